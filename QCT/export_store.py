@@ -0,0 +1,49 @@
+# ##############################################################################
+# Usage: python export_store.py store_path [Subj ...] [--out path]
+# ex) python export_store.py sample_data/ENV18PM/store_ENV18PM
+#     python export_store.py sample_data/ENV18PM/store_ENV18PM PMSN03001 --out review
+# ##############################################################################
+# 20221018, In Kyu Lee
+#  - Export images of the project store (get_QCT.py --store,
+#    run_cohort.py --store, see qct_store.py) to Analyze .hdr/.img,
+#    the same files as without --store.
+# ##############################################################################
+# Input:
+#  - Project store, ex) sample_data/ENV18PM/store_ENV18PM
+#  - Subjects (default: all)
+# Output:
+#  - .hdr/.img in --out (default: .),
+#    ex) PMSN03001_EX0-TO-PMSN03001_IN0-SSTVD_AirT.img
+# ##############################################################################
+
+# import libraries
+import os
+import argparse
+import time
+from tqdm.auto import tqdm
+
+import qct_store
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Export the project store to .hdr/.img')
+    parser.add_argument('store', type=str, help='Project store folder')
+    parser.add_argument('Subj', type=str, nargs='*', help='Subjects (default: all)')
+    parser.add_argument('--out', type=str, default='.', help='Output folder')
+    return parser.parse_args()
+
+
+def main():
+    start = time.time()
+    args = get_args()
+    arrays = [a for a in qct_store.list_arrays(args.store) if not args.Subj or a[0] in args.Subj]
+    os.makedirs(args.out, exist_ok=True)
+    for Subj, I1, I2, name, path in tqdm(arrays):
+        img_path = os.path.join(args.out, f'{Subj}_{I2}-TO-{Subj}_{I1}-SSTVD_{name}.img')
+        qct_store.export(path, img_path)
+    end = time.time()
+    print(f'{len(arrays)} files, Elapsed time: {end-start}s')
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,8 @@
 # ##############################################################################
 # 20220118, In Kyu Lee
 # No version suffix
+# 20221018, In Kyu Lee
+#  - Computation moved to qct_metrics.get_AirT
 # ##############################################################################
 # 02/19/2021, In Kyu Lee
 # Calculate Airtrapping
@@ -22,9 +24,9 @@
 # ##############################################################################
 
 # import libraries
-from medpy.io import load, save
-import numpy as np
-import pandas as pd
+from medpy.io import save
+from qct_io import load
+from qct_metrics import get_AirT
 import os
 import sys
 import time
@@ -56,30 +58,7 @@ EX_img,EX_header = load(EX_path)
 EX_lobe_img, _ = load(EX_lobe_path)
 atrap_h = EX_header
 
-# prepare .img
-atrap_img = np.zeros((EX_img.shape),dtype='uint8')
-atrap_img[(EX_img<threshold)] = 1
-atrap_img[EX_lobe_img==0] = 0
-
-# prepare Airtrapping stat
-EX_l0 = len(EX_img[EX_lobe_img==8])
-EX_l1 = len(EX_img[EX_lobe_img==16])
-EX_l2 = len(EX_img[EX_lobe_img==32])
-EX_l3 = len(EX_img[EX_lobe_img==64])
-EX_l4 = len(EX_img[EX_lobe_img==128])
-EX_t = EX_l0 + EX_l1 + EX_l2 + EX_l3 + EX_l4
-
-atrap_l0 = len(atrap_img[(EX_lobe_img==8)&(atrap_img==1)])
-atrap_l1 = len(atrap_img[(EX_lobe_img==16)&(atrap_img==1)])
-atrap_l2 = len(atrap_img[(EX_lobe_img==32)&(atrap_img==1)])
-atrap_l3 = len(atrap_img[(EX_lobe_img==64)&(atrap_img==1)])
-atrap_l4 = len(atrap_img[(EX_lobe_img==128)&(atrap_img==1)])
-atrap_t = atrap_l0 + atrap_l1 + atrap_l2 + atrap_l3 + atrap_l4
-
-atrap_stat = pd.DataFrame({'Lobes':['Lobe0','Lobe1','Lobe2','Lobe3','Lobe4','total'],
-              'airtrapratio':np.float32([atrap_l0/EX_l0,atrap_l1/EX_l1,atrap_l2/EX_l2,atrap_l3/EX_l3,atrap_l4/EX_l4,atrap_t/EX_t]),
-              'voxels_trap':[atrap_l0,atrap_l1,atrap_l2,atrap_l3,atrap_l4,atrap_t],
-              'Voxels':[EX_l0,EX_l1,EX_l2,EX_l3,EX_l4,EX_t]})
+atrap_img, atrap_stat = get_AirT(EX_img, EX_lobe_img, threshold)
 
 # Save
 atrap_stat.to_csv(atrap_stat_path, index=False, sep=' ')
@@ -5,6 +5,8 @@
 # ##############################################################################
 # 20220118, In Kyu Lee
 # No version suffix
+# 20221018, In Kyu Lee
+#  - Computation moved to qct_metrics.get_Emph
 # ##############################################################################
 # 03/22/2021, In Kyu Lee
 # Calculate Emphy% only
@@ -20,9 +22,9 @@
 # import libraries
 import os
 import sys
-from medpy.io import load, save
-import numpy as np
-import pandas as pd
+from medpy.io import save
+from qct_io import load
+from qct_metrics import get_Emph
 import time
 import SimpleITK as sitk
 sitk.ProcessObject_SetGlobalWarningDisplay(False)
@@ -52,32 +54,7 @@ IN_lobe_img, IN_lobe_header = load(IN_lobe_path)
 # get .hdr from IN.hdr
 emphy_h = IN_header
 
-# prepare .img
-emphy_img = np.zeros((IN_img.shape),dtype='uint8')
-# 2 if Emphysema
-emphy_img[(IN_img<emphy_threshold)] = 2
-# 0 if outside lobe
-emphy_img[IN_lobe_img==0] = 0
-
-# prepare emphysema & fsad stats
-IN_l0 = len(IN_img[IN_lobe_img==8])
-IN_l1 = len(IN_img[IN_lobe_img==16])
-IN_l2 = len(IN_img[IN_lobe_img==32])
-IN_l3 = len(IN_img[IN_lobe_img==64])
-IN_l4 = len(IN_img[IN_lobe_img==128])
-IN_t = IN_l0 + IN_l1 + IN_l2 + IN_l3 + IN_l4
-
-emphy_l0 = len(emphy_img[(IN_lobe_img==8)&(emphy_img==2)])
-emphy_l1 = len(emphy_img[(IN_lobe_img==16)&(emphy_img==2)])
-emphy_l2 = len(emphy_img[(IN_lobe_img==32)&(emphy_img==2)])
-emphy_l3 = len(emphy_img[(IN_lobe_img==64)&(emphy_img==2)])
-emphy_l4 = len(emphy_img[(IN_lobe_img==128)&(emphy_img==2)])
-emphy_t = emphy_l0 + emphy_l1 + emphy_l2 + emphy_l3 + emphy_l4
-
-emphy_stat = pd.DataFrame({'Lobes':['Lobe0','Lobe1','Lobe2','Lobe3','Lobe4','Total'],
-              'Emphysratio':np.float16([emphy_l0/IN_l0,emphy_l1/IN_l1,emphy_l2/IN_l2,emphy_l3/IN_l3,emphy_l4/IN_l4,emphy_t/IN_t]),
-              'voxels_Emphys':[emphy_l0,emphy_l1,emphy_l2,emphy_l3,emphy_l4,emphy_t],
-              'VoxelsAll':[IN_l0,IN_l1,IN_l2,IN_l3,IN_l4,IN_t]})
+emphy_img, emphy_stat = get_Emph(IN_img, IN_lobe_img, emphy_threshold)
 
 # Save
 emphy_stat.to_csv(emphy_stat_path, index=False, sep=' ')
@@ -5,6 +5,8 @@
 # ##############################################################################
 # 20220118, In Kyu Lee
 # No version suffix
+# 20221018, In Kyu Lee
+#  - Computation moved to qct_metrics.get_HAA
 # ##############################################################################
 # 02/19/2021, In Kyu Lee
 # Calculate HAA 
@@ -23,9 +25,9 @@
 import os
 import sys
 import time
-import numpy as np
-import pandas as pd
-from medpy.io import load, save
+from medpy.io import save
+from qct_io import load
+from qct_metrics import get_HAA
 import SimpleITK as sitk
 sitk.ProcessObject_SetGlobalWarningDisplay(False)
 import warnings
@@ -62,30 +64,7 @@ IN_lobe_img, IN_lobe_header = load(IN_lobe_path)
 # get .hdr from IN.hdr
 HAA_h = IN_header
 
-# prepare .img
-HAA_img = np.zeros((IN_img.shape),dtype='uint8')
-HAA_img[(l_threshold<=IN_img)&(IN_img<=u_threshold)] = 1
-# 0 if outside lobe
-HAA_img[IN_lobe_img==0] = 0
-
-IN_l0 = len(IN_img[IN_lobe_img==8])
-IN_l1 = len(IN_img[IN_lobe_img==16])
-IN_l2 = len(IN_img[IN_lobe_img==32])
-IN_l3 = len(IN_img[IN_lobe_img==64])
-IN_l4 = len(IN_img[IN_lobe_img==128])
-IN_t = IN_l0 + IN_l1 + IN_l2 + IN_l3 + IN_l4
-
-HAA_l0 = HAA_img[IN_lobe_img==8].sum()
-HAA_l1 = HAA_img[IN_lobe_img==16].sum()
-HAA_l2 = HAA_img[IN_lobe_img==32].sum()
-HAA_l3 = HAA_img[IN_lobe_img==64].sum()
-HAA_l4 = HAA_img[IN_lobe_img==128].sum()
-HAA_t = HAA_l0 + HAA_l1 + HAA_l2 + HAA_l3 + HAA_l4
-
-HAA_stat = pd.DataFrame({'Lobes':['Lobe0','Lobe1','Lobe2','Lobe3','Lobe4','total'],
-              'HAAratio':np.float16([HAA_l0/IN_l0,HAA_l1/IN_l1,HAA_l2/IN_l2,HAA_l3/IN_l3,HAA_l4/IN_l4,HAA_t/IN_t]),
-              'voxels_HAA':[HAA_l0,HAA_l1,HAA_l2,HAA_l3,HAA_l4,HAA_t],
-              'Voxels':[IN_l0,IN_l1,IN_l2,IN_l3,IN_l4,IN_t]})
+HAA_img, HAA_stat = get_HAA(IN_img, IN_lobe_img, l_threshold, u_threshold)
 
 # Save
 HAA_stat.to_csv(HAA_stat_path, index=False, sep=' ')
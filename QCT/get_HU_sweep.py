@@ -0,0 +1,77 @@
+# ##############################################################################
+# Usage: python get_HU_sweep.py Subj I1 I2 Img start stop step [upper]
+# ex) Emphysema % from -1000 to -900 HU:
+#       python get_HU_sweep.py PMSN03001 IN0 EX0 IN -1000 -900 10
+#     Airtrapping % from -900 to -800 HU:
+#       python get_HU_sweep.py PMSN03001 IN0 EX0 EX -900 -800 5
+#     HAA % with lower threshold from -800 to -600 HU and upper threshold 0 HU:
+#       python get_HU_sweep.py PMSN03001 IN0 EX0 IN -800 -600 50 0
+# Time: ~ 20s (independent of the number of thresholds)
+# ##############################################################################
+# 20221018, In Kyu Lee
+#  - Threshold sensitivity: one per-lobe HU histogram, then every threshold
+#    is read from the cumulative histogram.
+# ##############################################################################
+# Input:
+#  - CT image, ex) PMSN03001_IN0.img.gz (Img: I1) or PMSN03001_EX0.img.gz (Img: I2)
+#  - lobe mask of the same image, ex) PMSN03001_IN0_vida-lobes.img
+# Output:
+#  - lobar ratio for every threshold,
+#    ex) PMSN03001_EX0-TO-PMSN03001_IN0-SSTVD_lobar_sweep_IN0.txt
+#    - without upper: ratio of HU < threshold
+#    - with upper: ratio of threshold <= HU <= upper
+# ##############################################################################
+
+# import libraries
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+from qct_io import load
+import SimpleITK as sitk
+sitk.ProcessObject_SetGlobalWarningDisplay(False)
+
+from lobar import LOBE_NAMES, LobarHistogram
+
+start = time.time()
+Subj = str(sys.argv[1]) # Subj = 'PMSN03001'
+I1 = str(sys.argv[2]) # I1 = 'IN0'
+I2 = str(sys.argv[3]) # I2 = 'EX0'
+Img = str(sys.argv[4]) # Img = 'IN' or 'EX'
+thresholds = np.arange(int(sys.argv[5]), int(sys.argv[6])+1, int(sys.argv[7]))
+if len(sys.argv)==9:
+    upper = int(sys.argv[8])
+else:
+    upper = None
+I = I1 if Img=='IN' else I2
+
+# Input Path
+img_path = f'{Subj}_{I}.img.gz'
+lobe_path = f'{Subj}_{I}_vida-lobes.img'
+if not os.path.exists(lobe_path):
+    lobe_path = f'{Subj}_{I}_vida-lobes.img.gz'
+
+# Output Path
+sweep_stat_path = f'{Subj}_{I2}-TO-{Subj}_{I1}-SSTVD_lobar_sweep_{I}.txt'
+
+# Data Loading . . .
+img, _ = load(img_path)
+lobe_img, _ = load(lobe_path)
+hist = LobarHistogram.from_image(img, lobe_img)
+del img, lobe_img
+
+# one row per threshold
+rows = []
+for t in thresholds:
+    if upper is None:
+        rows.append(hist.fraction_below(t))
+    else:
+        rows.append(hist.fraction_between(t, upper))
+sweep_stat = pd.DataFrame(np.float32(rows), columns=LOBE_NAMES+['total'])
+sweep_stat.insert(0, 'threshold', thresholds)
+
+# Save
+sweep_stat.to_csv(sweep_stat_path, index=False, sep=' ')
+end = time.time()
+print(f'Elapsed time: {end-start}s')
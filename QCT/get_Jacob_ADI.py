@@ -0,0 +1,62 @@
+# ##############################################################################
+# Usage: python get_Jacob_ADI.py Subj I1 I2
+# Time: ~ 60s
+# Ref: Amelon et al., J Appl Physiol 2011 (ADI)
+# ##############################################################################
+# 20221018, In Kyu Lee
+# Jacobian determinant and anisotropic deformation index (ADI) from the
+# displacement field, computed in z-slabs (qct_metrics.get_Jacob_ADI).
+# Same layout as the lobar files of the registration pipeline
+# (_jacob_Lobe.dat, _ADI_Lobe.dat), which are not written over:
+# extract_QCT.py reads _lobar_jacob.txt & _lobar_ADI.txt if they exist.
+# ##############################################################################
+# Input:
+#  - displacement img, ex) PMSN03001_EX0-TO-PMSN03001_IN0-SSTVD_disp_resample.mhd
+#  - IN lobe mask, ex) PMSN03001_IN0_vida-lobes.img
+# Output:
+#  - Jacobian image, ex) PMSN03001_EX0-TO-PMSN03001_IN0-SSTVD_jacob_qct.img
+#  - ADI image, ex) PMSN03001_EX0-TO-PMSN03001_IN0-SSTVD_ADI_qct.img
+#  - Jacobian stat, ex) PMSN03001_EX0-TO-PMSN03001_IN0-SSTVD_lobar_jacob.txt
+#  - ADI stat, ex) PMSN03001_EX0-TO-PMSN03001_IN0-SSTVD_lobar_ADI.txt
+# ##############################################################################
+
+# import libraries
+import os
+import sys
+import time
+from medpy.io import save
+from qct_io import load
+import lobar
+from qct_metrics import get_Jacob_ADI
+import SimpleITK as sitk
+sitk.ProcessObject_SetGlobalWarningDisplay(False)
+import warnings
+warnings.filterwarnings("ignore")
+
+start = time.time()
+Subj = str(sys.argv[1]) # PMSN03001
+I1 = str(sys.argv[2]) # 'IN0'
+I2 = str(sys.argv[3]) # 'EX0'
+
+pre = f'{Subj}_{I2}-TO-{Subj}_{I1}-SSTVD'
+disp_path = f'{pre}_disp_resample.mhd'
+IN_lobe_path = f'{Subj}_{I1}_vida-lobes.img'
+if not os.path.exists(IN_lobe_path):
+    IN_lobe_path = f'{Subj}_{I1}_vida-lobes.img.gz'
+
+# Data Loading . . .
+disp, disp_h = load(disp_path)
+IN_lobe_img, IN_lobe_header = load(IN_lobe_path)
+# lung ROI with one voxel margin for the finite differences
+roi = lobar.lobe_bbox(IN_lobe_img, margin=1)
+J, ADI, J_stat, ADI_stat = get_Jacob_ADI(disp[roi], IN_lobe_img[roi], disp_h.get_voxel_spacing())
+J = lobar.paste(J, roi, disp.shape[:3])
+ADI = lobar.paste(ADI, roi, disp.shape[:3])
+
+# Save
+save(J, f'{pre}_jacob_qct.img', hdr=disp_h)
+save(ADI, f'{pre}_ADI_qct.img', hdr=disp_h)
+J_stat.to_csv(f'{pre}_lobar_jacob.txt', index=False, sep=' ')
+ADI_stat.to_csv(f'{pre}_lobar_ADI.txt', index=False, sep=' ')
+end = time.time()
+print(f'Elapsed time: {end-start}s')
@@ -0,0 +1,731 @@
+# ##############################################################################
+# Usage: python get_QCT.py Subj I1 I2 [I1 I2 ...] [options]
+# ex) python get_QCT.py PMSN03001 IN0 EX0
+#     python get_QCT.py PMSN03001 TLC0 FRC0 IND0 FRC0
+#     python get_QCT.py PMSN03001 IN0 EX0 --airt -856 --emph -950 --fsad -856 --haa -700 0
+# Time: ~ 40s
+# ##############################################################################
+# 20221018, In Kyu Lee
+#  - Single-pass step16: AirT, Emph_fSAD, HAA, RRAVC and S* in one process.
+#    Each input volume is loaded once and shared by every metric.
+#    Outputs are the same as get_Airtrapping.py, get_Emph_fSAD.py,
+#    get_HAA.py, get_RRAVC.py and get_S_norm.py.
+#  - Per-lobe HU histograms of IN, EX and warped EX, and the joint
+#    (IN, warped EX) histogram are saved to _lobar_hist.npz,
+#    see get_cohort_ratios.py.
+#  - _step16_manifest.json: inputs (name, size, mtime, optional sha1),
+#    thresholds and code version (get_QCT.py, qct_*.py & lobar.py) of each
+#    output. Reruns skip the metrics that are unchanged (--force to
+#    recompute, --hash to record sha1).
+#  - Metrics & histograms run on the lung ROI, the bounding box of the lobe
+#    mask (lobar.lobe_bbox), outputs are pasted back to the full image.
+#  - --voxels: metrics from the lung voxel tables (_lung_voxels.npz, see
+#    qct_voxels.py), 1D arrays of the voxels in the lobe masks.
+#    Reruns at new thresholds do not load the CT volumes.
+#    The lobe masks are indexed once (X_vida-lobes_index.npz) and shared
+#    by all registration pairs.
+#  - .img.gz inputs are decompressed with python-isal or pigz if available,
+#    and the next input volume is read ahead in a background thread.
+#  - Outputs are written by background threads (qct_io.AsyncWriter) while
+#    the next metric is computed.
+#  - --packed: label images as .lbl.npz (bit planes per slice, compressed),
+#    see unpack_labels.py to export them to Analyze.
+#  - _lobar_airDiff.txt & _lobar_fixed_tissue.txt (lobar air volume change
+#    and tissue fraction) from the RRAVC pass over airDiff & fixed_airVol,
+#    the _airDiff_Lobe.dat & _fixed_tissue_Lobe.dat of the registration
+#    pipeline are not written over.
+#  - _lobar_density_{I1}.txt & _lobar_density_{I2}.txt: lobar mean HU,
+#    percentiles (Perc15, ...) and air & tissue volumes of the IN & EX
+#    images, from the histograms of _lobar_hist.npz (not with --no-hist).
+#  - --jacobian: Jacobian & ADI of the displacement field (get_Jacob_ADI.py),
+#    from the displacement loaded for S*, as _lobar_jacob.txt &
+#    _lobar_ADI.txt. The _jacob_Lobe.dat & _ADI_Lobe.dat of the registration
+#    pipeline are not written over.
+#  - --store: output images in the per-project chunked store
+#    (qct_store.py), read by z-range without loading the whole image.
+#  - --slab NZ: bounded memory streaming, NZ slices at a time.
+#    Inputs are memory-mapped (.img.gz is decompressed to --tmp first)
+#    and outputs are written slab by slab, see qct_io.py.
+#  - --threads N: z-slabs of each volume are computed by N threads
+#    (lobar.map_slabs), default: number of CPUs. Outputs are the same for
+#    any N (per-slab results are merged in slab order).
+#  - --triage FRACTION: approximate lobar ratios (AirT, Emph, fSAD, HAA)
+#    and RRAVC mean with 95% intervals from a sample of the lobe voxels
+#    (--sample grid|random), see qct_triage.py. Only _lobar_triage.txt is
+#    written; rerun without --triage for the exact outputs.
+#    grid reads the images at the grid step (qct_io.load_strided); .img.gz
+#    inputs are still decompressed to the end.
+#  - Several registration pairs of a subject (run_step16_pairs): the CT
+#    images and lobe masks used by more than one pair (ex. FRC0 of TLC0 FRC0
+#    and IND0 FRC0) are loaded once and shared.
+# ##############################################################################
+# Input:
+#  - IN CT image, ex) PMSN03001_IN0.img.gz
+#  - EX CT image, ex) PMSN03001_EX0.img.gz
+#  - IN & EX lobe masks, ex) PMSN03001_IN0_vida-lobes.img
+#  - Warped image (From EX to IN), ex) PMSN03001_EX0-TO-PMSN03001_IN0-SSTVD.img.gz
+#  - airDiff img, ex) PMSN03001_EX0-TO-PMSN03001_IN0-SSTVD_airDiff.img
+#  - Fixed Air volume img, ex) PMSN03001_EX0-TO-PMSN03001_IN0-SSTVD_fixed_airVol.img
+#  - displacement img, ex) PMSN03001_EX0-TO-PMSN03001_IN0-SSTVD_disp_resample.mhd
+#  - IN & EX vida-histo, ex) PMSN03001_IN0_vida-histo.csv
+# Output:
+#  - _lobar_AirT.txt, _AirT.img
+#  - _lobar_Emph_fSAD.txt, _Emph_fSAD.img
+#  - _lobar_HAA{l}to{u}.txt, _HAA{l}to{u}.img
+#  - _lobar_RRAVC.txt, _RRAVC.img
+#  - _lobar_airDiff.txt, _lobar_fixed_tissue.txt
+#  - _lobar_s_norm.txt, _s_norm.img
+#  - _lobar_jacob.txt, _jacob_qct.img (--jacobian)
+#  - _lobar_ADI.txt, _ADI_qct.img (--jacobian)
+#  - _lobar_hist.npz: per-lobe HU histograms (skip with --no-hist)
+#  - _lobar_density_{I1}.txt, _lobar_density_{I2}.txt (not with --no-hist)
+#  - _step16_manifest.json
+#  - _lung_voxels.npz (--voxels)
+#  - _lobar_triage.txt (--triage, instead of all the above)
+#  - --store: images in {store}/{Subj}/{I2}-TO-{I1}/{name}.chunks instead of .img
+# ##############################################################################
+
+# import libraries
+import os
+import sys
+import argparse
+import numpy as np
+import time
+import hashlib
+import functools
+import contextlib
+import tempfile
+import traceback
+from medpy.io import save
+import qct_io
+import SimpleITK as sitk
+sitk.ProcessObject_SetGlobalWarningDisplay(False)
+
+import lobar
+import qct_cache
+import qct_kernels
+import qct_metrics
+import qct_store
+import qct_triage
+import qct_voxels
+
+
+# return .img if exists, otherwise .img.gz
+def find_img(path):
+    if not os.path.exists(path) and os.path.exists(path + '.gz'):
+        return path + '.gz'
+    return path
+
+
+# metrics of the RRAVC pass over airDiff & fixed_airVol
+AIR = {'RRAVC', 'airDiff', 'fixed_tissue'}
+# lobar density is computed from the histograms, not from the volumes
+DENSITY = {'density_IN', 'density_EX'}
+
+
+class Step16Paths:
+    def __init__(self, Subj, I1, I2, path='.', HAA_threshold=(-700, 0), packed=False, store=None):
+        pre = os.path.join(path, f'{Subj}_{I2}-TO-{Subj}_{I1}-SSTVD')
+        l_threshold, u_threshold = HAA_threshold
+        # label images as .lbl.npz (qct_io.save_packed) or .img
+        lbl = qct_io.LABEL_EXT if packed else '.img'
+        # Input Path
+        self.IN = os.path.join(path, f'{Subj}_{I1}.img.gz')
+        self.EX = os.path.join(path, f'{Subj}_{I2}.img.gz')
+        self.IN_lobe = find_img(os.path.join(path, f'{Subj}_{I1}_vida-lobes.img'))
+        self.EX_lobe = find_img(os.path.join(path, f'{Subj}_{I2}_vida-lobes.img'))
+        self.warped = f'{pre}.img.gz'
+        self.airdiff = find_img(f'{pre}_airDiff.img')
+        self.fixed = find_img(f'{pre}_fixed_airVol.img')
+        self.disp = f'{pre}_disp_resample.mhd'
+        self.disp_raw = f'{pre}_disp_resample.raw'
+        self.histo_IN = os.path.join(path, f'{Subj}_{I1}_vida-histo.csv')
+        self.histo_EX = os.path.join(path, f'{Subj}_{I2}_vida-histo.csv')
+        # Output Path
+        self.AirT_stat = f'{pre}_lobar_AirT.txt'
+        self.AirT_img = f'{pre}_AirT{lbl}'
+        self.Emph_fSAD_stat = f'{pre}_lobar_Emph_fSAD.txt'
+        self.Emph_fSAD_img = f'{pre}_Emph_fSAD{lbl}'
+        self.HAA_stat = f'{pre}_lobar_HAA{l_threshold}to{u_threshold}.txt'
+        self.HAA_img = f'{pre}_HAA{l_threshold}to{u_threshold}{lbl}'
+        self.RRAVC_stat = f'{pre}_lobar_RRAVC.txt'
+        self.RRAVC_img = f'{pre}_RRAVC.img'
+        self.s_norm_stat = f'{pre}_lobar_s_norm.txt'
+        self.s_norm_img = f'{pre}_s_norm.img'
+        self.density_IN_stat = f'{pre}_lobar_density_{I1}.txt'
+        self.density_EX_stat = f'{pre}_lobar_density_{I2}.txt'
+        # not the _airDiff_Lobe.dat & _fixed_tissue_Lobe.dat of the registration pipeline
+        self.airDiff_stat = f'{pre}_lobar_airDiff.txt'
+        self.fixed_tissue_stat = f'{pre}_lobar_fixed_tissue.txt'
+        # not the _jacob_Lobe.dat & _ADI_Lobe.dat of the registration pipeline
+        self.jacob_stat = f'{pre}_lobar_jacob.txt'
+        self.jacob_img = f'{pre}_jacob_qct.img'
+        self.ADI_stat = f'{pre}_lobar_ADI.txt'
+        self.ADI_img = f'{pre}_ADI_qct.img'
+        self.hist = f'{pre}_lobar_hist.npz'
+        self.manifest = f'{pre}_step16_manifest.json'
+        self.voxels = f'{pre}_lung_voxels.npz'
+        self.triage = f'{pre}_lobar_triage.txt'
+        # images in the project store (qct_store.py)
+        if store is not None:
+            self.AirT_img = qct_store.array_path(store, Subj, I1, I2, 'AirT')
+            self.Emph_fSAD_img = qct_store.array_path(store, Subj, I1, I2, 'Emph_fSAD')
+            self.HAA_img = qct_store.array_path(store, Subj, I1, I2, f'HAA{l_threshold}to{u_threshold}')
+            self.RRAVC_img = qct_store.array_path(store, Subj, I1, I2, 'RRAVC')
+            self.s_norm_img = qct_store.array_path(store, Subj, I1, I2, 's_norm')
+            self.jacob_img = qct_store.array_path(store, Subj, I1, I2, 'jacob')
+            self.ADI_img = qct_store.array_path(store, Subj, I1, I2, 'ADI')
+        # sources of each cached histogram
+        self.hist_sources = {'IN': [self.IN, self.IN_lobe],
+                             'EX': [self.EX, self.EX_lobe],
+                             'warped': [self.warped, self.IN_lobe],
+                             'joint': [self.IN, self.warped, self.IN_lobe]}
+        # sources of each lung voxel table (--voxels)
+        self.voxel_sources = {'EX': [self.EX, self.EX_lobe],
+                              'IN': [self.IN, self.warped, self.airdiff, self.fixed, self.IN_lobe]}
+        # inputs & outputs of each metric, and its name in the manifest
+        self.inputs = {'AirT': [self.EX, self.EX_lobe],
+                       'Emph_fSAD': [self.IN, self.IN_lobe, self.warped],
+                       'HAA': [self.IN, self.IN_lobe],
+                       'RRAVC': [self.airdiff, self.fixed, self.IN_lobe],
+                       'airDiff': [self.airdiff, self.IN_lobe],
+                       'fixed_tissue': [self.fixed, self.IN_lobe],
+                       's_norm': [self.disp, self.disp_raw, self.IN_lobe,
+                                  self.histo_IN, self.histo_EX],
+                       'density_IN': [self.IN, self.IN_lobe],
+                       'density_EX': [self.EX, self.EX_lobe],
+                       'jacob': [self.disp, self.disp_raw, self.IN_lobe],
+                       'ADI': [self.disp, self.disp_raw, self.IN_lobe]}
+        self.outputs = {'AirT': [self.AirT_img, self.AirT_stat],
+                        'Emph_fSAD': [self.Emph_fSAD_img, self.Emph_fSAD_stat],
+                        'HAA': [self.HAA_img, self.HAA_stat],
+                        'RRAVC': [self.RRAVC_img, self.RRAVC_stat],
+                        'airDiff': [self.airDiff_stat],
+                        'fixed_tissue': [self.fixed_tissue_stat],
+                        's_norm': [self.s_norm_img, self.s_norm_stat],
+                        'density_IN': [self.density_IN_stat],
+                        'density_EX': [self.density_EX_stat],
+                        'jacob': [self.jacob_img, self.jacob_stat],
+                        'ADI': [self.ADI_img, self.ADI_stat]}
+        self.manifest_name = {'AirT': 'AirT', 'Emph_fSAD': 'Emph_fSAD',
+                              'HAA': f'HAA{l_threshold}to{u_threshold}',
+                              'RRAVC': 'RRAVC', 'airDiff': 'airDiff',
+                              'fixed_tissue': 'fixed_tissue', 's_norm': 's_norm',
+                              'density_IN': f'density_{I1}', 'density_EX': f'density_{I2}',
+                              'jacob': 'jacob', 'ADI': 'ADI'}
+
+
+def write_output(img, stat, img_path, stat_path, hdr):
+    stat.to_csv(stat_path, index=False, sep=' ')
+    if isinstance(img, qct_io.SlabWriter):
+        img.close()
+    elif img_path.endswith(qct_io.LABEL_EXT):
+        qct_io.save_packed(img, img_path, hdr)
+    elif img_path.endswith(qct_store.STORE_EXT):
+        os.makedirs(os.path.dirname(img_path), exist_ok=True)
+        qct_store.save(img, img_path, hdr)
+    else:
+        save(img, img_path, hdr=hdr)
+
+
+# version of the code behind the outputs: hash of this script and of the
+# modules it computes & writes the outputs with
+def code_version():
+    h = hashlib.sha1()
+    for path in (__file__, qct_metrics.__file__, qct_kernels.__file__, lobar.__file__,
+                 qct_voxels.__file__, qct_io.__file__, qct_store.__file__,
+                 qct_cache.__file__, qct_triage.__file__):
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()[:12]
+
+
+def run_step16(Subj, I1, I2, path='.',
+               AirT_threshold=-856, emphy_threshold=-950, fSAD_threshold=-856,
+               HAA_threshold=(-700, 0), hist=True, slab=None, tmp=None,
+               force=False, hash=False, voxels=False, packed=False, store=None, writer=None,
+               threads=None, triage=None, sample='grid', seed=0, shared=None,
+               jacobian=False):
+    if threads is not None:
+        qct_kernels.set_threads(threads)
+    P = Step16Paths(Subj, I1, I2, path, HAA_threshold, packed, store)
+    if triage:
+        run_triage(P, AirT_threshold, emphy_threshold, fSAD_threshold, HAA_threshold,
+                   triage, sample, seed)
+        return
+    params = {'AirT': {'threshold': AirT_threshold},
+              'Emph_fSAD': {'emphy_threshold': emphy_threshold,
+                            'fSAD_threshold': fSAD_threshold},
+              'HAA': {'l_threshold': HAA_threshold[0], 'u_threshold': HAA_threshold[1]},
+              'RRAVC': {},
+              'airDiff': {},
+              'fixed_tissue': {},
+              's_norm': {}}
+    # Jacobian & ADI of the displacement field
+    if jacobian:
+        params['jacob'] = params['ADI'] = {}
+    # lobar density from the histograms
+    if hist:
+        params['density_IN'] = params['density_EX'] = {'percentiles': list(qct_metrics.PERCENTILES)}
+    manifest = qct_cache.Manifest(P.manifest, code_version(), hash)
+    # metrics to (re)compute
+    todo = {name for name in params
+            if force or not manifest.is_current(P.manifest_name[name], P.inputs[name],
+                                                params[name], P.outputs[name])}
+    # outputs are written in the background; with a writer of the caller,
+    # the caller flushes it (ex. while the next subject is computed)
+    if writer is None:
+        with qct_io.AsyncWriter() as writer:
+            _run_step16_mode(P, params, todo, manifest, hist, slab, tmp, voxels, writer, shared)
+    else:
+        _run_step16_mode(P, params, todo, manifest, hist, slab, tmp, voxels, writer, shared)
+
+
+def _run_step16_mode(P, params, todo, manifest, hist, slab, tmp, voxels, writer, shared):
+    if voxels:
+        _run_step16_voxels(P, params, todo, manifest, hist, writer, shared)
+    elif slab and shared is not None:
+        _run_step16(P, params, todo, manifest, hist, slab, shared.tmpdir, writer, shared)
+    elif slab:
+        with tempfile.TemporaryDirectory(dir=tmp) as tmpdir:
+            _run_step16(P, params, todo, manifest, hist, slab, tmpdir, writer)
+    else:
+        _run_step16(P, params, todo, manifest, hist, None, None, writer, shared)
+
+
+# Volumes shared by the registration pairs of a subject (run_step16_pairs):
+# {path: (img, header)} of the paths in keep (used by a later pair),
+# tmpdir: decompressed inputs of --slab
+class SharedVolumes:
+    def __init__(self, tmpdir=None):
+        self.volumes = {}
+        self.keep = set()
+        self.tmpdir = tmpdir
+
+    def get(self, path, load):
+        if path in self.volumes:
+            return self.volumes[path]
+        volume = load(path)
+        if path in self.keep:
+            self.volumes[path] = volume
+        return volume
+
+    # release the volumes that are not in keep
+    def release(self):
+        self.volumes = {path: v for path, v in self.volumes.items() if path in self.keep}
+
+
+# step16 of the registration pairs [(I1, I2), ...] of a subject.
+# CT images & lobe masks are kept while a later pair uses them.
+# A failed pair does not stop the others: {(I1, I2): traceback or None}
+def run_step16_pairs(Subj, pairs, path='.', slab=None, tmp=None, **kwargs):
+    Ps = [Step16Paths(Subj, I1, I2, path) for I1, I2 in pairs]
+    errors = {}
+    with (tempfile.TemporaryDirectory(dir=tmp) if slab else contextlib.nullcontext()) as tmpdir:
+        shared = SharedVolumes(tmpdir)
+        for k, (I1, I2) in enumerate(pairs):
+            shared.keep = {p for P in Ps[k+1:] for p in (P.IN, P.EX, P.IN_lobe, P.EX_lobe)}
+            if len(pairs) > 1:
+                print(f'{Subj} {I1} {I2}')
+            try:
+                run_step16(Subj, I1, I2, path, slab=slab, tmp=tmp, shared=shared, **kwargs)
+                errors[(I1, I2)] = None
+            except Exception:
+                errors[(I1, I2)] = traceback.format_exc()
+            shared.release()
+    return errors
+
+
+# write the output of a metric and record it in the manifest
+# full: function of img to the full size image (paste back a cropped output)
+# img None: a table only (ex. _lobar_airDiff.txt)
+def write_metric(P, manifest, params, name, img, stat, hdr, full=None):
+    if img is None:
+        stat.to_csv(P.outputs[name][0], index=False, sep=' ')
+    else:
+        img_path, stat_path = P.outputs[name]
+        if full is not None:
+            img = full(img)
+        write_output(img, stat, img_path, stat_path, hdr)
+    manifest.update(P.manifest_name[name], P.inputs[name], params[name], P.outputs[name])
+
+
+# lobar density of the IN & EX images from their histograms
+def write_density(P, params, todo, manifest, hists, writer):
+    for name, space, img_path in (('density_IN', 'IN', P.IN), ('density_EX', 'EX', P.EX)):
+        if name in todo:
+            voxel_volume = np.prod(qct_io.load_header(img_path)[0].get_voxel_spacing()[:3])
+            stat = qct_metrics.get_density(hists[space], voxel_volume, **params[name])
+            writer.submit(write_metric, P, manifest, params, name, None, stat, None)
+
+
+# input files of the stale metrics (todo) and of the missing histograms
+# (need), from their declared inputs (Step16Paths.inputs & hist_sources)
+def stale_inputs(P, todo, need):
+    paths = set()
+    for name in todo - DENSITY:
+        paths.update(P.inputs[name])
+    for name in need:
+        paths.update(P.hist_sources[name])
+    return paths
+
+
+# todo: metrics to compute, the others are skipped
+# slab: number of slices per z-slab (streaming), None: whole volumes
+def _run_step16(P, params, todo, manifest, hist, slab, tmpdir, writer, shared=None):
+    t = time.time()
+    def open_img(path):
+        if shared is not None:
+            return shared.get(path, _open_img)
+        return _open_img(path)
+    def _open_img(path):
+        if slab:
+            return qct_io.open_volume(path, tmpdir)
+        return qct_io.load(path)
+    # out= and chunk= of the metrics on the cropped image full[roi]
+    # nbits: bits of the label images (.lbl.npz)
+    def stream(full, roi, img_path, hdr, dtype=None, fill=0, nbits=1):
+        if not slab:
+            return {}
+        x, y = full[roi].shape[:2] if roi is not None else full.shape[:2]
+        if img_path.endswith(qct_io.LABEL_EXT):
+            out = qct_io.PackedWriter(img_path, full.shape[:3], hdr, nbits, roi, fill)
+        elif img_path.endswith(qct_store.STORE_EXT):
+            os.makedirs(os.path.dirname(img_path), exist_ok=True)
+            out = qct_store.StoreWriter(img_path, full.shape[:3], hdr, dtype, roi, fill)
+        else:
+            out = qct_io.SlabWriter(img_path, full.shape[:3], hdr, dtype, roi, fill)
+        return {'out': out, 'chunk': slab*x*y}
+    # paste back the cropped output (roi) to the full image and write
+    def done(name, img, stat, hdr, roi=None, shape=None, fill=0):
+        full = None
+        if roi is not None and isinstance(img, np.ndarray):
+            full = functools.partial(lobar.paste, roi=roi, shape=shape, fill=fill)
+        writer.submit(write_metric, P, manifest, params, name, img, stat, hdr, full)
+        nonlocal t
+        print(f'{name}: {time.time()-t:.1f}s'); t = time.time()
+    # histograms that are missing or stale in _lobar_hist.npz
+    hists = lobar.load_hist_cache(P.hist, P.hist_sources) if hist else {}
+    need = {name for name in P.hist_sources if hist and name not in hists}
+    new_hists = {}
+    skipped = sorted(set(params) - todo)
+    if skipped:
+        print(f'Unchanged: {skipped}')
+
+    # volumes to load, in the order they are used
+    inputs = stale_inputs(P, todo, need)
+    plan = [path for path in (P.EX, P.EX_lobe, P.IN_lobe, P.IN, P.warped, P.fixed, P.airdiff, P.disp)
+            if path in inputs]
+    use_EX = P.EX in inputs
+    use_IN_lobe = P.IN_lobe in inputs
+    use_IN = P.IN in inputs
+    use_warp = P.warped in inputs
+
+    # the next volume is read in the background while the current one is processed
+    with qct_io.Prefetcher(plan, open_img) as loader:
+        load = loader.get
+
+        # Airtrapping (EX space)
+        if use_EX:
+            EX_img, EX_header = load(P.EX)
+            EX_lobe_img, _ = load(P.EX_lobe)
+            # crop to the lung ROI
+            EX_roi = lobar.lobe_bbox(EX_lobe_img)
+            EX_shape = EX_img.shape
+            EX_lobe_crop = EX_lobe_img[EX_roi]
+            if 'AirT' in todo:
+                img, stat = qct_metrics.get_AirT(EX_img[EX_roi], EX_lobe_crop, **params['AirT'],
+                                                 **stream(EX_img, EX_roi, P.AirT_img, EX_header, 'uint8'))
+                done('AirT', img, stat, EX_header, EX_roi, EX_shape)
+                del img
+            if 'EX' in need:
+                new_hists['EX'] = lobar.LobarHistogram.from_image(EX_img[EX_roi], EX_lobe_crop)
+            del EX_img, EX_lobe_img, EX_lobe_crop
+
+        # Emph_fSAD & HAA (IN space), IN lobe mask is shared by all below
+        if use_IN_lobe:
+            IN_lobe_img, _ = load(P.IN_lobe)
+            # crop to the lung ROI
+            IN_roi = lobar.lobe_bbox(IN_lobe_img)
+            IN_lobe_crop = IN_lobe_img[IN_roi]
+        if use_IN:
+            IN_img, IN_header = load(P.IN)
+            IN_shape = IN_img.shape
+            IN_crop = IN_img[IN_roi]
+        if use_warp:
+            warp_img, _ = load(P.warped)
+            warp_crop = warp_img[IN_roi]
+            if 'Emph_fSAD' in todo:
+                img, stat = qct_metrics.get_Emph_fSAD(IN_crop, IN_lobe_crop, warp_crop,
+                                                      **params['Emph_fSAD'],
+                                                      **stream(IN_img, IN_roi, P.Emph_fSAD_img, IN_header, 'uint8',
+                                                               nbits=2))
+                done('Emph_fSAD', img, stat, IN_header, IN_roi, IN_shape)
+                del img
+            if 'warped' in need:
+                new_hists['warped'] = lobar.LobarHistogram.from_image(warp_crop, IN_lobe_crop)
+            if 'joint' in need:
+                new_hists['joint'] = lobar.JointHistogram.from_images(IN_crop, warp_crop, IN_lobe_crop)
+            del warp_img, warp_crop
+        if use_IN:
+            if 'IN' in need:
+                new_hists['IN'] = lobar.LobarHistogram.from_image(IN_crop, IN_lobe_crop)
+
+            if 'HAA' in todo:
+                img, stat = qct_metrics.get_HAA(IN_crop, IN_lobe_crop, **params['HAA'],
+                                                **stream(IN_img, IN_roi, P.HAA_img, IN_header, 'uint8'))
+                done('HAA', img, stat, IN_header, IN_roi, IN_shape)
+                del img
+            del IN_img, IN_crop
+
+        # RRAVC, _lobar_airDiff.txt & _lobar_fixed_tissue.txt (all are written if
+        # any changed), the RRAVC denominator is of the whole volume
+        if todo & AIR:
+            av_fixed_img, av_fixed_h = load(P.fixed)
+            airdiff_img, _ = load(P.airdiff)
+            RRAVC_den = qct_metrics.get_RRAVC_den(airdiff_img, av_fixed_img)
+            img, stat, airDiff_stat, tissue_stat = qct_metrics.get_RRAVC_dat(
+                airdiff_img[IN_roi], av_fixed_img[IN_roi], IN_lobe_crop,
+                np.prod(av_fixed_h.get_voxel_spacing()[:3]), RRAVC_den,
+                **stream(airdiff_img, IN_roi, P.RRAVC_img, av_fixed_h, 'float32', -100))
+            done('RRAVC', img, stat, av_fixed_h, IN_roi, airdiff_img.shape, -100)
+            done('airDiff', None, airDiff_stat, None)
+            done('fixed_tissue', None, tissue_stat, None)
+            del av_fixed_img, airdiff_img, img
+
+        if P.disp in inputs:
+            disp, disp_h = load(P.disp)
+        # S* is defined outside the lung as well: not cropped
+        if 's_norm' in todo:
+            V_IN = qct_metrics.get_lung_volume(P.histo_IN)
+            V_EX = qct_metrics.get_lung_volume(P.histo_EX)
+            img, stat = qct_metrics.get_S_norm(disp, IN_lobe_img, V_IN, V_EX,
+                                               **stream(disp, None, P.s_norm_img, disp_h, 'float32'))
+            done('s_norm', img, stat, disp_h)
+            del img
+
+        # Jacobian & ADI (both are written if either changed),
+        # ROI with one voxel margin for the finite differences
+        if todo & {'jacob', 'ADI'}:
+            J_roi = lobar.lobe_bbox(IN_lobe_img, margin=1)
+            J_out = stream(disp, J_roi, P.jacob_img, disp_h, 'float32')
+            ADI_out = stream(disp, J_roi, P.ADI_img, disp_h, 'float32')
+            out = (J_out['out'], ADI_out['out']) if slab else None
+            J, ADI, J_stat, ADI_stat = qct_metrics.get_Jacob_ADI(disp[J_roi], IN_lobe_img[J_roi],
+                                                                 disp_h.get_voxel_spacing(),
+                                                                 out, J_out.get('chunk'))
+            done('jacob', J, J_stat, disp_h, J_roi, disp.shape)
+            done('ADI', ADI, ADI_stat, disp_h, J_roi, disp.shape)
+            del J, ADI
+
+    if new_hists:
+        writer.submit(lobar.save_hist_cache, P.hist, new_hists, P.hist_sources)
+    write_density(P, params, todo, manifest, {**hists, **new_hists}, writer)
+
+
+# --triage: _lobar_triage.txt from a sample of fraction of the lobe voxels
+# grid: images are read at the grid step only (qct_io.load_strided), and
+# the lobe masks in full for the lobe voxel counts
+def run_triage(P, AirT_threshold, emphy_threshold, fSAD_threshold, HAA_threshold,
+               fraction, sample, seed):
+    t = time.time()
+    IN_lobe_img, _ = qct_io.load(P.IN_lobe)
+    EX_lobe_img, _ = qct_io.load(P.EX_lobe)
+    if sample == 'grid':
+        step = qct_triage.grid_step(fraction)
+        load = functools.partial(qct_io.load_strided, step=step)
+        lobe_counts = (lobar.lobar_count(IN_lobe_img)[:, 0], lobar.lobar_count(EX_lobe_img)[:, 0])
+        IN_lobe_img = np.array(IN_lobe_img[::step, ::step, ::step])
+        EX_lobe_img = np.array(EX_lobe_img[::step, ::step, ::step])
+        fraction = 1
+    else:
+        load = qct_io.load
+        lobe_counts = None
+    IN_img, _ = load(P.IN)
+    EX_img, _ = load(P.EX)
+    warp_img, _ = load(P.warped)
+    airdiff_img, _ = load(P.airdiff)
+    av_fixed_img, _ = load(P.fixed)
+    print(f'load: {time.time()-t:.1f}s'); t = time.time()
+    stat = qct_triage.get_triage(IN_img, IN_lobe_img, EX_img, EX_lobe_img, warp_img,
+                                 airdiff_img, av_fixed_img, AirT_threshold, emphy_threshold,
+                                 fSAD_threshold, HAA_threshold, fraction, sample, seed,
+                                 lobe_counts)
+    stat.to_csv(P.triage, index=False, sep=' ')
+    print(f'triage: {time.time()-t:.1f}s')
+
+
+# --voxels: metrics from the lung voxel tables (_lung_voxels.npz), built
+# from the volumes only if missing or stale. S* is from the volumes, since
+# its image is defined outside the lung as well.
+def _run_step16_voxels(P, params, todo, manifest, hist, writer, shared=None):
+    t = time.time()
+    def load(path):
+        if shared is not None:
+            return shared.get(path, qct_io.load)
+        return qct_io.load(path)
+    # scatter the 1D output of the table to the full image and write
+    def done(name, img, stat, hdr, table, fill=0):
+        full = functools.partial(table.scatter, fill=fill)
+        writer.submit(write_metric, P, manifest, params, name, img, stat, hdr, full)
+        nonlocal t
+        print(f'{name}: {time.time()-t:.1f}s'); t = time.time()
+    hists = lobar.load_hist_cache(P.hist, P.hist_sources) if hist else {}
+    need = {name for name in P.hist_sources if hist and name not in hists}
+    new_hists = {}
+    skipped = sorted(set(params) - todo)
+    if skipped:
+        print(f'Unchanged: {skipped}')
+
+    inputs = stale_inputs(P, todo, need)
+    tables = qct_voxels.load_cache(P.voxels, P.voxel_sources)
+    new_tables = {}
+    if 'EX' not in tables and P.EX in inputs:
+        table = qct_voxels.LungVoxels.from_index(qct_voxels.load_lobe_index(P.EX_lobe))
+        table.add('EX', load(P.EX)[0])
+        tables['EX'] = new_tables['EX'] = table
+    if 'IN' not in tables and inputs & {P.IN, P.warped, P.airdiff, P.fixed}:
+        table = qct_voxels.LungVoxels.from_index(qct_voxels.load_lobe_index(P.IN_lobe))
+        table.add('IN', load(P.IN)[0])
+        table.add('warped', qct_io.load(P.warped)[0])
+        table.add('airDiff', qct_io.load(P.airdiff)[0], keep_sum=True)
+        table.add('fixed_airVol', qct_io.load(P.fixed)[0], keep_sum=True)
+        tables['IN'] = new_tables['IN'] = table
+    if new_tables:
+        writer.submit(qct_voxels.save_cache, P.voxels, new_tables, P.voxel_sources)
+        print(f'Lung voxels: {time.time()-t:.1f}s'); t = time.time()
+
+    # Airtrapping (EX space)
+    if 'AirT' in todo:
+        EX = tables['EX']
+        img, stat = qct_metrics.get_AirT(EX['EX'], EX.lobe, **params['AirT'])
+        done('AirT', img, stat, qct_io.load_header(P.EX)[0], EX)
+    if 'EX' in need:
+        new_hists['EX'] = lobar.LobarHistogram.from_image(tables['EX']['EX'], tables['EX'].lobe)
+
+    # Emph_fSAD, HAA & RRAVC (IN space)
+    if 'IN' in tables:
+        IN = tables['IN']
+        IN_header = qct_io.load_header(P.IN)[0]
+        if 'Emph_fSAD' in todo:
+            img, stat = qct_metrics.get_Emph_fSAD(IN['IN'], IN.lobe, IN['warped'],
+                                                  **params['Emph_fSAD'])
+            done('Emph_fSAD', img, stat, IN_header, IN)
+        if 'HAA' in todo:
+            img, stat = qct_metrics.get_HAA(IN['IN'], IN.lobe, **params['HAA'])
+            done('HAA', img, stat, IN_header, IN)
+        if todo & AIR:
+            fixed_h = qct_io.load_header(P.fixed)[0]
+            RRAVC_den = qct_metrics.get_RRAVC_den(IN.sums['airDiff'], IN.sums['fixed_airVol'])
+            img, stat, airDiff_stat, tissue_stat = qct_metrics.get_RRAVC_dat(
+                IN['airDiff'], IN['fixed_airVol'], IN.lobe,
+                np.prod(fixed_h.get_voxel_spacing()[:3]), RRAVC_den)
+            done('RRAVC', img, stat, fixed_h, IN, -100)
+            writer.submit(write_metric, P, manifest, params, 'airDiff', None, airDiff_stat, None)
+            writer.submit(write_metric, P, manifest, params, 'fixed_tissue', None, tissue_stat, None)
+        if 'IN' in need:
+            new_hists['IN'] = lobar.LobarHistogram.from_image(IN['IN'], IN.lobe)
+        if 'warped' in need:
+            new_hists['warped'] = lobar.LobarHistogram.from_image(IN['warped'], IN.lobe)
+        if 'joint' in need:
+            new_hists['joint'] = lobar.JointHistogram.from_images(IN['IN'], IN['warped'], IN.lobe)
+
+    # S*, Jacobian & ADI
+    if P.disp in inputs:
+        IN_lobe_img, _ = load(P.IN_lobe)
+        disp, disp_h = qct_io.load(P.disp)
+    if 's_norm' in todo:
+        V_IN = qct_metrics.get_lung_volume(P.histo_IN)
+        V_EX = qct_metrics.get_lung_volume(P.histo_EX)
+        img, stat = qct_metrics.get_S_norm(disp, IN_lobe_img, V_IN, V_EX)
+        writer.submit(write_metric, P, manifest, params, 's_norm', img, stat, disp_h)
+        print(f's_norm: {time.time()-t:.1f}s'); t = time.time()
+    if todo & {'jacob', 'ADI'}:
+        J_roi = lobar.lobe_bbox(IN_lobe_img, margin=1)
+        J, ADI, J_stat, ADI_stat = qct_metrics.get_Jacob_ADI(disp[J_roi], IN_lobe_img[J_roi],
+                                                             disp_h.get_voxel_spacing())
+        full = functools.partial(lobar.paste, roi=J_roi, shape=disp.shape[:3])
+        writer.submit(write_metric, P, manifest, params, 'jacob', J, J_stat, disp_h, full)
+        writer.submit(write_metric, P, manifest, params, 'ADI', ADI, ADI_stat, disp_h, full)
+        print(f'jacob, ADI: {time.time()-t:.1f}s')
+
+    if new_hists:
+        writer.submit(lobar.save_hist_cache, P.hist, new_hists, P.hist_sources)
+    write_density(P, params, todo, manifest, {**hists, **new_hists}, writer)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='step16: AirT, Emph_fSAD, HAA, RRAVC, S*')
+    parser.add_argument('Subj', type=str)
+    parser.add_argument('pairs', type=str, nargs='+', metavar='I1 I2',
+                        help='Registration pairs: fixed & floating image, ex) IN0 EX0 [TLC0 FRC0 ...]')
+    parser.add_argument('--path', type=str, default='.', help='Subject folder')
+    parser.add_argument('--airt', type=int, default=-856, help='Airtrapping threshold')
+    parser.add_argument('--emph', type=int, default=-950, help='Emphysema threshold')
+    parser.add_argument('--fsad', type=int, default=-856, help='fSAD threshold')
+    parser.add_argument('--haa', type=int, nargs=2, default=[-700, 0],
+                        metavar=('LOWER', 'UPPER'), help='HAA thresholds')
+    parser.add_argument('--no-hist', action='store_true',
+                        help='Do not save per-lobe HU histograms (_lobar_hist.npz)')
+    parser.add_argument('--slab', type=int, default=None, metavar='NZ',
+                        help='Bounded memory streaming, NZ slices at a time')
+    parser.add_argument('--tmp', type=str, default=None,
+                        help='Folder for decompressed inputs of --slab (default: system temp)')
+    parser.add_argument('--voxels', action='store_true',
+                        help='Metrics from the lung voxel tables (_lung_voxels.npz)')
+    parser.add_argument('--packed', action='store_true',
+                        help='Label images (AirT, Emph_fSAD, HAA) as compact .lbl.npz')
+    parser.add_argument('--store', type=str, default=None,
+                        help='Project store folder for the output images, ex) ../store_ENV18PM')
+    parser.add_argument('--force', action='store_true',
+                        help='Recompute all metrics, even if unchanged')
+    parser.add_argument('--hash', action='store_true',
+                        help='Record sha1 of the inputs in the manifest')
+    parser.add_argument('--threads', type=int, default=os.cpu_count(),
+                        help='Threads per volume (default: number of CPUs)')
+    parser.add_argument('--jacobian', action='store_true',
+                        help='Jacobian & ADI of the displacement field (_lobar_jacob.txt, _lobar_ADI.txt)')
+    parser.add_argument('--triage', type=float, default=None, metavar='FRACTION',
+                        help='Approximate ratios from FRACTION of the lobe voxels (_lobar_triage.txt)')
+    parser.add_argument('--sample', type=str, default='grid', choices=qct_triage.MODES,
+                        help='Sample of --triage: grid (strided) or random')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of --sample random')
+    args = parser.parse_args()
+    if len(args.pairs) % 2:
+        parser.error('pairs need I1 I2 [I1 I2 ...]')
+    return args
+
+
+def main():
+    start = time.time()
+    args = get_args()
+    pairs = list(zip(args.pairs[0::2], args.pairs[1::2]))
+    errors = run_step16_pairs(args.Subj, pairs, args.path,
+                              AirT_threshold=args.airt,
+                              emphy_threshold=args.emph,
+                              fSAD_threshold=args.fsad,
+                              HAA_threshold=tuple(args.haa),
+                              hist=not args.no_hist,
+                              slab=args.slab,
+                              tmp=args.tmp,
+                              force=args.force,
+                              hash=args.hash,
+                              voxels=args.voxels,
+                              packed=args.packed,
+                              store=args.store,
+                              threads=args.threads,
+                              jacobian=args.jacobian,
+                              triage=args.triage,
+                              sample=args.sample,
+                              seed=args.seed)
+    end = time.time()
+    print(f'Elapsed time: {end-start}s')
+    failed = {pair: error for pair, error in errors.items() if error is not None}
+    for (I1, I2), error in failed.items():
+        print(f'{args.Subj} {I1} {I2} failed:\n{error}', file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
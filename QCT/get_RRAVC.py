@@ -5,6 +5,11 @@
 # ##############################################################################
 # 20220118, In Kyu Lee
 # No version suffix
+# 20221018, In Kyu Lee
+#  - Computation moved to qct_metrics.get_RRAVC
+#  - _lobar_airDiff.txt & _lobar_fixed_tissue.txt from the same pass
+#    (qct_metrics.get_RRAVC_dat), not over the _airDiff_Lobe.dat &
+#    _fixed_tissue_Lobe.dat of the registration pipeline
 # ##############################################################################
 # 02/24/2021, In Kyu Lee
 # Desc: Calculate RRAVC
@@ -18,15 +23,18 @@
 # Output:
 #  - RRAVC_img, ex) PMSN03001_EX0-TO-PMSN03001_IN0-SSTVD_RRAVC.img
 #  - RRAVC_stat, ex) PMSN03001_EX0-TO-PMSN03001_IN0-SSTVD_lobar_RRAVC.txt
+#  - airDiff stat, ex) PMSN03001_EX0-TO-PMSN03001_IN0-SSTVD_lobar_airDiff.txt
+#  - tissue fraction stat, ex) PMSN03001_EX0-TO-PMSN03001_IN0-SSTVD_lobar_fixed_tissue.txt
 # ##############################################################################
 
 # import libraries
 import os
 import sys
 import time
+from medpy.io import save
+from qct_io import load
 import numpy as np
-import pandas as pd
-from medpy.io import load, save
+from qct_metrics import get_RRAVC_dat
 import SimpleITK as sitk
 sitk.ProcessObject_SetGlobalWarningDisplay(False)
 import warnings
@@ -51,6 +59,8 @@ if not os.path.exists(IN_lobe_path):
 # Output Path
 RRAVC_stat_path = f'{Subj}_{I2}-TO-{Subj}_{I1}-SSTVD_lobar_RRAVC.txt'
 RRAVC_img_path = f'{Subj}_{I2}-TO-{Subj}_{I1}-SSTVD_RRAVC.img'
+airDiff_stat_path = f'{Subj}_{I2}-TO-{Subj}_{I1}-SSTVD_lobar_airDiff.txt'
+tissue_stat_path = f'{Subj}_{I2}-TO-{Subj}_{I1}-SSTVD_lobar_fixed_tissue.txt'
 
 # Data Loading . . .
 av_fixed_img, av_fixed_h = load(fixed_path)
@@ -59,52 +69,16 @@ IN_lobe_img, IN_lobe_header = load(IN_lobe_path)
 # get .hdr from IN.hdr
 RRAVC_h = av_fixed_h
 
-# air_dff/fixed_airvol
-# RRAVC_Denominator
-V_airdiff = np.sum(airdiff_img)
-V_airfixed = np.sum(av_fixed_img)
-RRAVC_den = V_airdiff/V_airfixed
-
-RRAVC_num = airdiff_img/av_fixed_img
-RRAVC_num[np.isnan(RRAVC_num)] = 0
-
-RRAVC_img = RRAVC_num/RRAVC_den
-
-# Set background to be -100
-RRAVC_img[IN_lobe_img==0] = -100
-
-# Prep stat
-RRAVC_l0 = np.mean(RRAVC_img[IN_lobe_img==8])
-RRAVC_l1 = np.mean(RRAVC_img[IN_lobe_img==16])
-RRAVC_l2 = np.mean(RRAVC_img[IN_lobe_img==32])
-RRAVC_l3 = np.mean(RRAVC_img[IN_lobe_img==64])
-RRAVC_l4 = np.mean(RRAVC_img[IN_lobe_img==128])
-RRAVC_mean = (RRAVC_l0 + RRAVC_l1 + RRAVC_l2 + RRAVC_l3 + RRAVC_l4)/5
-
-RRAVC_l0_sd = np.std(RRAVC_img[IN_lobe_img==8])
-RRAVC_l1_sd = np.std(RRAVC_img[IN_lobe_img==16])
-RRAVC_l2_sd = np.std(RRAVC_img[IN_lobe_img==32])
-RRAVC_l3_sd = np.std(RRAVC_img[IN_lobe_img==64])
-RRAVC_l4_sd = np.std(RRAVC_img[IN_lobe_img==128])
-RRAVC_sd = np.std(RRAVC_img[IN_lobe_img!=0])
-
-# CV = std/mean
-RRAVC_l0_cv = RRAVC_l0_sd/RRAVC_l0
-RRAVC_l1_cv = RRAVC_l1_sd/RRAVC_l1
-RRAVC_l2_cv = RRAVC_l2_sd/RRAVC_l2
-RRAVC_l3_cv = RRAVC_l3_sd/RRAVC_l3
-RRAVC_l4_cv = RRAVC_l4_sd/RRAVC_l4
-RRAVC_cv = RRAVC_sd/RRAVC_mean
-
-RRAVC_stat = pd.DataFrame({'Lobes':['Lobe0','Lobe1','Lobe2','Lobe3','Lobe4','All'],
-              'RRAVC_m':np.float16([RRAVC_l0,RRAVC_l1,RRAVC_l2,RRAVC_l3,RRAVC_l4,RRAVC_mean]),
-              'RRAVC_sd':np.float16([RRAVC_l0_sd,RRAVC_l1_sd,RRAVC_l2_sd,RRAVC_l3_sd,RRAVC_l4_sd,RRAVC_sd]),
-              'RRAVC_cv':np.float16([RRAVC_l0_cv,RRAVC_l1_cv,RRAVC_l2_cv,RRAVC_l3_cv,RRAVC_l4_cv,RRAVC_cv])})
+voxel_volume = np.prod(av_fixed_h.get_voxel_spacing()[:3])
+RRAVC_img, RRAVC_stat, airDiff_stat, tissue_stat = get_RRAVC_dat(airdiff_img, av_fixed_img,
+                                                                 IN_lobe_img, voxel_volume)
 
 # Save
 # Convert float64 -> float32
 save(RRAVC_img.astype('float32'),RRAVC_img_path,hdr=RRAVC_h)
 RRAVC_stat.to_csv(RRAVC_stat_path, index=False, sep=' ')
+airDiff_stat.to_csv(airDiff_stat_path, index=False, sep=' ')
+tissue_stat.to_csv(tissue_stat_path, index=False, sep=' ')
 
 end = time.time()
 print(f'Elapsed time: {end-start}s')
@@ -5,6 +5,9 @@
 # ##############################################################################
 # 20220118, In Kyu Lee
 # No version suffix
+# 20221018, In Kyu Lee
+#  - Computation moved to qct_metrics.get_S_norm
+#  - float32 output (float64 before)
 # ##############################################################################
 # v1c: 08/11/2021, In Kyu Lee
 # - Fixed: when V_IN < V_EX, s_norm returns nan issue.
@@ -25,22 +28,16 @@
 # import libraries
 import os
 import sys
-import numpy as np
 import time
 import pandas as pd
-from medpy.io import load, save
+from medpy.io import save
+from qct_io import load
+from qct_metrics import get_S_norm
 import SimpleITK as sitk
 sitk.ProcessObject_SetGlobalWarningDisplay(False)
 import warnings
 warnings.filterwarnings("ignore")
 
-def ownpow(a, b):
-    if a > 0:
-        return a**b
-    if a < 0:
-        temp = abs(a)**b
-        return -1*temp
-
 start = time.time()
 Subj = str(sys.argv[1]) # PMSN03001
 I1 = str(sys.argv[2]) # 'IN0'
@@ -67,39 +64,7 @@ V_IN = V_IN * 1000
 disp, disp_h = load(disp_path)
 IN_lobe_img, IN_lobe_header = load(IN_lobe_path)
 s_norm_h = disp_h
-# [mm]
-s = (disp[:,:,:,0]**2+disp[:,:,:,1]**2+disp[:,:,:,2]**2)**0.5
-# This doesn't work if V_IN- V_EX is negative
-# s_norm = s/((V_IN-V_EX)**(1/3))
-s_norm = s/ownpow(V_IN-V_EX,1/3)
-
-# Prep stat
-s_norm_l0 = np.mean(s_norm[IN_lobe_img==8])
-s_norm_l1 = np.mean(s_norm[IN_lobe_img==16])
-s_norm_l2 = np.mean(s_norm[IN_lobe_img==32])
-s_norm_l3 = np.mean(s_norm[IN_lobe_img==64])
-s_norm_l4 = np.mean(s_norm[IN_lobe_img==128])
-s_norm_mean = (s_norm_l0 + s_norm_l1 + s_norm_l2 + s_norm_l3 + s_norm_l4)/5
-
-s_norm_l0_sd = np.std(s_norm[IN_lobe_img==8])
-s_norm_l1_sd = np.std(s_norm[IN_lobe_img==16])
-s_norm_l2_sd = np.std(s_norm[IN_lobe_img==32])
-s_norm_l3_sd = np.std(s_norm[IN_lobe_img==64])
-s_norm_l4_sd = np.std(s_norm[IN_lobe_img==128])
-s_norm_sd = np.std(s_norm[IN_lobe_img!=0])
-
-# CV = std/mean
-s_norm_l0_cv = s_norm_l0_sd/s_norm_l0
-s_norm_l1_cv = s_norm_l1_sd/s_norm_l1
-s_norm_l2_cv = s_norm_l2_sd/s_norm_l2
-s_norm_l3_cv = s_norm_l3_sd/s_norm_l3
-s_norm_l4_cv = s_norm_l4_sd/s_norm_l4
-s_norm_cv = s_norm_sd/s_norm_mean
-
-s_norm_stat = pd.DataFrame({'Lobes':['Lobe0','Lobe1','Lobe2','Lobe3','Lobe4','All'],
-              'sStar_m':np.float16([s_norm_l0,s_norm_l1,s_norm_l2,s_norm_l3,s_norm_l4,s_norm_mean]),
-              'sStar_sd':np.float16([s_norm_l0_sd,s_norm_l1_sd,s_norm_l2_sd,s_norm_l3_sd,s_norm_l4_sd,s_norm_sd]),
-              'sStar_cv':np.float16([s_norm_l0_cv,s_norm_l1_cv,s_norm_l2_cv,s_norm_l3_cv,s_norm_l4_cv,s_norm_cv])})
+s_norm, s_norm_stat = get_S_norm(disp, IN_lobe_img, V_IN, V_EX)
 
 
 # Save
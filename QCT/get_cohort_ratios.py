@@ -0,0 +1,102 @@
+# ##############################################################################
+# Usage: python get_cohort_ratios.py Proj_path Proj I1 I2 [options]
+# ex) python get_cohort_ratios.py sample_data/ENV18PM ENV18PM IN0 EX0
+#       --emph -950 -910 --airt -856 -850 --haa -700 0 -600 -250
+#       --fsad -950 -856 -950 -830
+# Time: ~ 1s for 100 subjects
+# ##############################################################################
+# 20221018, In Kyu Lee
+#  - Lobar Emph, AirT and HAA ratios of a whole project at any thresholds
+#    from the _lobar_hist.npz files written by get_QCT.py.
+#    No image is loaded.
+#  - fSAD and normal ratios (PRM) from the joint (IN, warped EX) histogram.
+# ##############################################################################
+# Input:
+#  - Project folder, ex) sample_data/ENV18PM
+#  - Histogram cache in each subject folder,
+#    ex) ENV18PM_PMSN03001/PMSN03001_EX0-TO-PMSN03001_IN0-SSTVD_lobar_hist.npz
+# Output:
+#  - one row per subject, ex) ENV18PM_IN0_EX0_lobar_hist_all.csv
+#    - Emph{t}_All, Emph{t}_LUL, ...: IN < t
+#    - AirT{t}_All, AirT{t}_LUL, ...: EX < t
+#    - HAA{l}to{u}_All, HAA{l}to{u}_LUL, ...: l <= IN <= u
+#    - fSAD{e}_{f}_All, ...: e <= IN and warped EX < f
+#    - Normal{e}_{f}_All, ...: neither Emph (IN < e) nor fSAD
+# Subjects without (fresh) histograms are reported and skipped.
+# ##############################################################################
+
+# import libraries
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from tqdm.auto import tqdm
+
+import lobar
+from get_QCT import Step16Paths
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Lobar ratios from _lobar_hist.npz')
+    parser.add_argument('path', type=str, help='Project folder')
+    parser.add_argument('Proj', type=str)
+    parser.add_argument('I1', type=str, help='Fixed image, ex) IN0')
+    parser.add_argument('I2', type=str, help='Floating image, ex) EX0')
+    parser.add_argument('--emph', type=int, nargs='*', default=[-950])
+    parser.add_argument('--airt', type=int, nargs='*', default=[-856])
+    parser.add_argument('--haa', type=int, nargs='*', default=[-700, 0],
+                        help='pairs of lower and upper thresholds')
+    parser.add_argument('--fsad', type=int, nargs='*', default=[-950, -856],
+                        help='pairs of Emph and fSAD thresholds')
+    return parser.parse_args()
+
+
+def add_ratio(df, name, ratio):
+    # ratio: Lobe0-Lobe4 & total
+    df[f'{name}_All'] = ratio[5]
+    for abbr, r in zip(lobar.LOBE_ABBR, ratio[:5]):
+        df[f'{name}_{abbr}'] = r
+
+
+def main():
+    args = get_args()
+    path, Proj, I1, I2 = args.path, args.Proj, args.I1, args.I2
+    HAA_thresholds = list(zip(args.haa[0::2], args.haa[1::2]))
+    fSAD_thresholds = list(zip(args.fsad[0::2], args.fsad[1::2]))
+
+    Subjs = [
+        f.split("_")[1]
+        for f in os.listdir(path)
+        if os.path.isdir(os.path.join(path, f)) and f.split("_")[0] == Proj
+    ]
+    rows = []
+    missing = []
+    for Subj in tqdm(Subjs):
+        P = Step16Paths(Subj, I1, I2, os.path.join(path, f'{Proj}_{Subj}'))
+        hists = lobar.load_hist_cache(P.hist, P.hist_sources)
+        if not hists:
+            missing.append(Subj)
+            continue
+        df = {'Proj': Proj, 'Subj': Subj}
+        for t in args.emph:
+            add_ratio(df, f'Emph{t}', hists['IN'].fraction_below(t) if 'IN' in hists else [np.nan]*6)
+        for t in args.airt:
+            add_ratio(df, f'AirT{t}', hists['EX'].fraction_below(t) if 'EX' in hists else [np.nan]*6)
+        for l, u in HAA_thresholds:
+            add_ratio(df, f'HAA{l}to{u}', hists['IN'].fraction_between(l, u) if 'IN' in hists else [np.nan]*6)
+        for e, f in fSAD_thresholds:
+            _, fsad, normal = hists['joint'].fraction_prm(e, f) if 'joint' in hists else [[np.nan]*6]*3
+            add_ratio(df, f'fSAD{e}_{f}', fsad)
+            add_ratio(df, f'Normal{e}_{f}', normal)
+        rows.append(df)
+
+    if missing:
+        print(f'No histogram (or source image changed): {missing}')
+    # Save all subjects
+    pd.DataFrame(rows).to_csv(
+        os.path.join(path, f'{Proj}_{I1}_{I2}_lobar_hist_all.csv'), index=False
+    )
+
+
+if __name__ == "__main__":
+    main()
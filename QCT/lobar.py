@@ -0,0 +1,448 @@
+# ##############################################################################
+# lobar.py
+# Lobar reduction kernel shared by the QCT scripts
+# ##############################################################################
+# 20221018, In Kyu Lee
+#  - Per-lobe counts, sums and sums of squares with np.bincount over a lobe
+#    index instead of one boolean mask (IN_lobe_img==8, ...) per lobe.
+#  - lobe_bbox / paste: lung ROI cropping.
+#  - map_slabs: slabs computed by a thread pool (set_threads), results
+#    merged in slab order.
+# ##############################################################################
+# Lobe index (lobe_index):
+#  0: background (lobe mask == 0)
+#  1-5: Lobe0-Lobe4 (lobe mask == 8, 16, 32, 64, 128)
+#  6: any other non-zero label
+# Volumes are reduced in z-slabs of about CHUNK voxels, such that
+# temporaries stay small and every voxel is visited once.
+# With THREADS > 1, the slabs are computed by a thread pool (NumPy releases
+# the GIL in its loops). Results are merged in slab order, such that counts
+# and float sums are the same for any number of threads.
+# ##############################################################################
+import os
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import qct_cache
+
+LOBES = [8, 16, 32, 64, 128]
+LOBE_NAMES = ['Lobe0', 'Lobe1', 'Lobe2', 'Lobe3', 'Lobe4']
+# lobe0: lu | lobe1: ll | lobe2: ru | lobe3: rm | lobe4: rl
+LOBE_ABBR = ['LUL', 'LLL', 'RUL', 'RML', 'RLL']
+NLABEL = 7
+OTHER = 6
+CHUNK = 1 << 22
+# threads of map_slabs, see set_threads
+THREADS = 1
+
+_LUT = np.full(256, OTHER, dtype=np.uint8)
+_LUT[0] = 0
+_LUT[LOBES] = np.arange(1, 6, dtype=np.uint8)
+
+
+# lobe mask -> lobe index (uint8, 0-6)
+def lobe_index(lobe_img):
+    lobe_img = np.asarray(lobe_img)
+    if lobe_img.dtype == np.uint8:
+        return _LUT[lobe_img]
+    lobe_img = lobe_img.astype(np.int64)
+    idx = np.take(_LUT, lobe_img, mode='clip')
+    # labels out of the uint8 range are "other", not background
+    idx[(lobe_img!=0)&(idx==0)] = OTHER
+    return idx
+
+
+# Index tuples of z-slabs (last axis of shape) with about chunk voxels each.
+# For 3D shape, slabs can index 4D (x,y,z,c) arrays as well.
+def slabs(shape, chunk=None):
+    chunk = chunk or CHUNK
+    axis = len(shape) - 1
+    plane = int(np.prod(shape[:axis]))
+    step = max(1, chunk // max(plane, 1))
+    for z in range(0, shape[axis], step):
+        yield (slice(None),)*axis + (slice(z, min(z+step, shape[axis])),)
+
+
+# number of threads of map_slabs, None: number of CPUs
+def set_threads(n=None):
+    global THREADS
+    THREADS = max(1, int(n or os.cpu_count() or 1))
+
+
+# (sl, fn(sl)) of each slab, in slab order. fn runs on `threads` slabs at a
+# time, at most 2*threads results are pending (memory of 2*threads slabs).
+def map_slabs(fn, shape, chunk=None, threads=None):
+    threads = threads or THREADS
+    if threads == 1:
+        for sl in slabs(shape, chunk):
+            yield sl, fn(sl)
+        return
+    with ThreadPoolExecutor(threads) as pool:
+        pending = collections.deque()
+        for sl in slabs(shape, chunk):
+            pending.append((sl, pool.submit(fn, sl)))
+            if len(pending) >= 2*threads:
+                sl, future = pending.popleft()
+                yield sl, future.result()
+        while pending:
+            sl, future = pending.popleft()
+            yield sl, future.result()
+
+
+# counts[label, class] of one chunk
+# classes: integer or bool array (values < nclass), same shape as idx
+def bincount_lobes(idx, classes=None, nclass=1):
+    idx = idx.ravel(order='F')
+    if classes is None:
+        return np.bincount(idx, minlength=NLABEL).reshape(NLABEL, 1)
+    key = idx.astype(np.intp)
+    key *= nclass
+    key += classes.ravel(order='F')
+    return np.bincount(key, minlength=NLABEL*nclass).reshape(NLABEL, nclass)
+
+
+# moments[label] = (count, sum, sum of squares) of one chunk
+def moments_lobes(idx, values):
+    idx = idx.ravel(order='F')
+    values = values.ravel(order='F').astype(np.float64)
+    moments = np.empty((NLABEL, 3))
+    moments[:, 0] = np.bincount(idx, minlength=NLABEL)
+    moments[:, 1] = np.bincount(idx, weights=values, minlength=NLABEL)
+    values *= values
+    moments[:, 2] = np.bincount(idx, weights=values, minlength=NLABEL)
+    return moments
+
+
+# Whole volume: counts[label, class]
+def lobar_count(lobe_img, classes=None, nclass=1):
+    def count(sl):
+        c = None if classes is None else classes[sl]
+        return bincount_lobes(lobe_index(lobe_img[sl]), c, nclass)
+    counts = np.zeros((NLABEL, nclass), dtype=np.int64)
+    for _, c in map_slabs(count, lobe_img.shape):
+        counts += c
+    return counts
+
+
+# Whole volume: moments[label] = (count, sum, sum of squares)
+def lobar_moments(lobe_img, values):
+    moments = np.zeros((NLABEL, 3))
+    for _, m in map_slabs(lambda sl: moments_lobes(lobe_index(lobe_img[sl]), values[sl]),
+                          lobe_img.shape):
+        moments += m
+    return moments
+
+
+# Lobe0-Lobe4 and the sum of the five lobes
+def lobe_totals(x):
+    x = list(x[1:6])
+    return x + [sum(x)]
+
+
+# mean, sd and cv from moments
+# All: mean of the lobar means, sd of every non-zero label
+def lobar_m_sd_cv(moments):
+    n, s, ss = moments[:, 0], moments[:, 1], moments[:, 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m = s/n
+        sd = np.sqrt(np.maximum(ss/n - m*m, 0))
+        n_all = n[1:].sum()
+        m_all = s[1:].sum()/n_all
+        sd_all = np.sqrt(max(ss[1:].sum()/n_all - m_all*m_all, 0))
+        m = list(m[1:6]) + [sum(m[1:6])/5]
+        sd = list(sd[1:6]) + [sd_all]
+        # CV = std/mean
+        cv = [a/b for a, b in zip(sd, m)]
+    return m, sd, cv
+
+
+# ##############################################################################
+# Lung ROI
+# ##############################################################################
+# Voxels outside the bounding box of the lobe mask are background, so the
+# metrics can run on the cropped views img[roi] and the full size outputs
+# are pasted back only when they are written.
+
+# Bounding box of the lobe mask (non-zero) as (x, y, z) slices,
+# grown by margin voxels. The whole volume if the mask is empty.
+def lobe_bbox(lobe_img, margin=0):
+    shape = lobe_img.shape[:3]
+    any_x = np.zeros(shape[0], dtype=bool)
+    any_y = np.zeros(shape[1], dtype=bool)
+    any_z = np.zeros(shape[2], dtype=bool)
+    def project(sl):
+        mask = lobe_img[sl] != 0
+        return mask.any(axis=(1, 2)), mask.any(axis=(0, 2)), mask.any(axis=(0, 1))
+    for sl, (x, y, z) in map_slabs(project, shape):
+        any_x |= x
+        any_y |= y
+        any_z[sl[-1]] = z
+    if not any_z.any():
+        return (slice(None),)*3
+    roi = []
+    for a, n in zip((any_x, any_y, any_z), shape):
+        nonzero = np.flatnonzero(a)
+        roi.append(slice(max(int(nonzero[0])-margin, 0), min(int(nonzero[-1])+1+margin, n)))
+    return tuple(roi)
+
+
+# full size image from img = full[roi], fill outside roi
+def paste(img, roi, shape, fill=0):
+    full = np.full(tuple(shape[:3]) + img.shape[3:], fill, dtype=img.dtype)
+    full[roi] = img
+    return full
+
+
+# ##############################################################################
+# Per-lobe HU histogram
+# ##############################################################################
+# One bin per integer HU over the int16 range. Once built, any number of
+# threshold queries are answered from the cumulative counts without
+# touching the image again. Non-integer images are floored, which keeps
+# "HU < t" exact for integer thresholds t.
+HU_MIN = -32768
+NBIN = 65536
+
+
+class LobarHistogram:
+    def __init__(self, hist, hu_min=HU_MIN):
+        self.hist = np.asarray(hist, dtype=np.int64)
+        self.hu_min = hu_min
+        # cum[:, k]: number of voxels with HU < hu_min + k
+        self.cum = np.zeros((self.hist.shape[0], self.hist.shape[1]+1), dtype=np.int64)
+        np.cumsum(self.hist, axis=1, out=self.cum[:, 1:])
+
+    @classmethod
+    def from_image(cls, img, lobe_img):
+        hist = np.zeros(NLABEL*NBIN, dtype=np.int64)
+        for _, h in map_slabs(lambda sl: bincount_hu(lobe_index(lobe_img[sl]), img[sl]), img.shape):
+            hist += h
+        return cls(hist.reshape(NLABEL, NBIN))
+
+    def _bin(self, t):
+        return int(np.clip(np.floor(t) - self.hu_min, 0, self.cum.shape[1]-1))
+
+    # number of voxels per label
+    @property
+    def voxels(self):
+        return self.cum[:, -1]
+
+    # number of voxels per label with HU < t
+    def count_below(self, t):
+        return self.cum[:, self._bin(t)]
+
+    # number of voxels per label with lower <= HU <= upper
+    def count_between(self, lower, upper):
+        return self.cum[:, self._bin(upper+1)] - self.cum[:, self._bin(lower)]
+
+    # Lobe0-Lobe4 & total fraction of HU < t
+    def fraction_below(self, t):
+        return lobar_fraction(self.count_below(t), self.voxels)
+
+    # Lobe0-Lobe4 & total fraction of lower <= HU <= upper
+    def fraction_between(self, lower, upper):
+        return lobar_fraction(self.count_between(lower, upper), self.voxels)
+
+    # Lobe0-Lobe4 & total rows of the histogram
+    def lobe_rows(self):
+        h = self.hist[1:6]
+        return np.vstack([h, h.sum(axis=0)])
+
+    # Lobe0-Lobe4 & total mean HU
+    def mean(self):
+        h = self.lobe_rows()
+        hu = np.arange(self.hu_min, self.hu_min + h.shape[1], dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (h @ hu) / h.sum(axis=1)
+
+    # Lobe0-Lobe4 & total HU percentile p (0-100), the same as np.percentile
+    # (linear) of the voxels: from the cumulative counts, without sorting
+    def percentile(self, p):
+        cum = np.cumsum(self.lobe_rows(), axis=1)
+        out = np.full(cum.shape[0], np.nan)
+        for i, c in enumerate(cum):
+            n = c[-1]
+            if n == 0:
+                continue
+            pos = p/100*(n-1)
+            k = int(np.floor(pos))
+            # HU of the voxels of rank k & k+1 (0-based, ascending)
+            lo, hi = np.searchsorted(c, [k, min(k+1, n-1)], side='right') + self.hu_min
+            out[i] = lo + (pos-k)*(hi-lo)
+        return out
+
+    # Lobe0-Lobe4 & total (air, tissue) in voxels:
+    # air fraction of a voxel -HU/1000, clipped to [0, 1]
+    def air_tissue(self):
+        h = self.lobe_rows()
+        hu = np.arange(self.hu_min, self.hu_min + h.shape[1], dtype=np.float64)
+        air = h @ np.clip(-hu/1000, 0, 1)
+        return air, h.sum(axis=1) - air
+
+    # only the occupied HU range is stored: (hist[:, lo:hi], hu_min+lo)
+    def trimmed(self):
+        occupied = np.flatnonzero(self.hist.any(axis=0))
+        if len(occupied)==0:
+            return self.hist[:, :0], self.hu_min
+        lo, hi = occupied[0], occupied[-1]+1
+        return self.hist[:, lo:hi], self.hu_min+lo
+
+
+# HU histogram of one chunk: hist[label*NBIN + HU-HU_MIN]
+def bincount_hu(idx, img):
+    img = img.ravel(order='F')
+    if np.issubdtype(img.dtype, np.floating):
+        img = np.floor(img)
+    key = np.clip(img, HU_MIN, HU_MIN+NBIN-1).astype(np.intp)
+    key -= HU_MIN
+    key += idx.ravel(order='F').astype(np.intp) * NBIN
+    return np.bincount(key, minlength=NLABEL*NBIN)
+
+
+# Lobe0-Lobe4 & total ratio
+def lobar_fraction(count, voxels):
+    count = np.asarray(lobe_totals(count), dtype=np.float64)
+    voxels = np.asarray(lobe_totals(voxels), dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return count/voxels
+
+
+# ##############################################################################
+# Per-lobe joint histogram of (IN HU, warped EX HU)
+# ##############################################################################
+# Bins: one per integer HU in [lower, upper), HU < lower is counted in the
+# first bin and HU >= upper in one extra bin. Emph, fSAD and normal ratios are
+# therefore exact for any thresholds lower < t <= upper.
+# Voxels are classified as in get_Emph_fSAD.py:
+#  - Emph: IN < emphy_threshold
+#  - fSAD: emphy_threshold <= IN and warped EX < fSAD_threshold
+#  - normal: the rest
+JOINT_RANGE = (-1100, -500)
+
+
+class JointHistogram:
+    def __init__(self, hist, hu_range=JOINT_RANGE):
+        self.hist = np.asarray(hist, dtype=np.int64)
+        self.hu_range = tuple(int(h) for h in hu_range)
+        # cum[:, i, j]: number of voxels with IN bin < i and warped bin < j
+        n = self.hist.shape[1]
+        self.cum = np.zeros((self.hist.shape[0], n+1, n+1), dtype=np.int64)
+        np.cumsum(np.cumsum(self.hist, axis=1), axis=2, out=self.cum[:, 1:, 1:])
+
+    @classmethod
+    def from_images(cls, IN_img, warp_img, lobe_img, hu_range=JOINT_RANGE):
+        n = hu_range[1] - hu_range[0] + 1
+        hist = np.zeros(NLABEL*n*n, dtype=np.int64)
+        lock = threading.Lock()
+        # each slab is added to hist by its worker (integer counts, the same
+        # in any order), counted over the occupied key range only, such that
+        # no full-size histogram per slab is pending in map_slabs
+        def count(sl):
+            idx = lobe_index(lobe_img[sl]).ravel(order='F')
+            if idx.size == 0:
+                return
+            key = idx.astype(np.intp)
+            key *= n
+            key += _joint_bin(IN_img[sl], hu_range)
+            key *= n
+            key += _joint_bin(warp_img[sl], hu_range)
+            lo = key.min()
+            key -= lo
+            h = np.bincount(key)
+            with lock:
+                hist[lo:lo+len(h)] += h
+        for _ in map_slabs(count, IN_img.shape):
+            pass
+        return cls(hist.reshape(NLABEL, n, n), hu_range)
+
+    def _bin(self, t):
+        lower, upper = self.hu_range
+        if not lower < t <= upper:
+            raise ValueError(f'threshold {t} is out of the joint histogram range ({lower}, {upper}]')
+        return int(np.floor(t)) - lower
+
+    @property
+    def voxels(self):
+        return self.cum[:, -1, -1]
+
+    # counts per label: (Emph, fSAD, normal)
+    def count_prm(self, emphy_threshold, fSAD_threshold):
+        e, f = self._bin(emphy_threshold), self._bin(fSAD_threshold)
+        emph = self.cum[:, e, -1]
+        fsad = self.cum[:, -1, f] - self.cum[:, e, f]
+        return emph, fsad, self.voxels - emph - fsad
+
+    # Lobe0-Lobe4 & total ratios: (Emph, fSAD, normal)
+    def fraction_prm(self, emphy_threshold, fSAD_threshold):
+        return tuple(lobar_fraction(c, self.voxels)
+                     for c in self.count_prm(emphy_threshold, fSAD_threshold))
+
+    # sparse (index, count) for the cache file
+    def sparse(self):
+        index = np.flatnonzero(self.hist)
+        return index, self.hist.ravel()[index]
+
+    @classmethod
+    def from_sparse(cls, index, count, hu_range):
+        n = hu_range[1] - hu_range[0] + 1
+        hist = np.zeros(NLABEL*n*n, dtype=np.int64)
+        hist[index] = count
+        return cls(hist.reshape(NLABEL, n, n), hu_range)
+
+
+# joint histogram bin of one chunk: HU-lower, clipped to [0, upper-lower]
+def _joint_bin(img, hu_range):
+    img = img.ravel(order='F')
+    if np.issubdtype(img.dtype, np.floating):
+        img = np.floor(img)
+    b = np.clip(img, hu_range[0], hu_range[1]).astype(np.intp)
+    b -= hu_range[0]
+    return b
+
+
+# ##############################################################################
+# Histogram cache, ex) PMSN03001_EX0-TO-PMSN03001_IN0-SSTVD_lobar_hist.npz
+# ##############################################################################
+#  - IN: IN image in IN lobe mask
+#  - EX: EX image in EX lobe mask
+#  - warped: warped EX image in IN lobe mask
+#  - joint: JointHistogram of IN & warped EX images in IN lobe mask
+# Each histogram is stored with the stamp of its image and lobe mask, and is
+# dropped on load if either of them changed.
+# get_QCT.py builds them on the lung ROI (lobe_bbox), so label 0
+# (background) only counts the voxels in the ROI.
+# ##############################################################################
+
+# sources: {name: [img_path, ..., lobe_path]} -> {name: histogram}, fresh only
+def load_hist_cache(path, sources):
+    cache = qct_cache.load_npz(path)
+    hists = {}
+    for name, paths in sources.items():
+        if f'stamp_{name}' not in cache or not qct_cache.is_fresh(cache[f'stamp_{name}'], paths):
+            continue
+        if name=='joint':
+            hists[name] = JointHistogram.from_sparse(
+                cache['index_joint'], cache['hist_joint'], cache['range_joint'])
+        else:
+            hists[name] = LobarHistogram(cache[f'hist_{name}'], int(cache[f'hu_min_{name}']))
+    return hists
+
+
+# hists: {name: LobarHistogram or JointHistogram}
+# sources: {name: [img_path, ..., lobe_path]}
+# Histograms already in the cache file are kept.
+def save_hist_cache(path, hists, sources):
+    cache = qct_cache.load_npz(path)
+    for name, hist in hists.items():
+        if isinstance(hist, JointHistogram):
+            index, count = hist.sparse()
+            cache['index_joint'] = index.astype(np.int64)
+            cache['hist_joint'] = count.astype(np.int32)
+            cache['range_joint'] = np.array(hist.hu_range)
+        else:
+            h, hu_min = hist.trimmed()
+            cache[f'hist_{name}'] = h.astype(np.int32)
+            cache[f'hu_min_{name}'] = np.int64(hu_min)
+        cache[f'stamp_{name}'] = np.str_(qct_cache.stamp(sources[name]))
+    qct_cache.save_npz(path, **cache)
@@ -0,0 +1,152 @@
+# ##############################################################################
+# qct_cache.py
+# Sidecar caches (.npz) keyed on the size & mtime of their source files
+# ##############################################################################
+# 20221018, In Kyu Lee
+#  - stamp / is_fresh / save_npz / load_npz
+#  - Manifest: inputs, parameters and code version of each step16 output,
+#    such that reruns skip unchanged metrics.
+# ##############################################################################
+# A cache entry stores the stamp of its sources: [file name, size, mtime_ns].
+# The entry is stale, and has to be rebuilt, when any source changed.
+# ##############################################################################
+import os
+import json
+import hashlib
+import threading
+import zipfile
+import numpy as np
+
+
+def file_stamp(path):
+    st = os.stat(path)
+    return [os.path.basename(path), st.st_size, st.st_mtime_ns]
+
+
+def stamp(paths):
+    return json.dumps([file_stamp(p) for p in paths])
+
+
+def is_fresh(stored, paths):
+    try:
+        return json.loads(str(stored)) == json.loads(stamp(paths))
+    except OSError:
+        return False
+
+
+# write to a temporary file first, such that readers never see a partial file
+def save_npz(path, **arrays):
+    tmp = f'{path}.{os.getpid()}.tmp.npz'
+    np.savez_compressed(tmp, **arrays)
+    os.replace(tmp, path)
+
+
+def load_npz(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with np.load(path) as f:
+            return {k: f[k] for k in f.files}
+    except (OSError, ValueError, zipfile.BadZipFile):
+        return {}
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def save_json(path, obj):
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=1)
+    os.replace(tmp, path)
+
+
+def load_json(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+# Manifest (json) of outputs: {name: {inputs, params, version, outputs}}
+#  - inputs: [file name, size, mtime_ns(, sha1)] of each input file
+#  - params: thresholds, ...
+#  - version: code version that wrote the outputs
+# An output is current if its entry is the same and its output files exist.
+# With hash=True the sha1 of the inputs is recorded as well, and an input
+# with a new mtime (ex. copied) but the same size & sha1 is unchanged.
+# The sha1 of a file is computed once per stamp for the lifetime of the
+# Manifest (inputs like the IN image are shared by several metrics), and
+# not again for a stamp already recorded with its sha1.
+class Manifest:
+    def __init__(self, path, version, hash=False):
+        self.path = path
+        self.version = version
+        self.hash = hash
+        self.entries = load_json(path)
+        # update() may be called by writer threads
+        self.lock = threading.Lock()
+        # {(path, stamp): sha1}, with the sha1 recorded for the same stamps
+        self.hashes = {}
+        folder = os.path.dirname(os.path.abspath(path))
+        for entry in self.entries.values():
+            for stamp in entry.get('inputs', []):
+                if len(stamp) == 4:
+                    self.hashes[(os.path.join(folder, stamp[0]), tuple(stamp[:3]))] = stamp[3]
+
+    def file_hash(self, path, stamp):
+        key = (os.path.abspath(path), tuple(stamp))
+        if key not in self.hashes:
+            self.hashes[key] = file_hash(path)
+        return self.hashes[key]
+
+    def _same_file(self, stored, path):
+        if not os.path.exists(path):
+            return False
+        current = file_stamp(path)
+        if stored[:3] == current:
+            return True
+        return (self.hash and len(stored) == 4 and stored[:2] == current[:2]
+                and stored[3] == self.file_hash(path, current))
+
+    def is_current(self, name, inputs, params, outputs):
+        entry = self.entries.get(name)
+        if entry is None:
+            return False
+        if entry.get('version') != self.version:
+            return False
+        if entry.get('params') != json.loads(json.dumps(params)):
+            return False
+        if entry.get('outputs') != [os.path.basename(p) for p in outputs]:
+            return False
+        if not all(os.path.exists(p) for p in outputs):
+            return False
+        stored = entry.get('inputs', [])
+        if len(stored) != len(inputs):
+            return False
+        if not all(self._same_file(s, p) for s, p in zip(stored, inputs)):
+            return False
+        # stored stamps have the sha1 as 4th field with hash=True
+        if [s[:3] for s in stored] != [file_stamp(p) for p in inputs]:
+            # same content with a new mtime: record the new stamps
+            self.update(name, inputs, params, outputs)
+        return True
+
+    def update(self, name, inputs, params, outputs):
+        stamps = [file_stamp(p) for p in inputs]
+        if self.hash:
+            stamps = [s + [self.file_hash(p, s)] for s, p in zip(stamps, inputs)]
+        with self.lock:
+            self.entries[name] = {'inputs': stamps,
+                                  'params': json.loads(json.dumps(params)),
+                                  'version': self.version,
+                                  'outputs': [os.path.basename(p) for p in outputs]}
+            save_json(self.path, self.entries)
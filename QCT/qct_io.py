@@ -0,0 +1,619 @@
+# ##############################################################################
+# qct_io.py
+# Image loading for the QCT scripts
+# ##############################################################################
+# 20221018, In Kyu Lee
+#  - load: uncompressed Analyze/NIfTI pairs (.hdr/.img) and MetaImage
+#    (.mhd/.raw) are returned as read-only np.memmap views, such that the
+#    OS page cache is shared by processes and only the pages in use are read.
+#    Everything else (.img.gz, scaled or reoriented images, ...) is loaded
+#    with medpy.io.load.
+#  - open_volume / SlabWriter: bounded memory z-slab streaming.
+#    .img.gz is decompressed once to a temporary raw file and memory-mapped,
+#    outputs are written to .hdr/.img slab by slab.
+#  - .img.gz is decompressed directly into the array with a multi-threaded
+#    backend if available: python-isal (threaded) or pigz.
+#  - Prefetcher: the next volume is loaded in a background thread while the
+#    current one is processed.
+#  - AsyncWriter: outputs are written by background threads.
+#  - .lbl.npz: compact label images (bit planes per slice), unpack_labels
+#    exports them back to Analyze.
+#  - load_strided: img[::s, ::s, ::s] without the whole image in memory
+#    (get_QCT.py --triage). Uncompressed images read only the sampled
+#    z-slices; .img.gz is still decompressed to the end (gzip has no random
+#    access), but only the sampled slices are kept.
+# ##############################################################################
+# Arrays are in medpy order (x,y,z) or (x,y,z,c), and the header can be
+# passed to medpy.io.save as usual.
+# ##############################################################################
+import os
+import gzip
+import shutil
+import subprocess
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from medpy.io import load as medpy_load, save
+from medpy.io.header import Header
+import qct_cache
+import SimpleITK as sitk
+sitk.ProcessObject_SetGlobalWarningDisplay(False)
+try:
+    from isal import igzip_threaded
+except ImportError:
+    igzip_threaded = None
+
+# threads of the gzip backend
+GZ_THREADS = min(4, os.cpu_count() or 1)
+
+# Analyze datatype -> numpy dtype
+ANALYZE_DTYPE = {2: 'u1', 4: 'i2', 8: 'i4', 16: 'f4', 64: 'f8',
+                 256: 'i1', 512: 'u2', 768: 'u4', 1024: 'i8', 1280: 'u8'}
+# MetaImage ElementType -> numpy dtype
+MET_DTYPE = {'MET_UCHAR': 'u1', 'MET_CHAR': 'i1', 'MET_USHORT': 'u2',
+             'MET_SHORT': 'i2', 'MET_UINT': 'u4', 'MET_INT': 'i4',
+             'MET_ULONG_LONG': 'u8', 'MET_LONG_LONG': 'i8',
+             'MET_FLOAT': 'f4', 'MET_DOUBLE': 'f8'}
+
+
+def load(path, mmap=True):
+    if mmap:
+        raw = raw_info(path)
+        if raw is not None:
+            return load_raw(path, *raw)
+    if path.endswith('.img.gz') and gz_backend() is not None:
+        info = _gz_info(path)
+        if info is not None:
+            return load_gz(path, *info)
+    return medpy_load(path)
+
+
+# Header only (no pixel data), same as the header of medpy.io.load
+def load_header(path):
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    ndim = reader.GetDimension()
+    # 1 voxel image to carry the meta data
+    meta = sitk.Image([1]*ndim, sitk.sitkUInt8)
+    meta.SetSpacing(reader.GetSpacing())
+    meta.SetOrigin(reader.GetOrigin())
+    meta.SetDirection(reader.GetDirection())
+    for k in reader.GetMetaDataKeys():
+        meta.SetMetaData(k, reader.GetMetaData(k))
+    return Header(sitkimage=meta), reader
+
+
+# (data file, byte offset, dtype, shape (z,y,x,c)) of an uncompressed image,
+# None if the pixel data can not be used as it is.
+def raw_info(path):
+    if path.endswith('.img') or path.endswith('.hdr'):
+        return _analyze_info(path[:-4] + '.hdr', path[:-4] + '.img')
+    if path.endswith('.mhd'):
+        return _mhd_info(path)
+    return None
+
+
+def load_raw(path, data_path, offset, dtype, shape):
+    hdr, reader = load_header(path)
+    if tuple(reader.GetSize()) != tuple(shape[:3][::-1]):
+        return medpy_load(path)
+    img = np.memmap(data_path, dtype=dtype, mode='r', offset=offset, shape=shape)
+    # (z,y,x,c) -> (x,y,z,c)
+    if len(shape)==4:
+        return img.transpose(2, 1, 0, 3), hdr
+    return img.T, hdr
+
+
+def _analyze_info(hdr_path, img_path):
+    if not (os.path.exists(hdr_path) and os.path.exists(img_path)):
+        return None
+    with open(hdr_path, 'rb') as f:
+        h = f.read(348)
+    info = _analyze_header(h)
+    if info is None:
+        return None
+    offset, dtype, shape = info
+    if os.path.getsize(img_path) < offset + np.prod(shape)*dtype.itemsize:
+        return None
+    return img_path, offset, dtype, shape
+
+
+def _endian(h):
+    for endian in '<>':
+        if np.frombuffer(h, f'{endian}i4', 1, 0)[0]==348:
+            return endian
+    return None
+
+
+# (vox_offset, dtype, shape (z,y,x)) of a 3D Analyze/NIfTI-pair header
+def _analyze_header(h):
+    if len(h) < 348:
+        return None
+    endian = _endian(h)
+    if endian is None:
+        return None
+    dim = np.frombuffer(h, f'{endian}i2', 8, 40)
+    datatype = int(np.frombuffer(h, f'{endian}i2', 1, 70)[0])
+    vox_offset = float(np.frombuffer(h, f'{endian}f4', 1, 108)[0])
+    magic = h[344:347]
+    if magic==b'ni1':
+        # NIfTI pair: data scaling is not supported
+        scl_slope = float(np.frombuffer(h, f'{endian}f4', 1, 112)[0])
+        if scl_slope not in (0, 1):
+            return None
+    elif magic==b'n+1':
+        return None
+    elif h[252]!=0:
+        # Analyze 7.5: only the default orientation
+        return None
+    if dim[0]!=3 or datatype not in ANALYZE_DTYPE:
+        return None
+    shape = (int(dim[3]), int(dim[2]), int(dim[1]))
+    dtype = np.dtype(endian + ANALYZE_DTYPE[datatype])
+    return int(vox_offset), dtype, shape
+
+
+def _mhd_info(mhd_path):
+    info = {}
+    with open(mhd_path, 'r') as f:
+        for line in f:
+            if '=' in line:
+                k, v = line.split('=', 1)
+                info[k.strip()] = v.strip()
+    if info.get('CompressedData', 'False').lower()=='true':
+        return None
+    if info.get('ElementType') not in MET_DTYPE or info.get('NDims')!='3':
+        return None
+    data_file = info.get('ElementDataFile', '')
+    if data_file in ('', 'LOCAL') or data_file.startswith('LIST') or '%' in data_file:
+        return None
+    data_path = os.path.join(os.path.dirname(mhd_path), data_file)
+    if not os.path.exists(data_path):
+        return None
+    msb = info.get('BinaryDataByteOrderMSB', info.get('ElementByteOrderMSB', 'False'))
+    dtype = np.dtype(('>' if msb.lower()=='true' else '<') + MET_DTYPE[info['ElementType']])
+    x, y, z = (int(d) for d in info['DimSize'].split())
+    c = int(info.get('ElementNumberOfChannels', 1))
+    shape = (z, y, x, c) if c > 1 else (z, y, x)
+    nbytes = int(np.prod(shape))*dtype.itemsize
+    offset = int(info.get('HeaderSize', 0))
+    if offset==-1:
+        # data at the end of the file
+        offset = os.path.getsize(data_path) - nbytes
+    if offset < 0 or os.path.getsize(data_path) < offset + nbytes:
+        return None
+    return data_path, offset, dtype, shape
+
+
+# ##############################################################################
+# z-slab streaming
+# ##############################################################################
+
+# Volume for slab access without loading it: memmap if possible,
+# .img.gz is decompressed to tmpdir first (bounded memory).
+def open_volume(path, tmpdir):
+    raw = raw_info(path)
+    if raw is not None:
+        return load_raw(path, *raw)
+    if path.endswith('.img.gz'):
+        info = _gz_info(path)
+        if info is not None:
+            offset, dtype, shape = info
+            raw_path = os.path.join(tmpdir, os.path.basename(path)[:-3])
+            with open(raw_path, 'wb') as fout:
+                for block in gz_blocks(path):
+                    fout.write(block)
+            if os.path.getsize(raw_path) >= offset + np.prod(shape)*dtype.itemsize:
+                return load_raw(path, raw_path, offset, dtype, shape)
+    return medpy_load(path)
+
+
+# .img.gz decompressed block by block into the array
+def load_gz(path, offset, dtype, shape):
+    hdr, reader = load_header(path)
+    if tuple(reader.GetSize()) != tuple(shape[::-1]):
+        return medpy_load(path)
+    buf = np.empty(offset + int(np.prod(shape))*dtype.itemsize, dtype=np.uint8)
+    n = 0
+    blocks = gz_blocks(path)
+    for block in blocks:
+        k = min(len(block), len(buf)-n)
+        buf[n:n+k] = np.frombuffer(block, dtype=np.uint8, count=k)
+        n += k
+        if n == len(buf):
+            break
+    blocks.close()
+    if n < len(buf):
+        return medpy_load(path)
+    img = buf[offset:].view(dtype).reshape(shape)
+    # (z,y,x) -> (x,y,z)
+    return img.T, hdr
+
+
+# img[::step, ::step, ::step] of an image
+def load_strided(path, step):
+    raw = raw_info(path)
+    if raw is not None:
+        img, hdr = load_raw(path, *raw)
+        return np.array(img[::step, ::step, ::step]), hdr
+    if path.endswith('.img.gz'):
+        info = _gz_info(path)
+        if info is not None:
+            return load_gz_strided(path, *info, step)
+    img, hdr = medpy_load(path)
+    return np.array(img[::step, ::step, ::step]), hdr
+
+
+# .img.gz decompressed block by block, keeping every step-th z-slice
+def load_gz_strided(path, offset, dtype, shape, step):
+    hdr, reader = load_header(path)
+    if tuple(reader.GetSize()) != tuple(shape[::-1]):
+        img, hdr = medpy_load(path)
+        return np.array(img[::step, ::step, ::step]), hdr
+    nz, ny, nx = shape
+    size = ny*nx*dtype.itemsize
+    out = np.empty((len(range(0, nz, step)), len(range(0, ny, step)), len(range(0, nx, step))),
+                   dtype=dtype)
+    buf = b''
+    skip = offset
+    k = 0
+    blocks = gz_blocks(path)
+    for block in blocks:
+        if skip:
+            n = min(skip, len(block))
+            block = block[n:]
+            skip -= n
+        buf += block
+        i = 0
+        while len(buf)-i >= size and k < nz:
+            if k % step == 0:
+                out[k//step] = np.frombuffer(buf, dtype, ny*nx, i).reshape(ny, nx)[::step, ::step]
+            i += size
+            k += 1
+        buf = buf[i:]
+        if k == nz:
+            break
+    blocks.close()
+    if k < nz:
+        img, hdr = medpy_load(path)
+        return np.array(img[::step, ::step, ::step]), hdr
+    # (z,y,x) -> (x,y,z)
+    return out.T, hdr
+
+
+# multi-threaded gzip backend: 'isal' (python-isal), 'pigz' or None.
+# Without one, SimpleITK (medpy.io.load) decompresses faster than zlib.
+def gz_backend():
+    if GZ_THREADS < 2:
+        return None
+    if igzip_threaded is not None:
+        return 'isal'
+    if shutil.which('pigz') is not None:
+        return 'pigz'
+    return None
+
+
+# decompressed blocks of a .gz file
+def gz_blocks(path, size=1 << 24):
+    backend = gz_backend()
+    if backend == 'isal':
+        with igzip_threaded.open(path, 'rb', threads=GZ_THREADS) as f:
+            yield from iter(lambda: f.read(size), b'')
+        return
+    if backend == 'pigz':
+        with _Pipe(['pigz', '-dc', '-p', str(GZ_THREADS), path]) as f:
+            yield from iter(lambda: f.read(size), b'')
+        return
+    # zlib on large blocks is faster than gzip.open
+    dec = zlib.decompressobj(31)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(size), b''):
+            while block:
+                yield dec.decompress(block)
+                if dec.eof:
+                    # next gzip member
+                    block = dec.unused_data
+                    dec = zlib.decompressobj(31)
+                else:
+                    block = b''
+    yield dec.flush()
+
+
+# stdout of a command as a file
+class _Pipe:
+    def __init__(self, cmd):
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1 << 24)
+
+    def read(self, n=-1):
+        return self.proc.stdout.read(n)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            # read to the end, such that the command exits normally
+            while self.proc.stdout.read(1 << 20):
+                pass
+        self.proc.stdout.close()
+        if self.proc.wait() != 0 and exc[0] is None:
+            raise OSError(f'{self.proc.args[0]} failed: {self.proc.args[-1]}')
+
+
+# header of X.img.gz: X.hdr or X.hdr.gz
+def _gz_info(path):
+    for hdr_path, opener in ((path[:-7] + '.hdr', open), (path[:-7] + '.hdr.gz', gzip.open)):
+        if os.path.exists(hdr_path):
+            with opener(hdr_path, 'rb') as f:
+                return _analyze_header(f.read(348))
+    return None
+
+
+# .hdr bytes medpy.io.save writes for an image of shape & dtype:
+# header of a one slice image, then dim[3] = z
+def analyze_header(shape, hdr, dtype):
+    x, y, z = shape
+    with tempfile.TemporaryDirectory() as tmpdir:
+        save(np.zeros((x, y, 1), dtype=dtype), os.path.join(tmpdir, 'h.img'), hdr=hdr)
+        with open(os.path.join(tmpdir, 'h.hdr'), 'rb') as f:
+            h = bytearray(f.read())
+    h[46:48] = np.array(z, dtype=f'{_endian(bytes(h))}i2').tobytes()
+    return bytes(h)
+
+
+# Output .hdr/.img written slab by slab: writer[:,:,z0:z1] = slab
+# The header is the one medpy.io.save writes for the full image.
+# The file is created on the first write, with the dtype of that slab
+# (or dtype, if given).
+# With roi (see lobar.lobe_bbox), slabs are of the cropped image full[roi]
+# and the voxels outside roi are fill.
+class SlabWriter:
+    def __init__(self, path, shape, hdr, dtype=None, roi=None, fill=0):
+        self.path = path
+        self.shape = tuple(shape)
+        self.hdr = hdr
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.roi = roi
+        self.fill = fill
+        self.f = None
+
+    def _create(self, dtype):
+        self.dtype = np.dtype(dtype)
+        x, y, z = self.shape
+        self._open()
+        if self.roi is not None and self.fill != 0:
+            # fill the slices out of roi
+            z_roi = range(z)[self.roi[2]]
+            for z0, z1 in ((0, z_roi.start), (z_roi.stop, z)):
+                if z1 > z0:
+                    self._write(z0, np.full((x, y, z1-z0), self.fill, dtype=self.dtype))
+
+    def _open(self):
+        x, y, z = self.shape
+        with open(self.path[:-4] + '.hdr', 'wb') as f:
+            f.write(analyze_header(self.shape, self.hdr, self.dtype))
+        self.f = open(self.path, 'w+b')
+        self.f.truncate(x*y*z*self.dtype.itemsize)
+
+    def __setitem__(self, sl, value):
+        value = np.asarray(value)
+        if self.f is None:
+            self._create(self.dtype or value.dtype)
+        z = sl[-1]
+        if len(sl)!=3 or sl[0]!=slice(None) or sl[1]!=slice(None) or z.step not in (None, 1):
+            raise IndexError('SlabWriter only supports [:, :, z0:z1]')
+        z0 = z.start or 0
+        if self.roi is not None:
+            z0 += range(self.shape[2])[self.roi[2]].start
+            x, y, _ = self.shape
+            full = np.full((x, y, value.shape[2]), self.fill, dtype=self.dtype)
+            full[self.roi[:2]] = value
+            value = full
+        self._write(z0, value)
+
+    def _write(self, z0, value):
+        x, y, _ = self.shape
+        self.f.seek(z0 * x * y * self.dtype.itemsize)
+        # (x,y,z) -> (z,y,x)
+        self.f.write(np.ascontiguousarray(value.astype(self.dtype, copy=False).T).tobytes())
+
+    def close(self):
+        if self.f is None:
+            self._create(self.dtype or 'float32')
+        self.f.close()
+
+
+# ##############################################################################
+# Compact label images, ex) _AirT.lbl.npz
+# ##############################################################################
+# Label images (values < 2**nbits, ex. AirT & HAA: 1 bit, Emph_fSAD: 2 bits)
+# are stored as bit planes of each z-slice (np.packbits), compressed, with the
+# .hdr bytes of the Analyze image. unpack_labels exports the very same
+# .hdr/.img as medpy.io.save.
+#  - packed: (z, nbits, ceil(x*y/8)) uint8, slice in (y,x) order as in .img
+#  - shape: (x, y, z)
+#  - hdr: Analyze header bytes
+LABEL_EXT = '.lbl.npz'
+
+
+def pack_slices(img, nbits):
+    x, y, z = img.shape
+    planes = np.ascontiguousarray(img.T).reshape(z, 1, x*y)
+    bits = (planes >> np.arange(nbits, dtype=np.uint8)[None, :, None]) & 1
+    return np.packbits(bits, axis=-1)
+
+
+def unpack_slices(packed, shape):
+    x, y, z = shape
+    bits = np.unpackbits(packed, axis=-1, count=x*y)
+    img = np.zeros((packed.shape[0], x*y), dtype=np.uint8)
+    for b in range(packed.shape[1]):
+        img |= bits[:, b] << b
+    # (z,y,x) -> (x,y,z)
+    return img.reshape(-1, y, x).T
+
+
+# Label image written slab by slab (as SlabWriter) to .lbl.npz
+class PackedWriter(SlabWriter):
+    def __init__(self, path, shape, hdr, nbits=1, roi=None, fill=0):
+        super().__init__(path, shape, hdr, 'uint8', roi, fill)
+        self.nbits = nbits
+
+    def _open(self):
+        x, y, z = self.shape
+        self.header = analyze_header(self.shape, self.hdr, self.dtype)
+        self.packed = np.zeros((z, self.nbits, (x*y+7)//8), dtype=np.uint8)
+        self.f = True
+
+    def _write(self, z0, value):
+        value = value.astype(np.uint8, copy=False)
+        if value.max(initial=0) >= 1 << self.nbits:
+            raise ValueError(f'{self.path}: label >= 2**{self.nbits}')
+        self.packed[z0:z0+value.shape[2]] = pack_slices(value, self.nbits)
+
+    def close(self):
+        if self.f is None:
+            self._create(self.dtype or 'uint8')
+        qct_cache.save_npz(self.path, packed=self.packed, shape=np.array(self.shape),
+                           hdr=np.frombuffer(self.header, dtype=np.uint8))
+
+
+def save_packed(img, path, hdr, nbits=None):
+    if nbits is None:
+        nbits = max(1, int(img.max(initial=0)).bit_length())
+    writer = PackedWriter(path, img.shape, hdr, nbits)
+    writer[:, :, 0:img.shape[2]] = img
+    writer.close()
+
+
+# (image, Analyze header bytes) of a .lbl.npz
+def _read_packed(path):
+    with np.load(path) as f:
+        return unpack_slices(f['packed'], tuple(f['shape'])), f['hdr'].tobytes()
+
+
+def load_packed(path):
+    img, header = _read_packed(path)
+    return img, header_from_bytes(header)
+
+
+# medpy header of Analyze .hdr bytes
+def header_from_bytes(header):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with open(os.path.join(tmpdir, 'h.hdr'), 'wb') as f:
+            f.write(header)
+        open(os.path.join(tmpdir, 'h.img'), 'wb').close()
+        hdr, _ = load_header(os.path.join(tmpdir, 'h.hdr'))
+    return hdr
+
+
+# X.lbl.npz -> X.hdr & X.img (same bytes as medpy.io.save)
+def unpack_labels(path, img_path=None):
+    img_path = img_path or path[:-len(LABEL_EXT)] + '.img'
+    img, header = _read_packed(path)
+    with open(img_path[:-4] + '.hdr', 'wb') as f:
+        f.write(header)
+    with open(img_path, 'wb') as f:
+        f.write(np.ascontiguousarray(img.T).tobytes())
+    return img_path
+
+
+# ##############################################################################
+# Read-ahead
+# ##############################################################################
+# Loads paths (in the order they are used) one ahead in a background thread:
+#   with Prefetcher([P.EX, P.EX_lobe, ...], load) as loader:
+#       EX_img, EX_header = loader.get(P.EX)  # P.EX_lobe is loaded meanwhile
+# A path out of this order is loaded directly.
+class Prefetcher:
+    def __init__(self, paths, load=load):
+        self.paths = list(paths)
+        self.load = load
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.next = 0
+        self.pending = None
+        self._submit()
+
+    def _submit(self):
+        self.pending = None
+        if self.next < len(self.paths):
+            path = self.paths[self.next]
+            self.pending = (path, self.pool.submit(self.load, path))
+            self.next += 1
+
+    def get(self, path):
+        if self.pending is not None and self.pending[0] == path:
+            result = self.pending[1].result()
+            self._submit()
+            return result
+        return self.load(path)
+
+    def close(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        self.pending = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# ##############################################################################
+# Background writer
+# ##############################################################################
+# Output files written by a thread pool:
+#   with AsyncWriter() as writer:
+#       writer.submit(save, img, img_path, hdr=hdr)
+# At most maxsize writes are pending (submit blocks until one is done), such
+# that the images waiting to be written stay bounded. An error of a write is
+# raised by the next submit or by flush, which waits for every pending write.
+class AsyncWriter:
+    def __init__(self, workers=2, maxsize=2):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(maxsize)
+        self.futures = []
+
+    def submit(self, fn, *args, **kwargs):
+        self._raise_done()
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(fn, *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+        self.futures.append(future)
+        return future
+
+    # raise the first error of the finished writes
+    def _raise_done(self):
+        for i, future in enumerate(self.futures):
+            if future.done() and future.exception() is not None:
+                del self.futures[i]
+                raise future.exception()
+        self.futures = [f for f in self.futures if not f.done()]
+
+    def flush(self):
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            # keep the first error, but let the pending writes finish
+            self.pool.shutdown(wait=True)
@@ -0,0 +1,262 @@
+# ##############################################################################
+# qct_kernels.py
+# Per-slab kernels of the step16 metrics: NumPy, or Numba if installed
+# ##############################################################################
+# 20221018, In Kyu Lee
+#  - Classification (AirT, Emph_fSAD, HAA) and per-lobe accumulation
+#    (RRAVC, S*) of one slab. The NumPy kernels are the reference: a few
+#    ufunc passes and np.bincount (lobar.py).
+#    With Numba (pip install numba), the same kernels run as one compiled
+#    pass over the voxels, parallel over z-blocks of the slab.
+#  - BACKEND: 'numba' if installed, otherwise 'numpy'.
+#    Set QCT_BACKEND=numpy to use the reference kernels (QCT_BACKEND=numba
+#    without numba installed, or another value, is an error).
+#  - set_threads: threads of the slab loops (lobar.map_slabs) with the
+#    NumPy kernels, or of the Numba kernels, which are parallel themselves
+#    and then run one slab at a time.
+# ##############################################################################
+# Label images and counts are identical with both backends.
+# Float images (RRAVC, S*) are identical up to the last bit of float32 hypot
+# (S*), and lobar sums may differ in rounding (order of the summation).
+# Slabs are (x,y,z) (or (x,y,z,3) for S*) arrays, or 1D voxel arrays
+# (qct_voxels.py).
+# ##############################################################################
+import os
+import numpy as np
+import lobar
+try:
+    import numba
+except ImportError:
+    numba = None
+
+BACKENDS = ('numpy', 'numba')
+BACKEND = os.environ.get('QCT_BACKEND') or ('numba' if numba is not None else 'numpy')
+if BACKEND not in BACKENDS:
+    raise ValueError(f'unknown QCT_BACKEND={BACKEND}, one of {BACKENDS}')
+if BACKEND == 'numba' and numba is None:
+    raise ImportError('QCT_BACKEND=numba, but numba is not installed (pip install numba)')
+# z-blocks per slab of the numba kernels (fixed, such that the lobar sums do
+# not depend on the number of threads)
+NBLOCK = 64
+
+# lobe mask value (0-255) -> lobe index, see lobar.lobe_index
+_LUT = lobar.lobe_index(np.arange(256, dtype=np.uint8))
+# classification of _nb_label
+_BELOW, _BETWEEN, _EMPH_FSAD, _EMPH = 0, 1, 2, 3
+
+
+# ##############################################################################
+# NumPy (reference)
+# ##############################################################################
+
+# AirT: 1 if img < threshold in lobe, counts[label, class]
+def _np_below(img, lobe, threshold):
+    idx = lobar.lobe_index(lobe)
+    label = (img<threshold) & (idx!=0)
+    return label, lobar.bincount_lobes(idx, label, 2)
+
+
+# HAA: 1 if lower <= img <= upper in lobe
+def _np_between(img, lobe, lower, upper):
+    idx = lobar.lobe_index(lobe)
+    label = (lower<=img) & (img<=upper) & (idx!=0)
+    return label, lobar.bincount_lobes(idx, label, 2)
+
+
+# Emph_fSAD: 2 if img < emphy_threshold, 1 if warp < fSAD_threshold (fSAD),
+# warp None: Emphysema only
+def _np_emph_fsad(img, lobe, warp, emphy_threshold, fSAD_threshold):
+    idx = lobar.lobe_index(lobe)
+    emphy = img<emphy_threshold
+    label = emphy.astype(np.uint8)
+    label *= 2
+    if warp is not None:
+        label += (~emphy) & (warp<fSAD_threshold)
+    label[idx==0] = 0
+    return label, lobar.bincount_lobes(idx, label, 3)
+
+
+# RRAVC in out (float32), moments[0]: RRAVC, with voxel_volume also
+# moments[1]: airDiff, moments[2]: tissue fraction 1 - fixed/voxel_volume
+def _np_rravc(airdiff, fixed, lobe, RRAVC_den, voxel_volume, out):
+    moments = np.zeros((3, lobar.NLABEL, 3))
+    idx = lobar.lobe_index(lobe)
+    np.divide(airdiff, fixed, out=out)
+    out[np.isnan(out)] = 0
+    out /= RRAVC_den
+    # Set background to be -100
+    out[idx==0] = -100
+    moments[0] = lobar.moments_lobes(idx, out)
+    if voxel_volume is not None:
+        moments[1] = lobar.moments_lobes(idx, airdiff)
+        moments[2] = lobar.moments_lobes(idx, 1 - fixed/np.float64(voxel_volume))
+    return moments
+
+
+# S*: |disp| / V_norm in out (float32)
+def _np_s_norm(disp, lobe, V_norm, out):
+    np.hypot(disp[...,0], disp[...,1], out=out)
+    np.hypot(out, disp[...,2], out=out)
+    out /= V_norm
+    return lobar.moments_lobes(lobar.lobe_index(lobe), out)
+
+
+# ##############################################################################
+# Numba
+# ##############################################################################
+# One pass over the voxels (x fastest, as the medpy arrays are stored),
+# parallel over NBLOCK z-blocks with the counts / moments of each block
+# summed at the end.
+if numba is not None:
+    @numba.njit(inline='always')
+    def _nb_idx(v):
+        v = np.int64(v)
+        if v < 0 or v > 255:
+            return lobar.OTHER
+        return _LUT[v]
+
+    @numba.njit(parallel=True, cache=True)
+    def _nb_label(img, lobe, warp, kind, t0, t1, label, nclass):
+        nx, ny, nz = img.shape
+        nb = min(nz, NBLOCK)
+        part = np.zeros((nb, lobar.NLABEL, nclass), dtype=np.int64)
+        for b in numba.prange(nb):
+            for k in range(b*nz//nb, (b+1)*nz//nb):
+                for j in range(ny):
+                    for i in range(nx):
+                        idx = _nb_idx(lobe[i, j, k])
+                        c = 0
+                        if idx != 0:
+                            v = img[i, j, k]
+                            if kind == _BELOW:
+                                c = 1 if v < t0 else 0
+                            elif kind == _BETWEEN:
+                                c = 1 if t0 <= v and v <= t1 else 0
+                            elif v < t0:
+                                c = 2
+                            elif kind == _EMPH_FSAD and warp[i, j, k] < t1:
+                                c = 1
+                        label[i, j, k] = c
+                        part[b, idx, c] += 1
+        return part.sum(axis=0)
+
+    @numba.njit(parallel=True, cache=True, error_model='numpy')
+    def _nb_rravc(airdiff, fixed, lobe, den, voxel_volume, out):
+        nx, ny, nz = airdiff.shape
+        nb = min(nz, NBLOCK)
+        part = np.zeros((nb, 3, lobar.NLABEL, 3))
+        for b in numba.prange(nb):
+            for k in range(b*nz//nb, (b+1)*nz//nb):
+                for j in range(ny):
+                    for i in range(nx):
+                        idx = _nb_idx(lobe[i, j, k])
+                        a = np.float64(airdiff[i, j, k])
+                        f = np.float64(fixed[i, j, k])
+                        # float32 division, as np.divide
+                        r = np.float32(a / f)
+                        if np.isnan(r):
+                            r = np.float32(0)
+                        r = np.float32(np.float64(r) / den)
+                        if idx == 0:
+                            r = np.float32(-100)
+                        out[i, j, k] = r
+                        part[b, 0, idx, 0] += 1
+                        part[b, 0, idx, 1] += r
+                        part[b, 0, idx, 2] += np.float64(r)*r
+                        if voxel_volume > 0:
+                            part[b, 1, idx, 0] += 1
+                            part[b, 1, idx, 1] += a
+                            part[b, 1, idx, 2] += a*a
+                            t = 1 - f/voxel_volume
+                            part[b, 2, idx, 0] += 1
+                            part[b, 2, idx, 1] += t
+                            part[b, 2, idx, 2] += t*t
+        return part.sum(axis=0)
+
+    @numba.njit(parallel=True, cache=True, error_model='numpy')
+    def _nb_s_norm(disp, lobe, V_norm, out):
+        nx, ny, nz = out.shape
+        nb = min(nz, NBLOCK)
+        part = np.zeros((nb, lobar.NLABEL, 3))
+        for b in numba.prange(nb):
+            for k in range(b*nz//nb, (b+1)*nz//nb):
+                for j in range(ny):
+                    for i in range(nx):
+                        idx = _nb_idx(lobe[i, j, k])
+                        s = np.hypot(np.hypot(disp[i, j, k, 0], disp[i, j, k, 1]), disp[i, j, k, 2])
+                        s = np.float32(np.float64(s) / V_norm)
+                        out[i, j, k] = s
+                        part[b, idx, 0] += 1
+                        part[b, idx, 1] += s
+                        part[b, idx, 2] += np.float64(s)*s
+        return part.sum(axis=0)
+
+
+# threads of the kernels: lobar.map_slabs (NumPy), numba (Numba)
+def set_threads(n=None):
+    lobar.set_threads(n)
+    if numba is not None:
+        numba.set_num_threads(min(lobar.THREADS, numba.config.NUMBA_NUM_THREADS))
+
+
+# threads of a slab loop over these kernels (lobar.map_slabs)
+def slab_threads():
+    return 1 if BACKEND == 'numba' else lobar.THREADS
+
+
+# 1D voxel arrays as (1,1,n)
+def _3d(a):
+    a = np.asarray(a)
+    return a.reshape(1, 1, -1) if a.ndim == 1 else a
+
+
+def _nb_classify(img, lobe, warp, kind, t0, t1, nclass):
+    img = np.asarray(img)
+    label = np.empty(img.shape, dtype=np.uint8, order='F')
+    counts = _nb_label(_3d(img), _3d(lobe), _3d(img if warp is None else warp), kind,
+                       np.float64(t0), np.float64(t1), _3d(label), nclass)
+    return label, counts
+
+
+# scalar divisor of a float32 image as np.divide would apply it:
+# float32 unless it is a float64 (numpy scalar)
+def _divisor(x):
+    if np.result_type(np.float32, x) == np.float32:
+        x = np.float32(x)
+    return np.float64(x)
+
+
+# ##############################################################################
+# Kernels of qct_metrics.py
+# ##############################################################################
+def below(img, lobe, threshold):
+    if BACKEND == 'numba':
+        return _nb_classify(img, lobe, None, _BELOW, threshold, 0, 2)
+    return _np_below(img, lobe, threshold)
+
+
+def between(img, lobe, lower, upper):
+    if BACKEND == 'numba':
+        return _nb_classify(img, lobe, None, _BETWEEN, lower, upper, 2)
+    return _np_between(img, lobe, lower, upper)
+
+
+def emph_fsad(img, lobe, warp, emphy_threshold, fSAD_threshold):
+    if BACKEND == 'numba':
+        kind = _EMPH if warp is None else _EMPH_FSAD
+        return _nb_classify(img, lobe, warp, kind, emphy_threshold,
+                            0 if fSAD_threshold is None else fSAD_threshold, 3)
+    return _np_emph_fsad(img, lobe, warp, emphy_threshold, fSAD_threshold)
+
+
+def rravc(airdiff, fixed, lobe, RRAVC_den, voxel_volume, out):
+    if BACKEND == 'numba':
+        return _nb_rravc(_3d(airdiff), _3d(fixed), _3d(lobe), _divisor(RRAVC_den),
+                         np.float64(voxel_volume or 0), _3d(out))
+    return _np_rravc(airdiff, fixed, lobe, RRAVC_den, voxel_volume, out)
+
+
+def s_norm(disp, lobe, V_norm, out):
+    if BACKEND == 'numba':
+        return _nb_s_norm(np.asarray(disp), np.asarray(lobe), _divisor(V_norm), out)
+    return _np_s_norm(disp, lobe, V_norm, out)
@@ -0,0 +1,319 @@
+# ##############################################################################
+# qct_metrics.py
+# Shared step16 metric computations (AirT, Emph, Emph_fSAD, HAA, RRAVC, S*)
+# ##############################################################################
+# 20221018, In Kyu Lee
+#  - Computations moved out of get_*.py such that get_QCT.py can run all
+#    metrics on volumes that are loaded only once.
+#  - Lobar statistics use lobar.py (one bincount pass per volume).
+#  - RRAVC & S* are computed in float32 with in-place ufuncs, directly in
+#    the output buffer (S* output is float32, it was float64).
+#  - Inputs can be cropped to the lung ROI (lobar.lobe_bbox), the outputs
+#    are then pasted back by the caller.
+#  - get_RRAVC_dat: _lobar_airDiff.txt & _lobar_fixed_tissue.txt from the
+#    RRAVC pass over airDiff & fixed_airVol.
+#  - Slab kernels are in qct_kernels.py (NumPy, or Numba if installed).
+#  - Slabs are computed by a thread pool (lobar.map_slabs, get_QCT.py
+#    --threads), lobar sums are merged in slab order.
+#  - get_density: lobar mean HU, percentiles (Perc15) and air & tissue
+#    volumes from the per-lobe HU histograms (lobar.LobarHistogram).
+#  - get_Jacob_ADI: Jacobian determinant & ADI of the displacement field
+#    (_lobar_jacob.txt, _lobar_ADI.txt), see get_Jacob_ADI.py.
+# ##############################################################################
+# Every function takes already-loaded volumes and returns (img, stat):
+#  - img: output image (uint8 label or float32), same shape as input
+#  - stat: pd.DataFrame, written as _lobar_*.txt with sep=' '
+# Volumes are processed in z-slabs of about chunk voxels (lobar.CHUNK).
+# The inputs only need slab indexing (arrays or memmaps), and the output
+# can be given as out (ex. qct_io.SlabWriter) for bounded memory streaming.
+# ##############################################################################
+import numpy as np
+import pandas as pd
+import warnings
+import lobar
+import qct_kernels
+from lobar import LOBE_NAMES, lobe_totals
+
+
+def ownpow(a, b):
+    if a > 0:
+        return a**b
+    if a < 0:
+        temp = abs(a)**b
+        return -1*temp
+
+
+# Airtrapping: EX < threshold in EX lobe mask
+def get_AirT(EX_img, EX_lobe_img, threshold=-856, out=None, chunk=None):
+    atrap_img = np.zeros((EX_img.shape),dtype='uint8') if out is None else out
+    counts = np.zeros((lobar.NLABEL, 2), dtype=np.int64)
+    # 1 if airtrapping, 0 if outside lobe
+    for sl, (trap, c) in lobar.map_slabs(
+            lambda sl: qct_kernels.below(EX_img[sl], EX_lobe_img[sl], threshold),
+            EX_img.shape, chunk, qct_kernels.slab_threads()):
+        atrap_img[sl] = trap
+        counts += c
+
+    EX_l = lobe_totals(counts.sum(axis=1))
+    atrap_l = lobe_totals(counts[:, 1])
+    atrap_stat = pd.DataFrame({'Lobes':LOBE_NAMES+['total'],
+                  'airtrapratio':np.float32([a/n for a,n in zip(atrap_l,EX_l)]),
+                  'voxels_trap':atrap_l,
+                  'Voxels':EX_l})
+    return atrap_img, atrap_stat
+
+
+# label & count Emphysema (2) and fSAD (1), 0 if outside lobe
+def _Emph_fSAD(IN_img, IN_lobe_img, warp_img, emphy_threshold, fSAD_threshold, out, chunk):
+    emphy_img = np.zeros((IN_img.shape),dtype='uint8') if out is None else out
+    counts = np.zeros((lobar.NLABEL, 3), dtype=np.int64)
+    def kernel(sl):
+        warp = None if warp_img is None else warp_img[sl]
+        return qct_kernels.emph_fsad(IN_img[sl], IN_lobe_img[sl], warp,
+                                     emphy_threshold, fSAD_threshold)
+    for sl, (label, c) in lobar.map_slabs(kernel, IN_img.shape, chunk, qct_kernels.slab_threads()):
+        emphy_img[sl] = label
+        counts += c
+    return emphy_img, counts
+
+
+# Emphysema: IN < emphy_threshold in IN lobe mask
+def get_Emph(IN_img, IN_lobe_img, emphy_threshold=-950, out=None, chunk=None):
+    emphy_img, counts = _Emph_fSAD(IN_img, IN_lobe_img, None, emphy_threshold, None, out, chunk)
+
+    IN_l = lobe_totals(counts.sum(axis=1))
+    emphy_l = lobe_totals(counts[:, 2])
+    emphy_stat = pd.DataFrame({'Lobes':LOBE_NAMES+['Total'],
+                  'Emphysratio':np.float16([e/n for e,n in zip(emphy_l,IN_l)]),
+                  'voxels_Emphys':emphy_l,
+                  'VoxelsAll':IN_l})
+    return emphy_img, emphy_stat
+
+
+# Emphysema & fSAD:
+#  - 2 if IN < emphy_threshold
+#  - 1 if emphy_threshold <= IN and warped EX < fSAD_threshold
+def get_Emph_fSAD(IN_img, IN_lobe_img, warp_img, emphy_threshold=-950, fSAD_threshold=-856,
+                  out=None, chunk=None):
+    emphy_img, counts = _Emph_fSAD(IN_img, IN_lobe_img, warp_img, emphy_threshold, fSAD_threshold,
+                                   out, chunk)
+
+    IN_l = lobe_totals(counts.sum(axis=1))
+    emphy_l = lobe_totals(counts[:, 2])
+    fsad_l = lobe_totals(counts[:, 1])
+    emphy_stat = pd.DataFrame({'Lobes':LOBE_NAMES+['Total'],
+                  'Emphysratio':np.float16([e/n for e,n in zip(emphy_l,IN_l)]),
+                  'voxels_Emphys':emphy_l,
+                  'fSADratio':np.float16([f/n for f,n in zip(fsad_l,IN_l)]),
+                  'voxels_fSAD':fsad_l,
+                  'VoxelsAll':IN_l})
+    return emphy_img, emphy_stat
+
+
+# HAA: l_threshold <= IN <= u_threshold in IN lobe mask
+def get_HAA(IN_img, IN_lobe_img, l_threshold=-700, u_threshold=0, out=None, chunk=None):
+    HAA_img = np.zeros((IN_img.shape),dtype='uint8') if out is None else out
+    counts = np.zeros((lobar.NLABEL, 2), dtype=np.int64)
+    # 1 if HAA, 0 if outside lobe
+    for sl, (HAA, c) in lobar.map_slabs(
+            lambda sl: qct_kernels.between(IN_img[sl], IN_lobe_img[sl], l_threshold, u_threshold),
+            IN_img.shape, chunk, qct_kernels.slab_threads()):
+        HAA_img[sl] = HAA
+        counts += c
+
+    IN_l = lobe_totals(counts.sum(axis=1))
+    HAA_l = lobe_totals(counts[:, 1])
+    HAA_stat = pd.DataFrame({'Lobes':LOBE_NAMES+['total'],
+                  'HAAratio':np.float16([h/n for h,n in zip(HAA_l,IN_l)]),
+                  'voxels_HAA':HAA_l,
+                  'Voxels':IN_l})
+    return HAA_img, HAA_stat
+
+
+# RRAVC denominator: sum(airDiff)/sum(fixed_airVol) of the whole volume
+def get_RRAVC_den(airdiff_img, av_fixed_img):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        V_airdiff = np.sum(airdiff_img)
+        V_airfixed = np.sum(av_fixed_img)
+        return V_airdiff/V_airfixed
+
+
+# RRAVC: (airDiff/fixed_airVol) / (sum(airDiff)/sum(fixed_airVol))
+# RRAVC_den: given if the images are cropped (lobar.lobe_bbox)
+def get_RRAVC(airdiff_img, av_fixed_img, IN_lobe_img, RRAVC_den=None, out=None, chunk=None):
+    RRAVC_img, moments = _RRAVC(airdiff_img, av_fixed_img, IN_lobe_img, RRAVC_den, None, out, chunk)
+    return RRAVC_img, _RRAVC_stat(moments[0])
+
+
+# RRAVC and, from the same pass over airDiff & fixed_airVol, the lobar
+# tables _lobar_airDiff.txt and _lobar_fixed_tissue.txt (lobe_dat):
+#  - airDiff: air volume change [mm^3] of each voxel, total of each lobe
+#  - tissue fraction: 1 - fixed_airVol/voxel_volume, voxel_volume in mm^3
+def get_RRAVC_dat(airdiff_img, av_fixed_img, IN_lobe_img, voxel_volume, RRAVC_den=None,
+                  out=None, chunk=None):
+    RRAVC_img, moments = _RRAVC(airdiff_img, av_fixed_img, IN_lobe_img, RRAVC_den, voxel_volume,
+                                out, chunk)
+    return RRAVC_img, _RRAVC_stat(moments[0]), lobe_dat(moments[1]), lobe_dat(moments[2])
+
+
+# moments of RRAVC (, airDiff, tissue fraction if voxel_volume)
+def _RRAVC(airdiff_img, av_fixed_img, IN_lobe_img, RRAVC_den, voxel_volume, out, chunk):
+    RRAVC_img = np.empty(airdiff_img.shape, dtype='float32') if out is None else out
+    moments = np.zeros((3, lobar.NLABEL, 3))
+    if RRAVC_den is None:
+        RRAVC_den = get_RRAVC_den(airdiff_img, av_fixed_img)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        # air_dff/fixed_airvol
+        def kernel(sl):
+            airdiff = airdiff_img[sl]
+            RRAVC = _out_slab(RRAVC_img, sl, airdiff.shape)
+            # background is -100
+            return RRAVC, qct_kernels.rravc(airdiff, av_fixed_img[sl], IN_lobe_img[sl], RRAVC_den,
+                                            voxel_volume, RRAVC)
+
+        for sl, (RRAVC, m) in lobar.map_slabs(kernel, airdiff_img.shape, chunk,
+                                              qct_kernels.slab_threads()):
+            moments += m
+            if not isinstance(RRAVC_img, np.ndarray):
+                RRAVC_img[sl] = RRAVC
+    return RRAVC_img, moments
+
+
+def _RRAVC_stat(moments):
+    m, sd, cv = lobar.lobar_m_sd_cv(moments)
+    return pd.DataFrame({'Lobes':LOBE_NAMES+['All'],
+                  'RRAVC_m':np.float16(m),
+                  'RRAVC_sd':np.float16(sd),
+                  'RRAVC_cv':np.float16(cv)})
+
+
+# float32 slab of out to compute in place:
+# a view of out, or a buffer for out[sl] = buf (ex. qct_io.SlabWriter)
+def _out_slab(out, sl, shape):
+    if isinstance(out, np.ndarray):
+        return out[sl]
+    return np.empty(shape, dtype='float32')
+
+
+# S*: |displacement| / (V_IN-V_EX)^(1/3), V in mm^3
+def get_S_norm(disp, IN_lobe_img, V_IN, V_EX, out=None, chunk=None):
+    # This doesn't work if V_IN- V_EX is negative
+    # s_norm = s/((V_IN-V_EX)**(1/3))
+    V_norm = ownpow(V_IN-V_EX,1/3)
+    s_norm = np.empty(disp.shape[:3], dtype='float32') if out is None else out
+    moments = np.zeros((lobar.NLABEL, 3))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        def kernel(sl):
+            d = disp[sl]
+            s = _out_slab(s_norm, sl, d.shape[:3])
+            # [mm]
+            return s, qct_kernels.s_norm(d, IN_lobe_img[sl], V_norm, s)
+
+        for sl, (s, m) in lobar.map_slabs(kernel, disp.shape[:3], chunk,
+                                          qct_kernels.slab_threads()):
+            moments += m
+            if not isinstance(s_norm, np.ndarray):
+                s_norm[sl] = s
+
+    m, sd, cv = lobar.lobar_m_sd_cv(moments)
+    s_norm_stat = pd.DataFrame({'Lobes':LOBE_NAMES+['All'],
+                  'sStar_m':np.float16(m),
+                  'sStar_sd':np.float16(sd),
+                  'sStar_cv':np.float16(cv)})
+    return s_norm, s_norm_stat
+
+
+# Lobar table in the layout of the pipeline _Lobe.dat files (extract_QCT.py):
+# rows Lobe0-Lobe4 and All (the five lobes), total: sum, average: mean
+def lobe_dat(moments):
+    n = np.array(lobe_totals(moments[:, 0]))
+    s = np.array(lobe_totals(moments[:, 1]))
+    ss = np.array(lobe_totals(moments[:, 2]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m = s/n
+        sd = np.sqrt(np.maximum(ss/n - m*m, 0))
+        cv = sd/m
+    return pd.DataFrame({'Lobes':LOBE_NAMES+['All'],
+                  'total':s,
+                  'average':m,
+                  'sd':sd,
+                  'cv':cv,
+                  'voxels':n.astype(np.int64)})
+
+
+# Jacobian determinant & ADI of x -> x + disp(x), in the lobe mask (0 outside)
+#  - F = I + d(disp)/dx, central differences (np.gradient) in mm
+#  - principal stretches l1 >= l2 >= l3: sqrt of the eigenvalues of F^T F
+#  - ADI = sqrt(((l1-l2)/l2)^2 + ((l2-l3)/l3)^2)
+# Slabs are read with one slice of halo, so the z-derivatives are the same
+# as of the whole volume. Crop with lobar.lobe_bbox(margin=1) to keep the
+# x & y derivatives in the lobes as well.
+# out: (J out, ADI out), as out of the other metrics
+def get_Jacob_ADI(disp, IN_lobe_img, spacing, out=None, chunk=None):
+    shape = disp.shape[:3]
+    J_img, ADI_img = out if out is not None else (
+        np.zeros(shape, dtype='float32'), np.zeros(shape, dtype='float32'))
+    moments = np.zeros((2, lobar.NLABEL, 3))
+
+    def kernel(sl):
+        z0, z1 = sl[-1].start, sl[-1].stop
+        h0, h1 = max(z0-1, 0), min(z1+1, shape[2])
+        d = np.asarray(disp[:, :, h0:h1], dtype=np.float64)
+        idx = lobar.lobe_index(IN_lobe_img[sl])
+        lung = idx != 0
+        # F[..., i, j] = delta_ij + d(disp_i)/dx_j
+        F = np.zeros(lung.shape + (3, 3))
+        for j in range(3):
+            if d.shape[j] > 1:
+                g = np.gradient(d, spacing[j], axis=j)
+                F[..., j] = g[:, :, z0-h0:z1-h0]
+            F[..., j, j] += 1
+        F = F[lung]
+        J = np.linalg.det(F)
+        # ascending: l3, l2, l1
+        l3, l2, l1 = np.sqrt(np.maximum(np.linalg.eigvalsh(np.einsum('nki,nkj->nij', F, F)), 0)).T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ADI = np.sqrt(((l1-l2)/l2)**2 + ((l2-l3)/l3)**2)
+        outs = []
+        for v in (J, ADI):
+            slab = np.zeros(lung.shape, dtype='float32')
+            slab[lung] = v
+            outs.append((slab, lobar.moments_lobes(idx[lung], v)))
+        return outs
+
+    # (x,y,z,3,3) temporaries: smaller slabs than the other metrics
+    for sl, outs in lobar.map_slabs(kernel, shape, chunk or lobar.CHUNK//16):
+        for k, (img, (slab, m)) in enumerate(zip((J_img, ADI_img), outs)):
+            img[sl] = slab
+            moments[k] += m
+    return J_img, ADI_img, lobe_dat(moments[0]), lobe_dat(moments[1])
+
+
+# HU percentiles of get_density
+PERCENTILES = (10, 15, 25, 50, 75, 90)
+
+
+# Lobar density from a lobar.LobarHistogram: mean HU, HU percentiles
+# (Perc15, ...), total, air & tissue volume [cm^3], voxel_volume in mm^3
+def get_density(hist, voxel_volume, percentiles=PERCENTILES):
+    air, tissue = hist.air_tissue()
+    voxels = hist.lobe_rows().sum(axis=1)
+    stat = pd.DataFrame({'Lobes':LOBE_NAMES+['total'],
+                  'HU_mean':np.float32(hist.mean())})
+    for p in percentiles:
+        stat[f'Perc{p:g}'] = np.float32(hist.percentile(p))
+    stat['total_volume_cm3'] = np.float32(voxels*voxel_volume/1000)
+    stat['air_volume_cm3'] = np.float32(air*voxel_volume/1000)
+    stat['tissue_volume_cm3'] = np.float32(tissue*voxel_volume/1000)
+    stat['Voxels'] = voxels
+    return stat
+
+
+# V_cm3 from vida-histo.csv -> mm^3
+def get_lung_volume(histo_path):
+    histo = pd.read_csv(histo_path)
+    V = histo.loc[histo.location=='both', 'total-volume-cm3'].values[0]
+    return V * 1000
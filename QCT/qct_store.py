@@ -0,0 +1,205 @@
+# ##############################################################################
+# qct_store.py
+# Chunked, compressed per-project store of the step16 output images
+# ##############################################################################
+# 20221018, In Kyu Lee
+#  - One folder per project instead of loose .hdr/.img pairs in every
+#    subject folder (get_QCT.py --store, run_cohort.py --store).
+#    Each image is split into z-chunks of NZ slices, compressed with zlib,
+#    such that a slice range (or a lobe, see lobar.lobe_bbox) is read
+#    without reading the whole image.
+# ##############################################################################
+# Layout, ex) sample_data/ENV18PM/store_ENV18PM:
+#   {Subj}/{I2}-TO-{I1}/{name}.chunks/
+#     meta.json: shape, dtype, nz (slices per chunk), fill
+#     header.hdr: Analyze header (the one medpy.io.save writes)
+#     {k}.zlib: slices k*nz ... (k+1)*nz-1, (z,y,x) C-order bytes
+#   A chunk that is all fill (ex. outside the lung) is not stored.
+# Writes: an image is written to a temporary folder and renamed to
+# {name}.chunks when complete, such that readers never see a partial image
+# and writers of different images (ex. run_cohort.py workers) are
+# independent. Chunk & meta files are written to temporary files first.
+# ##############################################################################
+import os
+import shutil
+import threading
+import zlib
+import numpy as np
+import qct_cache
+import qct_io
+
+STORE_EXT = '.chunks'
+# slices per chunk
+NZ = 16
+
+
+# {Proj_path}/store_{Proj}
+def store_root(path, Proj):
+    return os.path.join(path, f'store_{Proj}')
+
+
+# ex) store_ENV18PM/PMSN03001/EX0-TO-IN0/AirT.chunks
+def array_path(root, Subj, I1, I2, name):
+    return os.path.join(root, Subj, f'{I2}-TO-{I1}', name + STORE_EXT)
+
+
+# [(Subj, I1, I2, name, path), ...] of the complete images in the store
+def list_arrays(root):
+    arrays = []
+    for Subj in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+        for pair in sorted(os.listdir(os.path.join(root, Subj))):
+            I2, _, I1 = pair.partition('-TO-')
+            for f in sorted(os.listdir(os.path.join(root, Subj, pair))):
+                path = os.path.join(root, Subj, pair, f)
+                if f.endswith(STORE_EXT) and os.path.exists(os.path.join(path, 'meta.json')):
+                    arrays.append((Subj, I1, I2, f[:-len(STORE_EXT)], path))
+    return arrays
+
+
+def _tmp_name(path):
+    return f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+
+def _write_file(path, data):
+    tmp = _tmp_name(path)
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+# Image written slab by slab (as qct_io.SlabWriter) to the store.
+# Slabs are buffered until their chunk is complete, at most one chunk
+# (two, if a slab spans a chunk boundary) is kept in memory.
+class StoreWriter(qct_io.SlabWriter):
+    def __init__(self, path, shape, hdr, dtype=None, roi=None, fill=0, nz=NZ):
+        super().__init__(path, shape, hdr, dtype, roi, fill)
+        self.nz = nz
+
+    def _open(self):
+        self.tmp = _tmp_name(self.path)
+        os.makedirs(self.tmp)
+        _write_file(os.path.join(self.tmp, 'header.hdr'),
+                    qct_io.analyze_header(self.shape, self.hdr, self.dtype))
+        # {chunk: [slices, number of slices written]}
+        self.chunks = {}
+        self.f = True
+
+    def _write(self, z0, value):
+        x, y, z = self.shape
+        value = value.astype(self.dtype, copy=False)
+        z1 = z0 + value.shape[2]
+        for k in range(z0 // self.nz, (z1-1) // self.nz + 1):
+            c0, c1 = k*self.nz, min((k+1)*self.nz, z)
+            if k not in self.chunks:
+                self.chunks[k] = [np.full((x, y, c1-c0), self.fill, dtype=self.dtype), 0]
+            a, b = max(z0, c0), min(z1, c1)
+            self.chunks[k][0][:, :, a-c0:b-c0] = value[:, :, a-z0:b-z0]
+            self.chunks[k][1] += b - a
+            if self.chunks[k][1] == c1 - c0:
+                self._flush(k)
+
+    def _flush(self, k):
+        data, _ = self.chunks.pop(k)
+        if np.all(data == self.fill):
+            return
+        # (x,y,z) -> (z,y,x)
+        _write_file(os.path.join(self.tmp, f'{k}.zlib'),
+                    zlib.compress(np.ascontiguousarray(data.T).tobytes(), 1))
+
+    def close(self):
+        if self.f is None:
+            self._create(self.dtype or 'float32')
+        for k in sorted(self.chunks):
+            self._flush(k)
+        qct_cache.save_json(os.path.join(self.tmp, 'meta.json'),
+                            {'shape': list(self.shape), 'dtype': self.dtype.str,
+                             'nz': self.nz, 'fill': self.fill})
+        # replace the previous image
+        old = None
+        if os.path.exists(self.path):
+            old = _tmp_name(self.path) + '.old'
+            os.replace(self.path, old)
+        os.replace(self.tmp, self.path)
+        if old is not None:
+            shutil.rmtree(old)
+
+
+def save(img, path, hdr, nz=NZ):
+    writer = StoreWriter(path, img.shape, hdr, img.dtype, nz=nz)
+    writer[:, :, 0:img.shape[2]] = img
+    writer.close()
+
+
+# Image of the store, read chunk by chunk:
+#   a = StoreArray(path)
+#   a[:, :, 100:120] reads the chunks of slices 100-119 only
+# The z index is an int or a slice, x & y any numpy index.
+class StoreArray:
+    def __init__(self, path):
+        meta = qct_cache.load_json(os.path.join(path, 'meta.json'))
+        if not meta:
+            raise FileNotFoundError(f'{path}: not a complete image')
+        self.path = path
+        self.shape = tuple(meta['shape'])
+        self.dtype = np.dtype(meta['dtype'])
+        self.nz = meta['nz']
+        self.fill = meta['fill']
+
+    def header(self):
+        with open(os.path.join(self.path, 'header.hdr'), 'rb') as f:
+            return f.read()
+
+    def chunk(self, k):
+        x, y, z = self.shape
+        n = min((k+1)*self.nz, z) - k*self.nz
+        path = os.path.join(self.path, f'{k}.zlib')
+        if not os.path.exists(path):
+            return np.full((x, y, n), self.fill, dtype=self.dtype)
+        with open(path, 'rb') as f:
+            data = np.frombuffer(zlib.decompress(f.read()), dtype=self.dtype)
+        # (z,y,x) -> (x,y,z)
+        return data.reshape(n, y, x).T
+
+    # slices z0 ... z1-1
+    def read(self, z0, z1):
+        x, y, _ = self.shape
+        out = np.empty((x, y, z1-z0), dtype=self.dtype, order='F')
+        for k in range(z0 // self.nz, (z1-1) // self.nz + 1):
+            c0 = k*self.nz
+            data = self.chunk(k)
+            a, b = max(z0, c0), min(z1, c0 + data.shape[2])
+            out[:, :, a-z0:b-z0] = data[:, :, a-c0:b-c0]
+        return out
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        key = key + (slice(None),)*(3-len(key))
+        if len(key) != 3 or not isinstance(key[2], (int, np.integer, slice)):
+            raise IndexError('StoreArray only supports [x, y, int or slice]')
+        z = range(self.shape[2])[key[2]]
+        if isinstance(z, int):
+            return self.read(z, z+1)[key[0], key[1], 0]
+        if len(z) == 0:
+            return np.empty(self.shape[:2] + (0,), dtype=self.dtype)[key[0], key[1]]
+        z0, z1 = min(z), max(z) + 1
+        data = self.read(z0, z1)
+        if z.step != 1:
+            data = data[:, :, np.asarray(z) - z0]
+        return data[key[0], key[1]]
+
+
+# (image, medpy header), as medpy.io.load
+def load(path):
+    a = StoreArray(path)
+    return a[:, :, :], qct_io.header_from_bytes(a.header())
+
+
+# store image -> .hdr/.img (same bytes as medpy.io.save), chunk by chunk
+def export(path, img_path):
+    a = StoreArray(path)
+    with open(img_path[:-4] + '.hdr', 'wb') as f:
+        f.write(a.header())
+    with open(img_path, 'wb') as f:
+        for k in range(-(-a.shape[2] // a.nz)):
+            f.write(np.ascontiguousarray(a.chunk(k).T).tobytes())
+    return img_path
@@ -0,0 +1,144 @@
+# ##############################################################################
+# qct_triage.py
+# Approximate step16 lobar ratios from a voxel sample, with confidence intervals
+# ##############################################################################
+# 20221018, In Kyu Lee
+#  - Triage of large batches (get_QCT.py --triage, run_cohort.py --triage):
+#    AirT, Emph, fSAD and HAA ratios and the RRAVC mean of each lobe from a
+#    sample of the lobe voxels, instead of every voxel.
+#    The same command without --triage computes the exact values
+#    (_lobar_*.txt), the triage table is not used by the other scripts.
+# ##############################################################################
+# Samples (sample_points): flat (F-order) indices of lobe voxels
+#  - grid: every s-th voxel along x, y and z (a downsampled volume),
+#    s = round(fraction^(-1/3))
+#  - random: each lobe voxel with probability fraction (seed)
+# Intervals (level 95%):
+#  - ratios: Wilson score interval of k sampled voxels out of n
+#  - RRAVC mean: m +- z*sd/sqrt(n)
+# Both treat the sample as random. The grid sample is systematic, its
+# intervals are approximate.
+# Reading (get_QCT.run_triage):
+#  - grid: the images are read at the grid step (qct_io.load_strided) and
+#    sampled with fraction 1, lobe_counts from the full lobe masks.
+#    The RRAVC denominator is from the strided airDiff & fixed_airVol.
+#  - random: whole images, the RRAVC denominator is of the whole volume.
+# Output table (_lobar_triage.txt): Metric, Lobes, value, ci_low, ci_high,
+# n_sample (sampled lobe voxels), n_lobe (lobe voxels) and fraction.
+# ##############################################################################
+import numpy as np
+import pandas as pd
+import warnings
+import lobar
+import qct_kernels
+import qct_metrics
+from lobar import LOBE_NAMES, lobe_totals
+
+MODES = ('grid', 'random')
+# z of the 95% interval
+Z = 1.959964
+
+
+# Wilson score interval of k successes out of n
+def wilson(k, n, z=Z):
+    k = np.asarray(k, dtype=np.float64)
+    n = np.asarray(n, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = k/n
+        d = 1 + z*z/n
+        center = (p + z*z/(2*n))/d
+        half = z*np.sqrt(p*(1-p)/n + z*z/(4*n*n))/d
+    return center-half, center+half
+
+
+# grid step of a sampling fraction
+def grid_step(fraction):
+    return max(1, int(round(fraction ** (-1/3))))
+
+
+# flat (F-order) indices of the sampled lobe voxels, ascending
+def sample_points(lobe_img, fraction, mode='grid', seed=0):
+    shape = lobe_img.shape[:3]
+    if mode == 'grid':
+        s = grid_step(fraction)
+        ijk = [a*s for a in np.nonzero(np.asarray(lobe_img[::s, ::s, ::s]))]
+        return np.sort(np.ravel_multi_index(ijk, shape, order='F'))
+    if mode == 'random':
+        points = np.flatnonzero(np.ravel(lobe_img, order='F'))
+        rng = np.random.default_rng(seed)
+        return points[rng.random(len(points)) < fraction]
+    raise ValueError(f'unknown sampling mode {mode}, one of {MODES}')
+
+
+# values of img at the sampled points
+def take(img, points):
+    return np.ravel(img, order='F')[points]
+
+
+# rows Lobe0-Lobe4 & total of a ratio: k of n sampled voxels, N lobe voxels
+def _ratio_rows(metric, k, n, N):
+    k, n, N = (np.asarray(lobe_totals(x), dtype=np.float64) for x in (k, n, N))
+    low, high = wilson(k, n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return pd.DataFrame({'Metric': metric, 'Lobes': LOBE_NAMES+['total'],
+                             'value': k/n, 'ci_low': low, 'ci_high': high,
+                             'n_sample': n.astype(np.int64), 'n_lobe': N.astype(np.int64),
+                             'fraction': n/N})
+
+
+# rows Lobe0-Lobe4 & All of the RRAVC mean (All: mean of the lobar means,
+# as _lobar_RRAVC.txt)
+def _mean_rows(metric, moments, N):
+    m, sd, _ = lobar.lobar_m_sd_cv(moments)
+    n = np.asarray(lobe_totals(moments[:, 0]), dtype=np.float64)
+    N = np.asarray(lobe_totals(N), dtype=np.float64)
+    m, sd = np.asarray(m), np.asarray(sd)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        half = Z*sd/np.sqrt(n)
+        return pd.DataFrame({'Metric': metric, 'Lobes': LOBE_NAMES+['All'],
+                             'value': m, 'ci_low': m-half, 'ci_high': m+half,
+                             'n_sample': n.astype(np.int64), 'n_lobe': N.astype(np.int64),
+                             'fraction': n/N})
+
+
+# Triage table of one registration pair.
+# thresholds: AirT_threshold, emphy_threshold, fSAD_threshold, HAA_threshold
+# (l, u); images that are None are skipped (EX & EX lobe: AirT, warped:
+# fSAD, airDiff & fixed: RRAVC).
+# lobe_counts: (IN, EX) lobe voxels (lobar.lobar_count) if the images are
+# strided, otherwise counted in the lobe images.
+def get_triage(IN_img, IN_lobe_img, EX_img=None, EX_lobe_img=None, warp_img=None,
+               airdiff_img=None, av_fixed_img=None, AirT_threshold=-856,
+               emphy_threshold=-950, fSAD_threshold=-856, HAA_threshold=(-700, 0),
+               fraction=0.01, mode='grid', seed=0, lobe_counts=None):
+    if lobe_counts is None:
+        lobe_counts = (lobar.lobar_count(IN_lobe_img)[:, 0],
+                       None if EX_lobe_img is None else lobar.lobar_count(EX_lobe_img)[:, 0])
+    rows = []
+    if EX_img is not None:
+        points = sample_points(EX_lobe_img, fraction, mode, seed)
+        N = lobe_counts[1]
+        _, c = qct_kernels.below(take(EX_img, points), take(EX_lobe_img, points), AirT_threshold)
+        rows.append(_ratio_rows('AirT', c[:, 1], c.sum(axis=1), N))
+
+    points = sample_points(IN_lobe_img, fraction, mode, seed)
+    N = lobe_counts[0]
+    IN = take(IN_img, points)
+    lobe = take(IN_lobe_img, points)
+    warp = None if warp_img is None else take(warp_img, points)
+    _, c = qct_kernels.emph_fsad(IN, lobe, warp, emphy_threshold, fSAD_threshold)
+    rows.append(_ratio_rows('Emph', c[:, 2], c.sum(axis=1), N))
+    if warp is not None:
+        rows.append(_ratio_rows('fSAD', c[:, 1], c.sum(axis=1), N))
+    _, c = qct_kernels.between(IN, lobe, *HAA_threshold)
+    rows.append(_ratio_rows('HAA', c[:, 1], c.sum(axis=1), N))
+
+    if airdiff_img is not None:
+        RRAVC_den = qct_metrics.get_RRAVC_den(airdiff_img, av_fixed_img)
+        RRAVC = np.empty(len(points), dtype='float32')
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            moments = qct_kernels.rravc(take(airdiff_img, points), take(av_fixed_img, points),
+                                        lobe, RRAVC_den, None, RRAVC)
+        rows.append(_mean_rows('RRAVC', moments[0], N))
+    return pd.concat(rows, ignore_index=True)
@@ -0,0 +1,189 @@
+# ##############################################################################
+# qct_voxels.py
+# Lung voxel table: the voxels in the lobe mask as 1D arrays
+# ##############################################################################
+# 20221018, In Kyu Lee
+#  - LungVoxels: flat indices, lobe codes and gathered image values of the
+#    voxels where lobe mask != 0, cached in _lung_voxels.npz.
+#    The metrics of qct_metrics.py run on the 1D arrays as they are
+#    (slabs of a 1D array are ranges of voxels), and the output images are
+#    scattered back to the full grid when they are written.
+#  - LobeIndex: voxels of each lobe (CSR layout) of a lobe mask file, cached
+#    beside the mask, ex) PMSN03001_IN0_vida-lobes_index.npz, such that the
+#    mask shared by every metric and registration pair is indexed once.
+# ##############################################################################
+# Flat indices are in Fortran order of the (x,y,z) image, i.e. in the same
+# order as the voxels are visited by lobar.py.
+# ##############################################################################
+import os
+import numpy as np
+import lobar
+import qct_cache
+import qct_io
+
+# lobe index (0-6) -> a lobe code with the same lobe index, 'other' as 1
+CODES = np.array([0] + lobar.LOBES + [1], dtype=np.uint8)
+
+
+class LungVoxels:
+    def __init__(self, shape, index, lobe, values, sums=None):
+        self.shape = tuple(int(s) for s in shape)
+        self.index = index
+        self.lobe = lobe
+        # {name: values of the image at index}
+        self.values = values
+        # {name: np.sum of the whole image}, ex) RRAVC denominator
+        self.sums = sums or {}
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def __len__(self):
+        return len(self.index)
+
+    # table of the voxels in the lobe mask, without values yet
+    @classmethod
+    def from_mask(cls, lobe_img):
+        shape = lobe_img.shape[:3]
+        plane = shape[0]*shape[1]
+        index_dtype = np.uint32 if np.prod(shape) < 2**32 else np.int64
+        index, lobe = [], []
+        for sl in lobar.slabs(shape):
+            lobe_slab = lobe_img[sl].ravel(order='F')
+            local = np.flatnonzero(lobe_slab)
+            index.append((local + sl[-1].start*plane).astype(index_dtype))
+            lobe.append(lobe_slab[local])
+        return cls(shape, np.concatenate(index), np.concatenate(lobe), {})
+
+    # table from a LobeIndex, lobe codes as in CODES
+    @classmethod
+    def from_index(cls, lobe_index):
+        index = lobe_index.order[lobe_index.offsets[1]:]
+        label = np.repeat(np.arange(1, lobar.NLABEL, dtype=np.uint8),
+                          np.diff(lobe_index.offsets[1:]))
+        order = np.argsort(index, kind='stable')
+        return cls(lobe_index.shape, index[order], CODES[label[order]], {})
+
+    # gather the values of img (same shape as the lobe mask), one slab at a
+    # time. keep_sum: keep the sum of the whole image as well
+    def add(self, name, img, keep_sum=False):
+        plane = self.shape[0]*self.shape[1]
+        values = np.empty(len(self.index), dtype=img.dtype)
+        for sl in lobar.slabs(self.shape):
+            z0, z1 = sl[-1].start*plane, sl[-1].stop*plane
+            i0, i1 = np.searchsorted(self.index, [z0, z1])
+            values[i0:i1] = img[sl].ravel(order='F')[self.index[i0:i1] - z0]
+        self.values[name] = values
+        if keep_sum:
+            self.sums[name] = np.sum(img)
+
+    # full image of values at index, fill elsewhere
+    def scatter(self, values, fill=0, dtype=None):
+        values = np.asarray(values)
+        img = np.full(self.shape, fill, dtype=dtype or values.dtype, order='F')
+        img.reshape(-1, order='F')[self.index] = values
+        return img
+
+
+# ##############################################################################
+# Cache, ex) PMSN03001_EX0-TO-PMSN03001_IN0-SSTVD_lung_voxels.npz
+# ##############################################################################
+# One table per lobe mask (space), ex) EX: EX image in EX lobe mask,
+# stored with the stamp of its images and lobe mask.
+# ##############################################################################
+
+# sources: {space: [img_path, ..., lobe_path]} -> {space: LungVoxels}, fresh only
+def load_cache(path, sources):
+    cache = qct_cache.load_npz(path)
+    tables = {}
+    for space, paths in sources.items():
+        if f'stamp_{space}' not in cache or not qct_cache.is_fresh(cache[f'stamp_{space}'], paths):
+            continue
+        values, sums = {}, {}
+        for key in cache:
+            if key.startswith(f'{space}_value_'):
+                values[key[len(f'{space}_value_'):]] = cache[key]
+            elif key.startswith(f'{space}_sum_'):
+                sums[key[len(f'{space}_sum_'):]] = cache[key][()]
+        tables[space] = LungVoxels(cache[f'{space}_shape'], cache[f'{space}_index'],
+                                   cache[f'{space}_lobe'], values, sums)
+    return tables
+
+
+# tables: {space: LungVoxels}, tables already in the cache file are kept
+def save_cache(path, tables, sources):
+    cache = qct_cache.load_npz(path)
+    for space, table in tables.items():
+        # drop the old table of this space
+        cache = {k: v for k, v in cache.items() if not k.startswith(f'{space}_')}
+        cache[f'{space}_shape'] = np.array(table.shape)
+        cache[f'{space}_index'] = table.index
+        cache[f'{space}_lobe'] = table.lobe
+        for name, v in table.values.items():
+            cache[f'{space}_value_{name}'] = v
+        for name, v in table.sums.items():
+            cache[f'{space}_sum_{name}'] = np.asarray(v)
+        cache[f'stamp_{space}'] = np.str_(qct_cache.stamp(sources[space]))
+    qct_cache.save_npz(path, **cache)
+
+
+# ##############################################################################
+# Lobe index, ex) PMSN03001_IN0_vida-lobes_index.npz
+# ##############################################################################
+# CSR layout of the lobe mask: order are the flat indices (Fortran order of
+# (x,y,z)) of the voxels sorted by lobe index (lobar.lobe_index), and
+# order[offsets[k]:offsets[k+1]] are the voxels of lobe index k.
+# Background (0) is not stored.
+# ##############################################################################
+class LobeIndex:
+    def __init__(self, shape, order, offsets):
+        self.shape = tuple(int(s) for s in shape)
+        self.order = order
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_mask(cls, lobe_img):
+        shape = lobe_img.shape[:3]
+        plane = shape[0]*shape[1]
+        index_dtype = np.uint32 if np.prod(shape) < 2**32 else np.int64
+        flat, label = [], []
+        for sl in lobar.slabs(shape):
+            idx = lobar.lobe_index(lobe_img[sl]).ravel(order='F')
+            local = np.flatnonzero(idx)
+            flat.append((local + sl[-1].start*plane).astype(index_dtype))
+            label.append(idx[local])
+        flat, label = np.concatenate(flat), np.concatenate(label)
+        order = flat[np.argsort(label, kind='stable')]
+        counts = np.bincount(label, minlength=lobar.NLABEL)
+        counts[0] = 0
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        return cls(shape, order, offsets)
+
+    # flat indices of the voxels of lobe index k (1-5: Lobe0-Lobe4)
+    def voxels(self, k):
+        return self.order[self.offsets[k]:self.offsets[k+1]]
+
+    # values of img in lobe index k, one fancy-index
+    # (img in Fortran order, ex. medpy.io.load or qct_io.load)
+    def gather(self, img, k):
+        return img.reshape(-1, order='F')[self.voxels(k)]
+
+
+# X_vida-lobes.img(.gz) -> X_vida-lobes_index.npz
+def lobe_index_path(mask_path):
+    base = mask_path[:-3] if mask_path.endswith('.gz') else mask_path
+    return os.path.splitext(base)[0] + '_index.npz'
+
+
+# LobeIndex of a lobe mask file, from the cache beside it if fresh
+def load_lobe_index(mask_path):
+    path = lobe_index_path(mask_path)
+    cache = qct_cache.load_npz(path)
+    if 'stamp' in cache and qct_cache.is_fresh(cache['stamp'], [mask_path]):
+        return LobeIndex(cache['shape'], cache['order'], cache['offsets'])
+    lobe_img, _ = qct_io.load(mask_path)
+    lobe_index = LobeIndex.from_mask(lobe_img)
+    qct_cache.save_npz(path, shape=np.array(lobe_index.shape), order=lobe_index.order,
+                       offsets=lobe_index.offsets,
+                       stamp=np.str_(qct_cache.stamp([mask_path])))
+    return lobe_index
@@ -0,0 +1,188 @@
+# ##############################################################################
+# Usage: python run_cohort.py Proj_path Proj [options]
+# ex) python run_cohort.py sample_data/ENV18PM ENV18PM --pairs IN0 EX0 --workers 8
+#     python run_cohort.py sample_data/ENV18PM ENV18PM --pairs IN0 EX0 TLC0 FRC0
+# ##############################################################################
+# 20221018, In Kyu Lee
+#  - step16 (get_QCT.run_step16_pairs) of a whole project in a process pool,
+#    one task per subject: the images & lobe masks shared by its
+#    registration pairs are loaded once.
+#    No script is copied to the subject folders (deploy_QCT.sh, step16.sh),
+#    each subject folder is passed as path.
+#    Unchanged metrics are skipped (_step16_manifest.json, see get_QCT.py),
+#    so a rerun after adding subjects only computes the new ones.
+#  - --store: output images in store_{Proj} of the project folder
+#    (qct_store.py), see export_store.py.
+#  - --threads: threads per subject (get_QCT.py --threads), ex) fewer
+#    workers than subjects on a many-core machine.
+#  - --triage FRACTION: approximate ratios of each subject from a voxel
+#    sample (get_QCT.py --triage), collected in {Proj}_triage.csv.
+# ##############################################################################
+# Input:
+#  - Project folder, ex) sample_data/ENV18PM
+#    with subject folders {Proj}_{Subj}, ex) ENV18PM_PMSN03001
+#  - Registration pairs (I1 I2 ...), ex) IN0 EX0
+# Output:
+#  - step16 outputs in each subject folder, see get_QCT.py
+#  - store_{Proj}: output images (--store)
+#  - {Proj}_step16_failed.csv: Subj, I1, I2, error of failed subjects
+#  - {Proj}_triage.csv: triage tables of all subjects (--triage)
+# ##############################################################################
+
+# import libraries
+import os
+import io
+import argparse
+import time
+import traceback
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from tqdm.auto import tqdm
+
+from get_QCT import run_step16_pairs, Step16Paths
+import qct_store
+import qct_triage
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='step16 of a whole project')
+    parser.add_argument('path', type=str, help='Project folder')
+    parser.add_argument('Proj', type=str)
+    parser.add_argument('--pairs', type=str, nargs='+', default=['IN0', 'EX0'],
+                        help='Registration pairs: I1 I2 [I1 I2 ...]')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of processes')
+    parser.add_argument('--airt', type=int, default=-856, help='Airtrapping threshold')
+    parser.add_argument('--emph', type=int, default=-950, help='Emphysema threshold')
+    parser.add_argument('--fsad', type=int, default=-856, help='fSAD threshold')
+    parser.add_argument('--haa', type=int, nargs=2, default=[-700, 0],
+                        metavar=('LOWER', 'UPPER'), help='HAA thresholds')
+    parser.add_argument('--no-hist', action='store_true',
+                        help='Do not save per-lobe HU histograms (_lobar_hist.npz)')
+    parser.add_argument('--slab', type=int, default=None, metavar='NZ',
+                        help='Bounded memory streaming, NZ slices at a time')
+    parser.add_argument('--tmp', type=str, default=None,
+                        help='Folder for decompressed inputs of --slab (default: system temp)')
+    parser.add_argument('--voxels', action='store_true',
+                        help='Metrics from the lung voxel tables (_lung_voxels.npz)')
+    parser.add_argument('--packed', action='store_true',
+                        help='Label images (AirT, Emph_fSAD, HAA) as compact .lbl.npz')
+    parser.add_argument('--store', action='store_true',
+                        help='Output images in the project store (store_{Proj})')
+    parser.add_argument('--force', action='store_true',
+                        help='Recompute all metrics, even if unchanged')
+    parser.add_argument('--hash', action='store_true',
+                        help='Record sha1 of the inputs in the manifest')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Threads per worker (z-slabs of each volume)')
+    parser.add_argument('--jacobian', action='store_true',
+                        help='Jacobian & ADI of the displacement field (get_QCT.py --jacobian)')
+    parser.add_argument('--triage', type=float, default=None, metavar='FRACTION',
+                        help='Approximate ratios from FRACTION of the lobe voxels')
+    parser.add_argument('--sample', type=str, default='grid', choices=qct_triage.MODES,
+                        help='Sample of --triage: grid (strided) or random')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of --sample random')
+    args = parser.parse_args()
+    if len(args.pairs) % 2:
+        parser.error('--pairs needs I1 I2 pairs')
+    return args
+
+
+# all pairs of one subject in a worker process,
+# returns (elapsed time, {(I1, I2): error or None})
+def run_subject(Subj, pairs, subj_path, kwargs):
+    t = time.time()
+    # keep the timing prints of run_step16 out of the progress bar
+    with contextlib.redirect_stdout(io.StringIO()):
+        errors = run_step16_pairs(Subj, pairs, subj_path, **kwargs)
+    return time.time()-t, errors
+
+
+def main():
+    start = time.time()
+    args = get_args()
+    path, Proj = args.path, args.Proj
+    pairs = list(zip(args.pairs[0::2], args.pairs[1::2]))
+    kwargs = {'AirT_threshold': args.airt,
+              'emphy_threshold': args.emph,
+              'fSAD_threshold': args.fsad,
+              'HAA_threshold': tuple(args.haa),
+              'hist': not args.no_hist,
+              'slab': args.slab,
+              'tmp': args.tmp,
+              'force': args.force,
+              'hash': args.hash,
+              'threads': args.threads,
+              'jacobian': args.jacobian,
+              'triage': args.triage,
+              'sample': args.sample,
+              'seed': args.seed,
+              'voxels': args.voxels,
+              'packed': args.packed,
+              'store': qct_store.store_root(path, Proj) if args.store else None}
+
+    Subjs = [
+        f.split("_")[1]
+        for f in os.listdir(path)
+        if os.path.isdir(os.path.join(path, f)) and f.split("_")[0] == Proj
+    ]
+    failed = []
+    succeeded = []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {}
+        for Subj in Subjs:
+            subj_path = os.path.join(path, f'{Proj}_{Subj}')
+            future = pool.submit(run_subject, Subj, pairs, subj_path, kwargs)
+            futures[future] = Subj
+        pbar = tqdm(as_completed(futures), total=len(futures))
+        for future in pbar:
+            Subj = futures[future]
+            try:
+                _, errors = future.result()
+            except Exception:
+                # worker process died, ex) out of memory
+                error = traceback.format_exc()
+                errors = {pair: error for pair in pairs}
+            for (I1, I2), error in errors.items():
+                if error is not None:
+                    error = error.strip().splitlines()[-1]
+                    failed.append({'Subj': Subj, 'I1': I1, 'I2': I2, 'error': error})
+                    tqdm.write(f'{Subj} {I1} {I2} failed: {error}')
+                else:
+                    succeeded.append((Subj, I1, I2))
+            pbar.set_description(f'failed: {len(failed)}')
+
+    # Failure summary
+    failed_path = os.path.join(path, f'{Proj}_step16_failed.csv')
+    if failed:
+        failed = pd.DataFrame(failed).sort_values(['Subj', 'I1', 'I2'])
+        failed.to_csv(failed_path, index=False)
+        print(f'{len(failed)}/{len(futures)*len(pairs)} failed, see {failed_path}')
+        print(failed.to_string(index=False))
+    else:
+        if os.path.exists(failed_path):
+            os.remove(failed_path)
+        print(f'{len(futures)*len(pairs)} done')
+
+    # Triage summary
+    if args.triage:
+        tables = []
+        for Subj, I1, I2 in sorted(succeeded):
+            triage_path = Step16Paths(Subj, I1, I2, os.path.join(path, f'{Proj}_{Subj}')).triage
+            if os.path.exists(triage_path):
+                stat = pd.read_csv(triage_path, sep=' ')
+                stat.insert(0, 'I2', I2)
+                stat.insert(0, 'I1', I1)
+                stat.insert(0, 'Subj', Subj)
+                tables.append(stat)
+        if tables:
+            triage_path = os.path.join(path, f'{Proj}_triage.csv')
+            pd.concat(tables, ignore_index=True).to_csv(triage_path, index=False)
+            print(f'Triage: {triage_path}')
+    end = time.time()
+    print(f'Elapsed time: {end-start}s')
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,10 @@
 # ###################################################################################
 # step16_*.sh {Subj}
 # ###################################################################################
+# 10/18/2022, In Kyu Lee
+#  - get_QCT.py runs all metrics in one process; each volume is loaded once.
+#  - All registration pairs in one get_QCT.py call (shared image loads).
+#    The per-metric scripts (get_Airtrapping.py, ...) are still available.
 # 8/10/2021, Jiwoong Choi, In Kyu Lee
 #  - nreg and for loop added.
 #  - Emph_fSAD, instead of Emph. 
@@ -33,11 +37,18 @@
   echo 'Starting at...'; date
 # ###################################################################################
 # Step 16. Airtrapping, Emphysema, HAA, RRAVC, s*
+# all pairs in one get_QCT.py: images & lobe masks shared by pairs are loaded once
+  pairs=''
   for (( i=1; i<=$nreg ; i++ )); do
-    python get_Airtrapping.py $Subj ${I1[i]} ${I2[i]} -856
-    python get_Emph_fSAD.py $Subj ${I1[i]} ${I2[i]} -950 -856
-    python get_HAA.py $Subj ${I1[i]} ${I2[i]} -700 0
-    python get_RRAVC.py $Subj ${I1[i]} ${I2[i]} 
-    python get_S_norm.py $Subj ${I1[i]} ${I2[i]} 
+    pairs="$pairs ${I1[i]} ${I2[i]}"
   done
+  python get_QCT.py $Subj $pairs --airt -856 --emph -950 --fsad -856 --haa -700 0
+# per-metric scripts, one pair at a time:
+# for (( i=1; i<=$nreg ; i++ )); do
+    # python get_Airtrapping.py $Subj ${I1[i]} ${I2[i]} -856
+    # python get_Emph_fSAD.py $Subj ${I1[i]} ${I2[i]} -950 -856
+    # python get_HAA.py $Subj ${I1[i]} ${I2[i]} -700 0
+    # python get_RRAVC.py $Subj ${I1[i]} ${I2[i]} 
+    # python get_S_norm.py $Subj ${I1[i]} ${I2[i]} 
+# done
 # ############################################################################### END
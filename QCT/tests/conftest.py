@@ -0,0 +1,104 @@
+# ##############################################################################
+# conftest.py
+# Fixtures of the QCT tests: a small synthetic subject for step16
+# ##############################################################################
+# 20221018, In Kyu Lee
+#  - Usage: cd QCT && python -m pytest -q tests
+#  - tests/baseline: the per-metric scripts as they were before get_QCT.py
+#    (whole volume numpy), used as the reference of get_QCT.py outputs.
+# ##############################################################################
+import os
+import sys
+import shutil
+import subprocess
+import numpy as np
+import pandas as pd
+import pytest
+from medpy.io import save
+from medpy.io.header import Header
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+QCT = os.path.dirname(TESTS)
+BASELINE = os.path.join(TESTS, 'baseline')
+# QCT modules import each other by name
+sys.path.insert(0, QCT)
+
+Subj, I1, I2 = 'PMSN03001', 'IN0', 'EX0'
+SHAPE = (40, 36, 24)
+SPACING = (0.6, 0.6, 0.8)
+# baseline script & arguments
+BASELINE_RUNS = [('get_Airtrapping.py', '-856'),
+                 ('get_Emph_fSAD.py', '-950', '-856'),
+                 ('get_HAA.py', '-700', '0'),
+                 ('get_RRAVC.py',),
+                 ('get_S_norm.py',)]
+
+
+# lobes in blocks, with a background margin such that the lung ROI crops
+def lobes(shape):
+    lobe = np.zeros(shape, dtype=np.uint8)
+    x, y, z = shape
+    lobe[4:x//2, 5:y-5, 3:z//2] = 8
+    lobe[4:x//2, 5:y-5, z//2:z-3] = 16
+    lobe[x//2:x-4, 5:y-5, 3:z//3] = 32
+    lobe[x//2:x-4, 5:y-5, z//3:2*z//3] = 64
+    lobe[x//2:x-4, 5:y-5, 2*z//3:z-3] = 128
+    return lobe
+
+
+# step16 inputs of Subj I1 I2, as the files of a subject folder
+def make_subject(folder, shape=SHAPE, seed=0):
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    hdr = Header(spacing=SPACING)
+    pair = f'{Subj}_{I2}-TO-{Subj}_{I1}-SSTVD'
+    def path(name):
+        return os.path.join(folder, name)
+    for name in (f'{Subj}_{I1}.img.gz', f'{Subj}_{I2}.img.gz', f'{pair}.img.gz'):
+        save(rng.integers(-1024, 200, shape).astype(np.int16), path(name), hdr)
+    # one lobe mask compressed, the other not
+    save(lobes(shape), path(f'{Subj}_{I1}_vida-lobes.img.gz'), hdr)
+    save(lobes(shape), path(f'{Subj}_{I2}_vida-lobes.img'), hdr)
+    airdiff = rng.random(shape, dtype=np.float32) * 0.3
+    fixed = rng.random(shape, dtype=np.float32) * 0.28
+    # 0/0 -> 0 in RRAVC
+    fixed[0, 0, :] = 0
+    save(airdiff, path(f'{pair}_airDiff.img'), hdr)
+    save(fixed, path(f'{pair}_fixed_airVol.img.gz'), hdr)
+    disp = (rng.standard_normal(shape + (3,)) * 3).astype(np.float32)
+    save(disp, path(f'{pair}_disp_resample.mhd'), hdr)
+    for img, volume in ((I1, 5000.0), (I2, 2500.0)):
+        pd.DataFrame({'location': ['both', 'left'],
+                      'total-volume-cm3': [volume, volume/2]}).to_csv(
+            path(f'{Subj}_{img}_vida-histo.csv'), index=False)
+    return folder
+
+
+def run(args, cwd, env=None):
+    proc = subprocess.run([sys.executable] + list(args), cwd=cwd, env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    assert proc.returncode == 0, proc.stdout
+    return proc.stdout
+
+
+@pytest.fixture(scope='session')
+def subject_base(tmp_path_factory):
+    return make_subject(str(tmp_path_factory.mktemp('subject')))
+
+
+# a fresh copy of the synthetic subject
+@pytest.fixture
+def subject(subject_base, tmp_path):
+    folder = str(tmp_path / 'subject')
+    shutil.copytree(subject_base, folder)
+    return folder
+
+
+# outputs of the baseline scripts on the synthetic subject
+@pytest.fixture(scope='session')
+def baseline(subject_base, tmp_path_factory):
+    folder = str(tmp_path_factory.mktemp('baseline') / 'subject')
+    shutil.copytree(subject_base, folder)
+    for script, *thresholds in BASELINE_RUNS:
+        run([os.path.join(BASELINE, script), Subj, I1, I2] + thresholds, folder)
+    return folder
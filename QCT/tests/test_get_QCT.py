@@ -0,0 +1,132 @@
+# ##############################################################################
+# test_get_QCT.py
+# get_QCT.py outputs vs the baseline per-metric scripts
+# ##############################################################################
+# 20221018, In Kyu Lee
+#  - Each mode (crop: default, slab, voxels, packed, store) with each
+#    backend (QCT_BACKEND=numpy, numba) on the synthetic subject.
+#  - Stats: same rows & columns, values within the float16 of the baseline.
+#  - Images: same dtype (but S*), values and Analyze header.
+# ##############################################################################
+import os
+import importlib.util
+import numpy as np
+import pandas as pd
+import pytest
+from medpy.io import load
+from conftest import QCT, Subj, I1, I2, run
+import get_QCT
+import qct_io
+import qct_store
+
+# metrics of the baseline scripts (conftest.BASELINE_RUNS)
+METRICS = ('AirT', 'Emph_fSAD', 'HAA', 'RRAVC', 's_norm')
+# S* is float32 (it was float64), see qct_metrics.py
+DTYPE = {'s_norm': np.dtype('float32')}
+MODES = {'crop': [],
+         'slab': ['--slab', '4'],
+         'voxels': ['--voxels'],
+         'packed': ['--slab', '4', '--packed'],
+         'store': ['--slab', '4', '--store', 'store']}
+BACKENDS = [pytest.param('numpy'),
+            pytest.param('numba', marks=pytest.mark.skipif(
+                importlib.util.find_spec('numba') is None, reason='numba is not installed'))]
+
+
+def get_qct(folder, args, backend='numpy'):
+    env = dict(os.environ, QCT_BACKEND=backend)
+    return run([os.path.join(QCT, 'get_QCT.py'), Subj, I1, I2] + args, folder, env)
+
+
+def paths(folder, args):
+    store = os.path.join(folder, 'store') if '--store' in args else None
+    return get_QCT.Step16Paths(Subj, I1, I2, folder, packed='--packed' in args, store=store)
+
+
+def load_output(path):
+    if path.endswith(qct_io.LABEL_EXT):
+        return qct_io.load_packed(path)[0]
+    if path.endswith(qct_store.STORE_EXT):
+        return qct_store.load(path)[0]
+    return load(path)[0]
+
+
+def read_hdr(path):
+    with open(path[:-4] + '.hdr', 'rb') as f:
+        return f.read()
+
+
+def assert_same_stat(ref_path, path):
+    ref = pd.read_csv(ref_path, sep=' ')
+    new = pd.read_csv(path, sep=' ')
+    assert list(new.columns) == list(ref.columns)
+    assert list(new.iloc[:, 0]) == list(ref.iloc[:, 0])
+    for c in ref.columns[1:]:
+        # the baseline ratios are float16
+        np.testing.assert_allclose(new[c].astype(float), ref[c].astype(float),
+                                   rtol=2e-3, err_msg=f'{os.path.basename(path)} {c}')
+
+
+def assert_same_outputs(baseline, folder, args):
+    ref_P = paths(baseline, [])
+    P = paths(folder, args)
+    for metric in METRICS:
+        ref_img, ref_stat = ref_P.outputs[metric]
+        img, stat = P.outputs[metric]
+        assert_same_stat(ref_stat, stat)
+        ref, new = load_output(ref_img), load_output(img)
+        assert new.dtype == DTYPE.get(metric, ref.dtype), metric
+        assert new.shape == ref.shape, metric
+        np.testing.assert_allclose(new, ref, rtol=1e-5, atol=1e-6, err_msg=metric)
+        if img.endswith('.img') and metric not in DTYPE:
+            assert read_hdr(img) == read_hdr(ref_img), metric
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('mode', MODES)
+def test_baseline(baseline, subject, mode, backend):
+    get_qct(subject, MODES[mode], backend)
+    assert_same_outputs(baseline, subject, MODES[mode])
+
+
+def test_threads(baseline, subject):
+    get_qct(subject, ['--slab', '4', '--threads', '3'])
+    assert_same_outputs(baseline, subject, [])
+
+
+# a rerun skips the metrics whose inputs, parameters & outputs are unchanged
+def test_rerun(baseline, subject):
+    get_qct(subject, [])
+    P = paths(subject, [])
+    mtime = {m: os.stat(P.outputs[m][1]).st_mtime_ns for m in METRICS}
+    out = get_qct(subject, [])
+    assert 'Unchanged' in out
+    assert {m: os.stat(P.outputs[m][1]).st_mtime_ns for m in METRICS} == mtime
+    # new AirT threshold: AirT only
+    get_qct(subject, ['--airt', '-900'])
+    changed = {m for m in METRICS if os.stat(P.outputs[m][1]).st_mtime_ns != mtime[m]}
+    assert changed == {'AirT'}
+    # missing output: that metric only
+    os.remove(P.RRAVC_img)
+    get_qct(subject, ['--airt', '-900'])
+    assert os.path.exists(P.RRAVC_img)
+    assert os.stat(P.s_norm_stat).st_mtime_ns == mtime['s_norm']
+    # --force: everything, same outputs as the baseline
+    get_qct(subject, ['--force'])
+    assert_same_outputs(baseline, subject, [])
+
+
+# --triage 1: every voxel, the ratios of the baseline; nothing else is written
+def test_triage(baseline, subject):
+    before = set(os.listdir(subject))
+    get_qct(subject, ['--triage', '1'])
+    P = paths(subject, [])
+    assert set(os.listdir(subject)) - before == {os.path.basename(P.triage)}
+    table = pd.read_csv(P.triage, sep=' ')
+    ref_P = paths(baseline, [])
+    for metric, stat, column in (('AirT', ref_P.AirT_stat, 'airtrapratio'),
+                                 ('Emph', ref_P.Emph_fSAD_stat, 'Emphysratio'),
+                                 ('fSAD', ref_P.Emph_fSAD_stat, 'fSADratio')):
+        ref = pd.read_csv(stat, sep=' ')[column].to_numpy(dtype=float)
+        value = table.loc[table.Metric == metric, 'value'].to_numpy()
+        np.testing.assert_allclose(value, ref, rtol=2e-3, err_msg=metric)
@@ -0,0 +1,130 @@
+# ##############################################################################
+# test_lobar.py
+# lobar counts, ROI and histograms vs direct numpy on the voxels
+# ##############################################################################
+import numpy as np
+import pytest
+from conftest import SHAPE, lobes
+import lobar
+
+
+@pytest.fixture
+def images():
+    rng = np.random.default_rng(1)
+    lobe = lobes(SHAPE)
+    # a label that is not a lobe
+    lobe[0, 0, 0] = 3
+    IN = rng.integers(-1200, 200, SHAPE).astype(np.int16)
+    warp = rng.integers(-1200, 200, SHAPE).astype(np.int16)
+    return IN, warp, lobe
+
+
+# several slabs on several threads
+@pytest.fixture(params=[1, 3])
+def slabs(request, monkeypatch):
+    monkeypatch.setattr(lobar, 'CHUNK', SHAPE[0]*SHAPE[1]*5)
+    monkeypatch.setattr(lobar, 'THREADS', request.param)
+
+
+def test_lobe_index():
+    lobe = np.array([0, 8, 16, 32, 64, 128, 3, 255], dtype=np.uint8)
+    np.testing.assert_array_equal(lobar.lobe_index(lobe), [0, 1, 2, 3, 4, 5, 6, 6])
+    # wider integer masks: out of range is "other"
+    np.testing.assert_array_equal(lobar.lobe_index(np.array([0, 8, 264, -1])), [0, 1, 6, 6])
+
+
+def test_map_slabs(slabs):
+    shape = (4, 3, 23)
+    z = [sl[-1] for sl, _ in lobar.map_slabs(lambda sl: None, shape, chunk=4*3*5)]
+    assert [(s.start, s.stop) for s in z] == [(0, 5), (5, 10), (10, 15), (15, 20), (20, 23)]
+
+
+def test_lobar_count(images, slabs):
+    IN, _, lobe = images
+    classes = (IN < -856).astype(np.uint8)
+    counts = lobar.lobar_count(lobe, classes, 2)
+    for k, label in enumerate(lobar.LOBES, 1):
+        assert counts[k, 0] + counts[k, 1] == np.sum(lobe == label)
+        assert counts[k, 1] == np.sum((lobe == label) & (IN < -856))
+    assert counts[lobar.OTHER].sum() == 1
+
+
+def test_lobar_moments(images, slabs):
+    IN, _, lobe = images
+    values = IN.astype(np.float32) / 1000
+    m, sd, cv = lobar.lobar_m_sd_cv(lobar.lobar_moments(lobe, values))
+    for k, label in enumerate(lobar.LOBES):
+        v = values[lobe == label].astype(np.float64)
+        assert m[k] == pytest.approx(v.mean())
+        assert sd[k] == pytest.approx(v.std())
+        assert cv[k] == pytest.approx(v.std() / v.mean())
+    assert m[5] == pytest.approx(np.mean(m[:5]))
+    assert sd[5] == pytest.approx(values[lobe != 0].astype(np.float64).std())
+
+
+def test_bbox_paste(images, slabs):
+    IN, _, lobe = images
+    lobe[0, 0, 0] = 0
+    roi = lobar.lobe_bbox(lobe)
+    x, y, z = np.nonzero(lobe)
+    assert roi == (slice(x.min(), x.max()+1), slice(y.min(), y.max()+1), slice(z.min(), z.max()+1))
+    assert lobar.lobe_bbox(lobe, margin=100) == (slice(0, SHAPE[0]), slice(0, SHAPE[1]), slice(0, SHAPE[2]))
+    assert lobar.lobe_bbox(np.zeros(SHAPE, np.uint8)) == (slice(None),)*3
+    full = lobar.paste(IN[roi], roi, IN.shape, fill=-1024)
+    np.testing.assert_array_equal(full[roi], IN[roi])
+    outside = np.ones(SHAPE, dtype=bool)
+    outside[roi] = False
+    assert np.all(full[outside] == -1024)
+
+
+def test_lobar_histogram(images, slabs):
+    IN, _, lobe = images
+    hist = lobar.LobarHistogram.from_image(IN, lobe)
+    for k, label in enumerate(lobar.LOBES, 1):
+        v = IN[lobe == label]
+        assert hist.voxels[k] == v.size
+        assert hist.count_below(-856)[k] == np.sum(v < -856)
+        assert hist.count_between(-700, 0)[k] == np.sum((-700 <= v) & (v <= 0))
+    lung = np.isin(lobe, lobar.LOBES)
+    for p in (10, 50, 90):
+        assert hist.percentile(p)[5] == pytest.approx(np.percentile(IN[lung], p))
+    assert hist.mean()[5] == pytest.approx(IN[lung].mean())
+    ratio = hist.fraction_below(-950)
+    assert ratio[5] == pytest.approx(np.sum(IN[lung] < -950) / lung.sum())
+
+
+def test_joint_histogram(images, slabs):
+    IN, warp, lobe = images
+    joint = lobar.JointHistogram.from_images(IN, warp, lobe)
+    for e, f in ((-950, -856), (-1000, -600), (-910, -910)):
+        emph, fsad, normal = joint.count_prm(e, f)
+        for k, label in enumerate(lobar.LOBES, 1):
+            l = lobe == label
+            assert emph[k] == np.sum(l & (IN < e))
+            assert fsad[k] == np.sum(l & (IN >= e) & (warp < f))
+            assert normal[k] == np.sum(l) - emph[k] - fsad[k]
+    with pytest.raises(ValueError):
+        joint.count_prm(-1200, -856)
+    # sparse round-trip (cache)
+    back = lobar.JointHistogram.from_sparse(*joint.sparse(), joint.hu_range)
+    np.testing.assert_array_equal(back.hist, joint.hist)
+
+
+def test_hist_cache(images, tmp_path):
+    IN, warp, lobe = images
+    sources = {name: [str(tmp_path / f'{name}.img')] for name in ('IN', 'joint')}
+    for paths in sources.values():
+        open(paths[0], 'wb').close()
+    hists = {'IN': lobar.LobarHistogram.from_image(IN, lobe),
+             'joint': lobar.JointHistogram.from_images(IN, warp, lobe)}
+    path = str(tmp_path / 'hist.npz')
+    lobar.save_hist_cache(path, hists, sources)
+    cached = lobar.load_hist_cache(path, sources)
+    np.testing.assert_array_equal(cached['IN'].cum[:, -1], hists['IN'].cum[:, -1])
+    assert cached['IN'].count_below(-856).tolist() == hists['IN'].count_below(-856).tolist()
+    assert cached['IN'].percentile(50).tolist() == hists['IN'].percentile(50).tolist()
+    np.testing.assert_array_equal(cached['joint'].hist, hists['joint'].hist)
+    # a changed source drops its histogram only
+    with open(sources['IN'][0], 'wb') as f:
+        f.write(b'x')
+    assert set(lobar.load_hist_cache(path, sources)) == {'joint'}
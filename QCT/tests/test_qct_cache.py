@@ -0,0 +1,158 @@
+# ##############################################################################
+# test_qct_cache.py
+# Manifest invalidation & sidecar cache stamps
+# ##############################################################################
+import os
+import numpy as np
+import pytest
+import qct_cache
+
+PARAMS = {'threshold': -856}
+
+
+@pytest.fixture
+def files(tmp_path):
+    inputs = [str(tmp_path / 'a.img'), str(tmp_path / 'b.img')]
+    outputs = [str(tmp_path / 'out.img'), str(tmp_path / 'out.txt')]
+    for path, data in zip(inputs + outputs, (b'aaaa', b'bbbbbb', b'o', b't')):
+        with open(path, 'wb') as f:
+            f.write(data)
+    return inputs, outputs
+
+
+def manifest(tmp_path, version='v1', hash=False):
+    return qct_cache.Manifest(str(tmp_path / 'manifest.json'), version, hash)
+
+
+# same size, new mtime
+def touch(path, data=None):
+    if data is not None:
+        with open(path, 'wb') as f:
+            f.write(data)
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+
+@pytest.mark.parametrize('hash', [False, True])
+def test_current(tmp_path, files, hash):
+    inputs, outputs = files
+    assert not manifest(tmp_path, hash=hash).is_current('AirT', inputs, PARAMS, outputs)
+    manifest(tmp_path, hash=hash).update('AirT', inputs, PARAMS, outputs)
+    # reloaded from the json
+    m = manifest(tmp_path, hash=hash)
+    assert m.is_current('AirT', inputs, PARAMS, outputs)
+    assert not m.is_current('HAA', inputs, PARAMS, outputs)
+
+
+@pytest.mark.parametrize('hash', [False, True])
+def test_input_change(tmp_path, files, hash):
+    inputs, outputs = files
+    manifest(tmp_path, hash=hash).update('AirT', inputs, PARAMS, outputs)
+    with open(inputs[0], 'wb') as f:
+        f.write(b'new content')
+    assert not manifest(tmp_path, hash=hash).is_current('AirT', inputs, PARAMS, outputs)
+    # same size, different content
+    manifest(tmp_path, hash=hash).update('AirT', inputs, PARAMS, outputs)
+    touch(inputs[1], b'BBBBBB')
+    assert not manifest(tmp_path, hash=hash).is_current('AirT', inputs, PARAMS, outputs)
+    # other inputs
+    assert not manifest(tmp_path, hash=hash).is_current('AirT', inputs[:1], PARAMS, outputs)
+
+
+# only the mtime changed (ex. copied): stale by stamp, current by sha1
+@pytest.mark.parametrize('hash', [False, True])
+def test_mtime_change(tmp_path, files, hash):
+    inputs, outputs = files
+    manifest(tmp_path, hash=hash).update('AirT', inputs, PARAMS, outputs)
+    touch(inputs[0])
+    m = manifest(tmp_path, hash=hash)
+    assert m.is_current('AirT', inputs, PARAMS, outputs) == hash
+    if hash:
+        # the new stamp is recorded, and not hashed again
+        m = manifest(tmp_path, hash=hash)
+        m.file_hash = None
+        assert m.is_current('AirT', inputs, PARAMS, outputs)
+
+
+def test_param_change(tmp_path, files):
+    inputs, outputs = files
+    manifest(tmp_path).update('HAA', inputs, {'l_threshold': -700, 'u_threshold': 0}, outputs)
+    m = manifest(tmp_path)
+    assert m.is_current('HAA', inputs, {'l_threshold': -700, 'u_threshold': 0}, outputs)
+    assert not m.is_current('HAA', inputs, {'l_threshold': -700, 'u_threshold': 100}, outputs)
+    assert not m.is_current('HAA', inputs, {'l_threshold': -700}, outputs)
+    # tuples are stored as json lists
+    m.update('HAA', inputs, {'HAA_threshold': (-700, 0)}, outputs)
+    assert manifest(tmp_path).is_current('HAA', inputs, {'HAA_threshold': (-700, 0)}, outputs)
+
+
+def test_version_change(tmp_path, files):
+    inputs, outputs = files
+    manifest(tmp_path, 'v1').update('AirT', inputs, PARAMS, outputs)
+    assert manifest(tmp_path, 'v1').is_current('AirT', inputs, PARAMS, outputs)
+    assert not manifest(tmp_path, 'v2').is_current('AirT', inputs, PARAMS, outputs)
+
+
+def test_output_change(tmp_path, files):
+    inputs, outputs = files
+    manifest(tmp_path).update('AirT', inputs, PARAMS, outputs)
+    os.remove(outputs[0])
+    assert not manifest(tmp_path).is_current('AirT', inputs, PARAMS, outputs)
+    # other output names (ex. --packed)
+    assert not manifest(tmp_path).is_current('AirT', inputs, PARAMS, outputs[1:])
+
+
+def test_missing_input(tmp_path, files):
+    inputs, outputs = files
+    manifest(tmp_path, hash=True).update('AirT', inputs, PARAMS, outputs)
+    os.remove(inputs[1])
+    assert not manifest(tmp_path, hash=True).is_current('AirT', inputs, PARAMS, outputs)
+
+
+# the sha1 of an input is computed once per stamp
+def test_hash_once(tmp_path, files, monkeypatch):
+    inputs, outputs = files
+    calls = []
+    file_hash = qct_cache.file_hash
+    monkeypatch.setattr(qct_cache, 'file_hash', lambda p: calls.append(p) or file_hash(p))
+    m = manifest(tmp_path, hash=True)
+    m.update('AirT', inputs, PARAMS, outputs)
+    m.update('HAA', inputs, PARAMS, outputs)
+    assert sorted(calls) == sorted(inputs)
+    # unchanged inputs of a stored manifest are not hashed
+    calls.clear()
+    assert manifest(tmp_path, hash=True).is_current('AirT', inputs, PARAMS, outputs)
+    assert calls == []
+
+
+def test_corrupt_manifest(tmp_path, files):
+    inputs, outputs = files
+    with open(tmp_path / 'manifest.json', 'w') as f:
+        f.write('{"AirT": ')
+    m = manifest(tmp_path)
+    assert not m.is_current('AirT', inputs, PARAMS, outputs)
+    m.update('AirT', inputs, PARAMS, outputs)
+    assert manifest(tmp_path).is_current('AirT', inputs, PARAMS, outputs)
+
+
+def test_is_fresh(tmp_path, files):
+    inputs, _ = files
+    stored = np.str_(qct_cache.stamp(inputs))
+    assert qct_cache.is_fresh(stored, inputs)
+    touch(inputs[0])
+    assert not qct_cache.is_fresh(stored, inputs)
+    os.remove(inputs[1])
+    assert not qct_cache.is_fresh(stored, inputs)
+
+
+def test_npz(tmp_path):
+    path = str(tmp_path / 'cache.npz')
+    assert qct_cache.load_npz(path) == {}
+    qct_cache.save_npz(path, a=np.arange(5), s=np.str_('x'))
+    cache = qct_cache.load_npz(path)
+    np.testing.assert_array_equal(cache['a'], np.arange(5))
+    assert str(cache['s']) == 'x'
+    # a broken file is an empty cache
+    with open(path, 'wb') as f:
+        f.write(b'not a zip')
+    assert qct_cache.load_npz(path) == {}
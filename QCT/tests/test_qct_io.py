@@ -0,0 +1,118 @@
+# ##############################################################################
+# test_qct_io.py
+# qct_io loaders & writers vs medpy.io
+# ##############################################################################
+import os
+import shutil
+import numpy as np
+import pytest
+from medpy.io import load, save
+from conftest import Subj, I1, I2
+import lobar
+import qct_io
+
+IN = f'{Subj}_{I1}.img.gz'
+EX_lobe = f'{Subj}_{I2}_vida-lobes.img'
+disp = f'{Subj}_{I2}-TO-{Subj}_{I1}-SSTVD_disp_resample.mhd'
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+# .img & .mhd: read-only memmaps of the same data & header
+@pytest.mark.parametrize('name', [EX_lobe, disp])
+def test_memmap(subject, name):
+    path = os.path.join(subject, name)
+    ref, ref_hdr = load(path)
+    img, hdr = qct_io.load(path)
+    assert isinstance(img.base if img.base is not None else img, np.memmap)
+    assert not img.flags.writeable
+    np.testing.assert_array_equal(img, ref)
+    assert img.dtype == ref.dtype
+    assert hdr.get_voxel_spacing() == ref_hdr.get_voxel_spacing()
+
+
+@pytest.mark.parametrize('backend', ['zlib', 'pigz', 'isal'])
+def test_gz_backends(subject, monkeypatch, backend):
+    if backend == 'pigz' and shutil.which('pigz') is None:
+        pytest.skip('pigz is not installed')
+    if backend == 'isal' and qct_io.igzip_threaded is None:
+        pytest.skip('python-isal is not installed')
+    monkeypatch.setattr(qct_io, 'gz_backend', lambda: backend)
+    path = os.path.join(subject, IN)
+    ref, ref_hdr = load(path)
+    img, hdr = qct_io.load(path)
+    np.testing.assert_array_equal(img, ref)
+    assert img.dtype == ref.dtype
+    assert hdr.get_voxel_spacing() == ref_hdr.get_voxel_spacing()
+    # slab access: decompressed to a raw file & memory-mapped
+    img = qct_io.open_volume(path, subject)[0]
+    np.testing.assert_array_equal(img, ref)
+
+
+@pytest.mark.parametrize('name', [IN, EX_lobe])
+@pytest.mark.parametrize('step', [1, 2, 3, 5])
+def test_load_strided(subject, name, step):
+    path = os.path.join(subject, name)
+    ref, _ = load(path)
+    img, _ = qct_io.load_strided(path, step)
+    np.testing.assert_array_equal(img, ref[::step, ::step, ::step])
+
+
+# SlabWriter: the same .hdr/.img as medpy.io.save, with & without roi
+@pytest.mark.parametrize('crop', [False, True])
+def test_slab_writer(subject, tmp_path, crop):
+    img, hdr = load(os.path.join(subject, IN))
+    lobe, _ = load(os.path.join(subject, EX_lobe))
+    ref_path = str(tmp_path / 'ref.img')
+    save(img, ref_path, hdr=hdr)
+    roi = lobar.lobe_bbox(lobe) if crop else (slice(None),)*3
+    fill = -1000 if crop else 0
+    full = lobar.paste(img[roi], roi, img.shape, fill)
+    path = str(tmp_path / 'slab.img')
+    writer = qct_io.SlabWriter(path, img.shape, hdr, roi=roi if crop else None, fill=fill)
+    nz = img[roi].shape[2]
+    for z in range(0, nz, 4):
+        writer[:, :, z:min(z+4, nz)] = img[roi][:, :, z:z+4]
+    writer.close()
+    if not crop:
+        assert read(path) == read(ref_path)
+    assert read(path[:-4] + '.hdr') == read(ref_path[:-4] + '.hdr')
+    np.testing.assert_array_equal(load(path)[0], full)
+
+
+# .lbl.npz: the very same .hdr/.img as medpy.io.save after unpack_labels
+@pytest.mark.parametrize('nbits', [1, 2, 3])
+def test_packed(subject, tmp_path, nbits):
+    _, hdr = load(os.path.join(subject, IN))
+    lobe, _ = load(os.path.join(subject, EX_lobe))
+    rng = np.random.default_rng(nbits)
+    labels = rng.integers(0, 1 << nbits, lobe.shape).astype(np.uint8)
+    labels[lobe == 0] = 0
+    path = str(tmp_path / f'label{qct_io.LABEL_EXT}')
+    qct_io.save_packed(labels, path, hdr)
+    img, packed_hdr = qct_io.load_packed(path)
+    np.testing.assert_array_equal(img, labels)
+    assert packed_hdr.get_voxel_spacing() == hdr.get_voxel_spacing()
+    ref_path = str(tmp_path / 'ref.img')
+    save(labels, ref_path, hdr=hdr)
+    qct_io.unpack_labels(path, str(tmp_path / 'label.img'))
+    assert read(str(tmp_path / 'label.img')) == read(ref_path)
+    assert read(str(tmp_path / 'label.hdr')) == read(str(tmp_path / 'ref.hdr'))
+    # slab by slab, cropped
+    roi = lobar.lobe_bbox(lobe)
+    path = str(tmp_path / f'slab{qct_io.LABEL_EXT}')
+    writer = qct_io.PackedWriter(path, labels.shape, hdr, nbits, roi)
+    crop = labels[roi]
+    for z in range(0, crop.shape[2], 5):
+        writer[:, :, z:z+5] = crop[:, :, z:z+5]
+    writer.close()
+    np.testing.assert_array_equal(qct_io.load_packed(path)[0], labels)
+
+
+def test_packed_overflow(tmp_path):
+    writer = qct_io.PackedWriter(str(tmp_path / f'x{qct_io.LABEL_EXT}'), (4, 4, 2), None, nbits=1)
+    with pytest.raises(ValueError):
+        writer[:, :, 0:2] = np.full((4, 4, 2), 2, dtype=np.uint8)
@@ -0,0 +1,114 @@
+# ##############################################################################
+# test_qct_kernels.py
+# Numba kernels vs the NumPy (reference) kernels, QCT_BACKEND
+# ##############################################################################
+import os
+import sys
+import subprocess
+import numpy as np
+import pytest
+from conftest import QCT, SHAPE, lobes
+import qct_kernels
+
+numba_only = pytest.mark.skipif(qct_kernels.numba is None, reason='numba is not installed')
+
+
+@pytest.fixture
+def images():
+    rng = np.random.default_rng(2)
+    lobe = lobes(SHAPE)
+    lobe[0, 0, 0] = 3
+    IN = rng.integers(-1200, 200, SHAPE).astype(np.int16)
+    warp = rng.integers(-1200, 200, SHAPE).astype(np.int16)
+    airdiff = rng.random(SHAPE, dtype=np.float32) * 0.3
+    fixed = rng.random(SHAPE, dtype=np.float32) * 0.28
+    fixed[0, 0, :] = 0
+    airdiff[0, 0, :2] = 0
+    disp = (rng.standard_normal(SHAPE + (3,)) * 3).astype(np.float32)
+    return IN, warp, lobe, airdiff, fixed, disp
+
+
+# fn(*args) with each backend
+def both(monkeypatch, fn, *args):
+    out = []
+    for backend in ('numpy', 'numba'):
+        monkeypatch.setattr(qct_kernels, 'BACKEND', backend)
+        out.append(fn(*args))
+    return out
+
+
+@numba_only
+@pytest.mark.parametrize('kernel, args', [
+    ('below', (-856,)), ('between', (-700, 0)), ('between', (-700.5, 0.5))])
+def test_classify(images, monkeypatch, kernel, args):
+    IN, _, lobe, *_ = images
+    (ref, ref_counts), (label, counts) = both(monkeypatch, getattr(qct_kernels, kernel),
+                                              IN, lobe, *args)
+    np.testing.assert_array_equal(label, ref)
+    np.testing.assert_array_equal(counts, ref_counts)
+
+
+@numba_only
+@pytest.mark.parametrize('with_warp', [True, False])
+def test_emph_fsad(images, monkeypatch, with_warp):
+    IN, warp, lobe, *_ = images
+    (ref, ref_counts), (label, counts) = both(
+        monkeypatch, qct_kernels.emph_fsad, IN, lobe, warp if with_warp else None, -950,
+        -856 if with_warp else None)
+    np.testing.assert_array_equal(label, ref)
+    np.testing.assert_array_equal(counts, ref_counts)
+
+
+@numba_only
+@pytest.mark.parametrize('voxel_volume', [None, 0.288])
+def test_rravc(images, monkeypatch, voxel_volume):
+    _, _, lobe, airdiff, fixed, _ = images
+    den = np.sum(airdiff) / np.sum(fixed)
+    outs = [np.empty(SHAPE, dtype=np.float32) for _ in range(2)]
+    moments = []
+    for backend, out in zip(('numpy', 'numba'), outs):
+        monkeypatch.setattr(qct_kernels, 'BACKEND', backend)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            moments.append(qct_kernels.rravc(airdiff, fixed, lobe, den, voxel_volume, out))
+    np.testing.assert_array_equal(outs[1], outs[0])
+    np.testing.assert_allclose(moments[1], moments[0], rtol=1e-9)
+
+
+@numba_only
+def test_s_norm(images, monkeypatch):
+    *_, lobe, _, _, disp = images
+    V_norm = np.float64(5000.0/2500.0) ** (1/3)
+    outs = [np.empty(SHAPE, dtype=np.float32) for _ in range(2)]
+    moments = []
+    for backend, out in zip(('numpy', 'numba'), outs):
+        monkeypatch.setattr(qct_kernels, 'BACKEND', backend)
+        moments.append(qct_kernels.s_norm(disp, lobe, V_norm, out))
+    # up to the last bit of float32 hypot
+    np.testing.assert_allclose(outs[1], outs[0], rtol=2e-7)
+    np.testing.assert_allclose(moments[1], moments[0], rtol=1e-6)
+
+
+# 1D voxel tables (--voxels) as slabs
+@numba_only
+def test_voxels(images, monkeypatch):
+    IN, _, lobe, *_ = images
+    lung = np.flatnonzero(lobe.ravel(order='F'))
+    values, labels = IN.ravel(order='F')[lung], lobe.ravel(order='F')[lung]
+    (ref, ref_counts), (label, counts) = both(monkeypatch, qct_kernels.below, values, labels, -856)
+    np.testing.assert_array_equal(label.ravel(), ref)
+    np.testing.assert_array_equal(counts, ref_counts)
+
+
+@pytest.mark.parametrize('backend, error', [('numpy', None), ('numba', None), ('fast', 'ValueError')])
+def test_backend_env(backend, error):
+    if backend == 'numba' and qct_kernels.numba is None:
+        error = 'ImportError'
+    proc = subprocess.run([sys.executable, '-c', 'import qct_kernels; print(qct_kernels.BACKEND)'],
+                          cwd=QCT, env=dict(os.environ, QCT_BACKEND=backend),
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if error is None:
+        assert proc.returncode == 0, proc.stderr
+        assert proc.stdout.strip() == backend
+    else:
+        assert proc.returncode != 0
+        assert error in proc.stderr
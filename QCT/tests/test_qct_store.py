@@ -0,0 +1,91 @@
+# ##############################################################################
+# test_qct_store.py
+# qct_store round-trip: save / StoreWriter -> StoreArray, load, export
+# ##############################################################################
+import os
+import numpy as np
+import pytest
+from medpy.io import load, save
+from conftest import Subj, I1, I2
+import lobar
+import qct_store
+
+IN = f'{Subj}_{I1}.img.gz'
+EX_lobe = f'{Subj}_{I2}_vida-lobes.img'
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def image(subject):
+    img, hdr = load(os.path.join(subject, IN))
+    return img.astype(np.float32) / 7, hdr
+
+
+def test_array_path(tmp_path):
+    root = qct_store.store_root(str(tmp_path), 'ENV18PM')
+    path = qct_store.array_path(root, Subj, I1, I2, 'AirT')
+    assert path == os.path.join(str(tmp_path), 'store_ENV18PM', Subj, f'{I2}-TO-{I1}',
+                                'AirT' + qct_store.STORE_EXT)
+
+
+@pytest.mark.parametrize('nz', [1, 5, 16, 100])
+def test_round_trip(image, tmp_path, nz):
+    img, hdr = image
+    path = str(tmp_path / f'a{qct_store.STORE_EXT}')
+    qct_store.save(img, path, hdr, nz=nz)
+    a = qct_store.StoreArray(path)
+    assert a.shape == img.shape and a.dtype == img.dtype
+    np.testing.assert_array_equal(a[:, :, :], img)
+    for key in [(slice(None), slice(None), slice(3, 11)), (slice(None), slice(None), 7),
+                (slice(2, 9), 4, slice(1, None, 3)), (slice(None), slice(None), slice(-4, None)),
+                (slice(None), slice(None), slice(5, 5))]:
+        np.testing.assert_array_equal(a[key], img[key])
+    loaded, loaded_hdr = qct_store.load(path)
+    np.testing.assert_array_equal(loaded, img)
+    assert loaded_hdr.get_voxel_spacing() == hdr.get_voxel_spacing()
+    # export: the same .hdr/.img as medpy.io.save
+    ref_path = str(tmp_path / 'ref.img')
+    save(img, ref_path, hdr=hdr)
+    qct_store.export(path, str(tmp_path / 'export.img'))
+    assert read(str(tmp_path / 'export.img')) == read(ref_path)
+    assert read(str(tmp_path / 'export.hdr')) == read(str(tmp_path / 'ref.hdr'))
+
+
+# cropped slabs: chunks that are all fill are not stored, and read as fill
+def test_writer_roi(image, subject, tmp_path):
+    img, hdr = image
+    lobe, _ = load(os.path.join(subject, EX_lobe))
+    roi = lobar.lobe_bbox(lobe)
+    full = lobar.paste(img[roi], roi, img.shape, fill=-100)
+    path = str(tmp_path / f'a{qct_store.STORE_EXT}')
+    writer = qct_store.StoreWriter(path, img.shape, hdr, 'float32', roi, fill=-100, nz=2)
+    crop = img[roi]
+    for z in range(0, crop.shape[2], 3):
+        writer[:, :, z:z+3] = crop[:, :, z:z+3]
+    writer.close()
+    np.testing.assert_array_equal(qct_store.StoreArray(path)[:, :, :], full)
+    assert not os.path.exists(os.path.join(path, '0.zlib'))
+    # rewrite replaces the image, no temporary folder is left
+    qct_store.save(img, path, hdr)
+    np.testing.assert_array_equal(qct_store.load(path)[0], img)
+    assert sorted(os.listdir(tmp_path)) == [f'a{qct_store.STORE_EXT}', 'subject']
+
+
+def test_list_arrays(image, tmp_path):
+    img, hdr = image
+    root = qct_store.store_root(str(tmp_path), 'ENV18PM')
+    for name in ('AirT', 'RRAVC'):
+        path = qct_store.array_path(root, Subj, I1, I2, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        qct_store.save(img, path, hdr)
+    assert [a[:4] for a in qct_store.list_arrays(root)] == [
+        (Subj, I1, I2, 'AirT'), (Subj, I1, I2, 'RRAVC')]
+
+
+def test_incomplete(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        qct_store.StoreArray(str(tmp_path / f'a{qct_store.STORE_EXT}'))
@@ -0,0 +1,84 @@
+# ##############################################################################
+# test_qct_triage.py
+# Triage with every voxel sampled is exact, intervals cover the exact ratio
+# ##############################################################################
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from medpy.io import load
+from conftest import Subj, I1, I2
+import lobar
+import qct_triage
+
+pair = f'{Subj}_{I2}-TO-{Subj}_{I1}-SSTVD'
+
+
+@pytest.fixture(scope='module')
+def images(subject_base):
+    names = {'IN_img': f'{Subj}_{I1}.img.gz', 'IN_lobe_img': f'{Subj}_{I1}_vida-lobes.img.gz',
+             'EX_img': f'{Subj}_{I2}.img.gz', 'EX_lobe_img': f'{Subj}_{I2}_vida-lobes.img',
+             'warp_img': f'{pair}.img.gz', 'airdiff_img': f'{pair}_airDiff.img',
+             'av_fixed_img': f'{pair}_fixed_airVol.img.gz'}
+    return {k: load(os.path.join(subject_base, v))[0] for k, v in names.items()}
+
+
+# Lobe0-Lobe4 & total ratio of mask within the lobes
+def exact(lobe, mask):
+    k = [np.sum((lobe == l) & mask) for l in lobar.LOBES]
+    n = [np.sum(lobe == l) for l in lobar.LOBES]
+    return np.array(k + [sum(k)]) / np.array(n + [sum(n)])
+
+
+def values(table, metric):
+    return table.loc[table.Metric == metric, 'value'].to_numpy()
+
+
+def test_grid_step():
+    assert [qct_triage.grid_step(f) for f in (1, 0.125, 0.01, 0.001)] == [1, 2, 5, 10]
+
+
+def test_all_voxels(images):
+    table = qct_triage.get_triage(**images, fraction=1)
+    IN, warp, lobe = images['IN_img'], images['warp_img'], images['IN_lobe_img']
+    EX, EX_lobe = images['EX_img'], images['EX_lobe_img']
+    np.testing.assert_allclose(values(table, 'AirT'), exact(EX_lobe, EX < -856))
+    np.testing.assert_allclose(values(table, 'Emph'), exact(lobe, IN < -950))
+    np.testing.assert_allclose(values(table, 'fSAD'), exact(lobe, (IN >= -950) & (warp < -856)))
+    np.testing.assert_allclose(values(table, 'HAA'), exact(lobe, (-700 <= IN) & (IN <= 0)))
+    assert (table.n_sample == table.n_lobe).all()
+    assert (table.ci_low <= table.value).all() and (table.value <= table.ci_high).all()
+
+
+@pytest.mark.parametrize('mode', qct_triage.MODES)
+def test_sample(images, mode):
+    table = qct_triage.get_triage(**images, fraction=0.1, mode=mode, seed=1)
+    exact_table = qct_triage.get_triage(**images, fraction=1)
+    assert list(table.Metric) == list(exact_table.Metric)
+    assert list(table.Lobes) == list(exact_table.Lobes)
+    assert (table.n_lobe == exact_table.n_lobe).all()
+    # grid step 2: 1/8 of the voxels, random: 1/10
+    assert table.fraction.between(0.05, 0.2).all()
+    assert (table.ci_low <= table.value).all() and (table.value <= table.ci_high).all()
+    # the same sample for the same seed
+    pd.testing.assert_frame_equal(
+        table, qct_triage.get_triage(**images, fraction=0.1, mode=mode, seed=1))
+
+
+# grid sample of the strided images (get_QCT.py --triage) = grid sample of
+# the full images, but the RRAVC denominator (from the strided images)
+def test_strided(images):
+    s = qct_triage.grid_step(0.01)
+    strided = {k: v[::s, ::s, ::s] for k, v in images.items()}
+    counts = (lobar.lobar_count(images['IN_lobe_img'])[:, 0],
+              lobar.lobar_count(images['EX_lobe_img'])[:, 0])
+    table = qct_triage.get_triage(**strided, fraction=1, lobe_counts=counts)
+    ref = qct_triage.get_triage(**images, fraction=0.01)
+    ratio = ref.Metric != 'RRAVC'
+    pd.testing.assert_frame_equal(table[ratio], ref[ratio])
+
+
+def test_wilson():
+    low, high = qct_triage.wilson(np.array([0, 5, 10]), np.array([10, 10, 10]))
+    assert low[0] == 0 and high[2] == pytest.approx(1)
+    assert (low < np.array([0, 0.5, 1]) + 1e-12).all() and (np.array([0, 0.5, 1]) < high + 1e-12).all()
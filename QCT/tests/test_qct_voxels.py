@@ -0,0 +1,80 @@
+# ##############################################################################
+# test_qct_voxels.py
+# Lung voxel tables & lobe index vs the images
+# ##############################################################################
+import os
+import numpy as np
+import pytest
+from medpy.io import load
+from conftest import SHAPE, Subj, I1
+import lobar
+import qct_cache
+import qct_voxels
+
+IN = f'{Subj}_{I1}.img.gz'
+IN_lobe = f'{Subj}_{I1}_vida-lobes.img.gz'
+
+
+@pytest.fixture
+def images(subject, monkeypatch):
+    # several slabs
+    monkeypatch.setattr(lobar, 'CHUNK', SHAPE[0]*SHAPE[1]*5)
+    img, _ = load(os.path.join(subject, IN))
+    lobe, _ = load(os.path.join(subject, IN_lobe))
+    return img, lobe
+
+
+def test_from_mask(images):
+    img, lobe = images
+    table = qct_voxels.LungVoxels.from_mask(lobe)
+    flat = lobe.ravel(order='F')
+    np.testing.assert_array_equal(table.index, np.flatnonzero(flat))
+    np.testing.assert_array_equal(table.lobe, flat[flat != 0])
+    table.add('IN', img, keep_sum=True)
+    np.testing.assert_array_equal(table['IN'], img.ravel(order='F')[flat != 0])
+    assert table.sums['IN'] == np.sum(img)
+    full = table.scatter(table['IN'], fill=-1024)
+    np.testing.assert_array_equal(full, np.where(lobe != 0, img, -1024))
+
+
+def test_from_index(images):
+    _, lobe = images
+    table = qct_voxels.LungVoxels.from_index(qct_voxels.LobeIndex.from_mask(lobe))
+    ref = qct_voxels.LungVoxels.from_mask(lobe)
+    np.testing.assert_array_equal(table.index, ref.index)
+    np.testing.assert_array_equal(table.lobe, ref.lobe)
+
+
+def test_lobe_index(images, subject):
+    img, lobe = images
+    path = os.path.join(subject, IN_lobe)
+    index = qct_voxels.load_lobe_index(path)
+    cache_path = qct_voxels.lobe_index_path(path)
+    assert cache_path == os.path.join(subject, f'{Subj}_{I1}_vida-lobes_index.npz')
+    flat, flat_lobe = img.ravel(order='F'), lobe.ravel(order='F')
+    for k, label in enumerate(lobar.LOBES, 1):
+        np.testing.assert_array_equal(index.gather(img, k), flat[flat_lobe == label])
+    # from the cache, rebuilt when the mask changed
+    stamp = qct_cache.load_npz(cache_path)['stamp']
+    np.testing.assert_array_equal(qct_voxels.load_lobe_index(path).order, index.order)
+    assert qct_cache.load_npz(cache_path)['stamp'] == stamp
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10**9))
+    np.testing.assert_array_equal(qct_voxels.load_lobe_index(path).order, index.order)
+    assert qct_cache.is_fresh(qct_cache.load_npz(cache_path)['stamp'], [path])
+
+
+def test_cache(images, subject):
+    img, lobe = images
+    sources = {'IN': [os.path.join(subject, IN), os.path.join(subject, IN_lobe)]}
+    table = qct_voxels.LungVoxels.from_mask(lobe)
+    table.add('IN', img, keep_sum=True)
+    path = os.path.join(subject, 'voxels.npz')
+    qct_voxels.save_cache(path, {'IN': table}, sources)
+    cached = qct_voxels.load_cache(path, sources)['IN']
+    assert cached.shape == table.shape
+    np.testing.assert_array_equal(cached.index, table.index)
+    np.testing.assert_array_equal(cached['IN'], table['IN'])
+    assert cached.sums == table.sums
+    # stale when a source changed
+    os.utime(sources['IN'][0], ns=(0, os.stat(sources['IN'][0]).st_mtime_ns + 10**9))
+    assert qct_voxels.load_cache(path, sources) == {}
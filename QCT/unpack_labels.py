@@ -0,0 +1,46 @@
+# ##############################################################################
+# Usage: python unpack_labels.py path [path ...]
+# ex) python unpack_labels.py PMSN03001_EX0-TO-PMSN03001_IN0-SSTVD_AirT.lbl.npz
+#     python unpack_labels.py sample_data/ENV18PM
+# ##############################################################################
+# 20221018, In Kyu Lee
+#  - Export compact label images (.lbl.npz, get_QCT.py --packed) to
+#    Analyze .hdr/.img, the same files as without --packed.
+# ##############################################################################
+# Input:
+#  - .lbl.npz files, or folders (searched recursively)
+# Output:
+#  - .hdr/.img beside each .lbl.npz, ex) PMSN03001_EX0-TO-PMSN03001_IN0-SSTVD_AirT.img
+# ##############################################################################
+
+# import libraries
+import os
+import sys
+import time
+from tqdm.auto import tqdm
+
+import qct_io
+
+
+def find_labels(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files += [os.path.join(root, n) for n in sorted(names) if n.endswith(qct_io.LABEL_EXT)]
+        else:
+            files.append(path)
+    return files
+
+
+def main():
+    start = time.time()
+    files = find_labels(sys.argv[1:])
+    for path in tqdm(files):
+        qct_io.unpack_labels(path)
+    end = time.time()
+    print(f'{len(files)} files, Elapsed time: {end-start}s')
+
+
+if __name__ == "__main__":
+    main()
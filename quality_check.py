@@ -9,8 +9,8 @@ df_path = str(sys.argv[1])
 std_factor = int(sys.argv[2])
 
 df = pd.read_csv(df_path)
-df_mean = df.iloc[:,2:].mean()
-df_std = df.iloc[:,2:].std()
+df_mean = df.iloc[:,2:].mean(numeric_only=True)
+df_std = df.iloc[:,2:].std(numeric_only=True)
 up_thre = df_mean + df_std * std_factor
 lo_thre = df_mean - df_std * std_factor
 
@@ -28,7 +28,7 @@ def main():
     df_path = str(sys.argv[1])
     raw_df = pd.read_csv(df_path)
     print(f"Successfully read: {df_path}!\n")
-    str_cols = ['Proj','Subj','CaseType','dis','Cluster','BD']
+    str_cols = ['Proj','Subj','Img0','Img1','CaseType','dis','Cluster','BD']
     drop_cols = [x for x in str_cols if x in raw_df.columns ]
     df = raw_df.drop(columns=drop_cols)
     print(f"Dropping {drop_cols} columns\n")